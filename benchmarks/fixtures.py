@@ -0,0 +1,134 @@
+"""Synthetic wordpress sites for the benchmarks
+A site is a wordpress tree with wp-config.php, some php files and uploads,
+and a database stored as one sql file per table for the wp stand-in
+"""
+import json
+import os
+import random
+import shutil
+
+# Share of the dump taken by every table
+TABLES = {'wp_posts': 0.55, 'wp_postmeta': 0.25, 'wp_comments': 0.1,
+          'wp_options': 0.05, 'wp_users': 0.02, 'wp_usermeta': 0.03}
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+
+WP_CONFIG = """<?php
+define('DB_NAME', '{name}');
+define('DB_USER', 'bench');
+define('DB_PASSWORD', 'bench');
+define('DB_HOST', 'localhost');
+$table_prefix = 'wp_';
+"""
+
+
+def _text(rnd, size):
+    words = list()
+    length = 0
+    while length < size:
+        word = rnd.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)
+
+
+def _table(path, name, size, rnd, siteurl):
+    """Writes INSERT statements until the file reaches size bytes
+    The rows mix plain text, the site url and php serialized values, like
+    the rows search-replace works on
+    """
+    with open(path, 'w') as file:
+        file.write('DROP TABLE IF EXISTS `{0}`;\nCREATE TABLE `{0}` '
+                   '(`id` bigint(20) NOT NULL, `value` longtext, '
+                   'PRIMARY KEY (`id`));\n'.format(name))
+        # Generating the text of every row is slow for big dumps
+        texts = [_text(rnd, rnd.randint(100, 900)) for _ in range(1000)]
+        row = 0
+        while file.tell() < size:
+            values = list()
+            for _ in range(100):
+                row += 1
+                url = '{}/?p={}'.format(siteurl, row)
+                serialized = 'a:1:{{s:3:\\"url\\";s:{}:\\"{}\\";}}'.format(
+                    len(url), url)
+                values.append("({},'{} {} {}')".format(
+                    row, rnd.choice(texts), url, serialized))
+            file.write('INSERT INTO `{}` VALUES {};\n'.format(
+                name, ','.join(values)))
+
+
+def _tree(path, files, file_size, rnd):
+    for folder in ('wp-admin', 'wp-includes'):
+        os.makedirs(os.path.join(path, folder))
+        for idx in range(50):
+            with open(os.path.join(path, folder, 'file{}.php'.format(idx)),
+                      'w') as file:
+                file.write('<?php\n// {}\n'.format(_text(rnd, 4096)))
+    for idx in range(files):
+        folder = os.path.join(path, 'wp-content', 'uploads',
+                              '20{:02d}'.format(10 + idx % 10),
+                              '{:02d}'.format(1 + idx // 10 % 12))
+        os.makedirs(folder, exist_ok=True)
+        # The uploads are mostly already compressed media
+        with open(os.path.join(folder, 'upload{}.jpg'.format(idx)),
+                  'wb') as file:
+            file.write(rnd.getrandbits(file_size * 8).to_bytes(file_size,
+                                                               'little'))
+
+
+def generate(root, files=1000, file_size=32 * 1024,
+             dump_size=64 * 1024 * 1024, seed=0):
+    """Creates the source and destination sites inside root
+    root/src/site and root/dest/site are the wordpress paths and
+    root/src/db and root/dest/db their databases. The fixture is kept when
+    it was generated before with the same parameters
+    Returns the parameters of the fixture
+    """
+    params = {'files': files, 'file_size': file_size,
+              'dump_size': dump_size, 'seed': seed}
+    marker = os.path.join(root, 'fixture.json')
+    if os.path.exists(marker):
+        with open(marker) as file:
+            if json.load(file) == params:
+                return params
+    shutil.rmtree(root, ignore_errors=True)
+    rnd = random.Random(seed)
+    for direction, siteurl, tree, size in (
+            ('src', 'http://source.bench', files, dump_size),
+            ('dest', 'http://destination.bench', files // 10,
+             dump_size // 10)):
+        site = os.path.join(root, direction, 'site')
+        os.makedirs(site)
+        _tree(site, tree, file_size, rnd)
+        with open(os.path.join(site, 'wp-config.php'), 'w') as file:
+            file.write(WP_CONFIG.format(name=direction))
+        db = os.path.join(root, direction, 'db')
+        os.makedirs(db)
+        for name, share in TABLES.items():
+            _table(os.path.join(db, name + '.sql'), name, int(size * share),
+                   rnd, siteurl)
+    with open(marker, 'w') as file:
+        file.write(json.dumps(params))
+    return params
+
+
+def reset(root):
+    """Restores the destination site, which the migrations replace, and
+    removes the temporary files of both machines
+    """
+    site = os.path.join(root, 'dest', 'site')
+    backup = os.path.join(root, 'dest.orig')
+    if not os.path.exists(backup):
+        shutil.copytree(site, backup, symlinks=True)
+    shutil.rmtree(site, ignore_errors=True)
+    shutil.copytree(backup, site, symlinks=True)
+    for direction in ('src', 'dest'):
+        for name in os.listdir(os.path.join(root, direction)):
+            path = os.path.join(root, direction, name)
+            if name in ('site', 'db'):
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
@@ -0,0 +1,114 @@
+"""Checks the builtin search and replace against dumps whose result is
+known: nested php serialized strings, lengths which do not match, urls
+escaped by json, quotes escaped in the literals, urls split between the
+pieces fed and the order of the batches replaced by several workers
+
+python3 benchmarks/replace.py
+"""
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import process.replace  # noqa: E402
+from process.replace import Replacer, replace_batch, rules  # noqa: E402
+
+SEARCH = 'http://old.example'
+REPLACE = 'https://new.example.com'
+
+
+def _serialized(value):
+    return b's:%d:"%s";' % (len(value), value)
+
+
+def _sql(value):
+    """Quotes a value like mysqldump"""
+    return b"'" + process.replace._escape(value) + b"'"
+
+
+def _insert(*values):
+    return b'INSERT INTO `wp_options` VALUES (1,%s);\n' % b','.join(values)
+
+
+def _cases():
+    """Returns the (name, dump, expected) of every check"""
+    old = SEARCH.encode('utf-8')
+    new = REPLACE.encode('utf-8')
+    nested = b'a:1:{i:0;%s}' % _serialized(
+        b'a:1:{s:3:"url";%s}' % _serialized(old + b'/page'))
+    fixed = b'a:1:{i:0;%s}' % _serialized(
+        b'a:1:{s:3:"url";%s}' % _serialized(new + b'/page'))
+    return [
+        ('plain', _insert(_sql(old + b'/a')), _insert(_sql(new + b'/a'))),
+        ('serialized', _insert(_sql(_serialized(old))),
+         _insert(_sql(_serialized(new)))),
+        ('nested', _insert(_sql(nested)), _insert(_sql(fixed))),
+        # A length which does not match is left as it was, like wp does
+        ('mismatched length', _insert(_sql(b's:5:"' + old + b'";')),
+         _insert(_sql(b's:5:"' + new + b'";'))),
+        ('json', _insert(_sql(b'{"u":"' + old.replace(b'/', b'\\/') +
+                              b'"}')),
+         _insert(_sql(b'{"u":"' + new.replace(b'/', b'\\/') + b'"}'))),
+        ('escaped quotes', _insert(_sql(b"it's \"" + old + b'"'),
+                                   _sql(_serialized(b"'" + old + b"'"))),
+         _insert(_sql(b"it's \"" + new + b'"'),
+                 _sql(_serialized(b"'" + new + b"'")))),
+        # The names and the comments are not values
+        ('names', b'-- ' + old + b'\nINSERT INTO `' + old + b'` VALUES (1);\n',
+         b'-- ' + old + b'\nINSERT INTO `' + old + b'` VALUES (1);\n'),
+    ]
+
+
+def _feed(engine, dump, sizes):
+    """Feeds the dump in pieces of the given sizes, returns the output"""
+    output = list()
+    pos = 0
+    while pos < len(dump):
+        size = next(sizes)
+        output.append(engine.feed(dump[pos:pos + size]))
+        pos += size
+    output.append(engine.close())
+    return b''.join(output)
+
+
+def _check(name, result, expected, failures):
+    if result != expected:
+        failures.append(name)
+        print('FAIL {}\n  expected {!r}\n  got      {!r}'.format(
+            name, expected[:300], result[:300]))
+    else:
+        print('ok   {}'.format(name))
+
+
+def main():
+    failures = list()
+    pairs = rules(SEARCH, REPLACE)
+    cases = _cases()
+    for name, dump, expected in cases:
+        _check(name, replace_batch(dump, pairs), expected, failures)
+    dump = b''.join(item[1] for item in cases)
+    expected = b''.join(item[2] for item in cases)
+    # Every url is split between two pieces at least once
+    for size in (1, 2, 3, 7):
+        _check('pieces of {} bytes'.format(size),
+               _feed(Replacer(SEARCH, REPLACE), dump, iter(lambda: size, 0)),
+               expected, failures)
+    # Small batches, so the workers replace many of them at the same time
+    # and they finish in any order
+    process.replace.BATCH_SIZE = 256
+    rand = random.Random(0)
+    lines = [rand.choice(cases)[1:] if idx % 3 else
+             (_insert(_sql(b'row %d' % idx)),) * 2 for idx in range(3000)]
+    dump = b''.join(item[0] for item in lines)
+    expected = b''.join(item[1] for item in lines)
+    _check('order with 4 workers',
+           _feed(Replacer(SEARCH, REPLACE, workers=4), dump,
+                 iter(lambda: rand.randint(1, 4096), 0)),
+           expected, failures)
+    if failures:
+        sys.exit('{} of the checks failed'.format(len(failures)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""Runs migrations end to end between two local ssh servers and measures
+the time of the migration and of every step, the peak memory of the client
+and the bytes on the wire
+
+python3 benchmarks/run.py --output results.json
+python3 benchmarks/run.py --output new.json --compare results.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import fixtures
+import server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHIMS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shims')
+
+# Arguments of every scenario, the warm ones run once before being measured
+# so they start from a destination which was already migrated
+SCENARIOS = {
+    'default': {'flags': []},
+    'stream': {'flags': ['--stream']},
+    'stream-db': {'flags': ['--stream-db']},
+    'delta': {'flags': ['--delta']},
+    'delta-warm': {'flags': ['--delta'], 'warm': True},
+    'zstd': {'flags': ['--compression', 'zstd']},
+    'db-workers': {'flags': ['--db-workers', '4']},
+    'streams': {'flags': ['--streams', '4']},
+    'plan': {'flags': ['--plan']},
+}
+
+
+def _start_servers(root):
+    servers = dict()
+    for direction, siteurl in (('src', 'http://source.bench'),
+                               ('dest', 'http://destination.bench')):
+        env = dict(os.environ)
+        env['PATH'] = SHIMS + os.pathsep + env['PATH']
+        env['BENCH_DB'] = os.path.join(root, direction, 'db')
+        env['BENCH_SITEURL'] = siteurl
+        servers[direction] = server.serve(os.path.join(root, direction), env)
+    return servers
+
+
+def _migrate(root, servers, flags, work_dir):
+    """Runs main.py and returns the seconds, the peak rss in KB, the bytes
+    on the wire and the report of the steps
+    """
+    report = os.path.join(work_dir, 'report.json')
+    cmd = [sys.executable, os.path.join(ROOT, 'main.py'), '-n',
+           '--log-level', 'warning', '--work-dir', work_dir,
+           '--tmp-dir', 'tmp', '--report', report]
+    for direction in ('src', 'dest'):
+        cmd += ['--{}-address'.format(direction), '127.0.0.1',
+                '--{}-port'.format(direction), str(servers[direction][0]),
+                '--{}-user'.format(direction), 'bench',
+                '--{}-passw'.format(direction), 'bench',
+                '--{}-wpath'.format(direction),
+                os.path.join(root, direction, 'site')]
+    wire = sum(counter.value for _, counter in servers.values())
+    start = time.time()
+    proc = subprocess.Popen(cmd + flags)
+    # wait4 gives the peak memory of the migration alone
+    _, status, usage = os.wait4(proc.pid, 0)
+    elapsed = time.time() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise Exception('Migration failed: {}'.format(' '.join(flags)))
+    wire = sum(counter.value for _, counter in servers.values()) - wire
+    with open(report) as file:
+        steps = json.load(file)['sites'][0]['steps']
+    return elapsed, usage.ru_maxrss, wire, steps
+
+
+def run(args):
+    params = fixtures.generate(args.root, args.files, args.file_size * 1024,
+                               args.dump_size * 1024 * 1024)
+    servers = _start_servers(args.root)
+    results = dict()
+    for name in args.scenario:
+        scenario = SCENARIOS[name]
+        runs = list()
+        work_dir = tempfile.mkdtemp(prefix='wpbench.')
+        try:
+            for _ in range(args.repeat):
+                fixtures.reset(args.root)
+                shutil.rmtree(work_dir)
+                os.makedirs(work_dir)
+                if scenario.get('warm'):
+                    _migrate(args.root, servers, scenario['flags'], work_dir)
+                elapsed, rss, wire, steps = _migrate(
+                    args.root, servers, scenario['flags'], work_dir)
+                runs.append({'time': elapsed, 'peak_rss_kb': rss,
+                             'wire_bytes': wire,
+                             'steps': {step['key']: step['wall_time']
+                                       for step in steps
+                                       if step['status'] == 'done'}})
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        results[name] = {
+            'time': statistics.median(item['time'] for item in runs),
+            'peak_rss_kb': max(item['peak_rss_kb'] for item in runs),
+            'wire_bytes': statistics.median(item['wire_bytes']
+                                            for item in runs),
+            'steps': {key: statistics.median(item['steps'][key]
+                                             for item in runs)
+                      for key in runs[0]['steps']},
+            'runs': runs}
+        print('{:<12} {:>8.2f}s {:>9.1f} MB rss {:>10.1f} MB wire'.format(
+            name, results[name]['time'], results[name]['peak_rss_kb'] / 1024,
+            results[name]['wire_bytes'] / 1024 / 1024))
+    return {'fixture': params, 'python': platform.python_version(),
+            'platform': platform.platform(), 'commit': _commit(),
+            'results': results}
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL
+                                       ).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def compare(old, new, threshold):
+    """Prints the change of every measure between two results
+    Returns True when a time, memory or wire measure grew more than
+    threshold percent
+    """
+    if old['fixture'] != new['fixture']:
+        print('Warning: the results were taken with different fixtures')
+    regression = False
+    print('{:<40} {:>12} {:>12} {:>8}'.format('measure', 'old', 'new',
+                                                'change'))
+    for name in new['results']:
+        if name not in old['results']:
+            continue
+        before = old['results'][name]
+        after = new['results'][name]
+        measures = [('time', 'time'), ('peak_rss_kb', 'peak_rss_kb'),
+                    ('wire_bytes', 'wire_bytes')]
+        measures += [('step ' + key, key) for key in after['steps']
+                     if key in before['steps']]
+        for label, key in measures:
+            if label.startswith('step '):
+                old_value, new_value = before['steps'][key], after['steps'][key]
+            else:
+                old_value, new_value = before[key], after[key]
+            change = (new_value - old_value) / old_value * 100 \
+                if old_value else 0
+            # The steps are too short to flag their noise as regressions
+            flag = change > threshold and not label.startswith('step ')
+            regression = regression or flag
+            print('{:<40} {:>12.2f} {:>12.2f} {:>7.1f}%{}'.format(
+                '{} {}'.format(name, label)[:40], old_value, new_value,
+                change, ' REGRESSION' if flag else ''))
+    return regression
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Migration benchmarks')
+    parser.add_argument('--root', default=os.path.join(tempfile.gettempdir(),
+                                                       'wpbench'),
+                        help='Directory of the synthetic sites, they are '
+                             'reused while the parameters do not change')
+    parser.add_argument('--files', default=1000, type=int,
+                        help='Amount of uploads in the source site')
+    parser.add_argument('--file-size', default=32, type=int,
+                        help='Size in KB of every upload')
+    parser.add_argument('--dump-size', default=64, type=int,
+                        help='Size in MB of the source database dump')
+    parser.add_argument('--scenario', nargs='+', default=list(SCENARIOS),
+                        choices=list(SCENARIOS))
+    parser.add_argument('--repeat', default=3, type=int,
+                        help='Runs of every scenario, the median is kept')
+    parser.add_argument('--output', help='Write the results in a json file')
+    parser.add_argument('--compare', help='Compare with a previous result')
+    parser.add_argument('--threshold', default=10, type=float,
+                        help='Percent of growth reported as a regression')
+    args = parser.parse_args()
+
+    result = run(args)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(json.dumps(result, indent=2))
+    if args.compare:
+        with open(args.compare) as file:
+            if compare(json.load(file), result, args.threshold):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
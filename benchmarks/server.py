@@ -0,0 +1,210 @@
+"""Local ssh server used as source and destination by the benchmarks
+It accepts any user, password and key, runs the commands with bash in its
+root directory and serves sftp. Relative paths resolve against the root,
+like they resolve against the home directory in a real server, so two
+servers in the same machine do not share their temporary files when the
+migration uses a relative --tmp-dir
+"""
+import logging
+import os
+import socket
+import subprocess
+import threading
+
+import paramiko
+from paramiko import (SFTPAttributes, SFTPHandle, SFTPServer,
+                      SFTPServerInterface, SFTP_OK)
+
+HOST_KEY = paramiko.RSAKey.generate(2048)
+
+# The clients close their transports without a goodbye
+logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+
+
+class _CountingSocket(object):
+    """Socket which counts the bytes sent and received"""
+
+    def __init__(self, sock, counter):
+        self.sock = sock
+        self.counter = counter
+
+    def recv(self, size):
+        data = self.sock.recv(size)
+        self.counter.add(len(data))
+        return data
+
+    def send(self, data):
+        sent = self.sock.send(data)
+        self.counter.add(sent)
+        return sent
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+        self.counter.add(len(data))
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class Counter(object):
+    """Bytes on the wire of a server"""
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def add(self, amount):
+        with self.lock:
+            self.value += amount
+
+
+class _Handle(SFTPHandle):
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        if attr.st_size is not None:
+            self.writefile.truncate(attr.st_size)
+        return SFTP_OK
+
+
+def _sftp_interface(root):
+    class Interface(SFTPServerInterface):
+        def _path(self, path):
+            return os.path.join(root, path)
+
+        def list_folder(self, path):
+            items = list()
+            for name in os.listdir(self._path(path)):
+                attr = SFTPAttributes.from_stat(
+                    os.lstat(os.path.join(self._path(path), name)))
+                attr.filename = name
+                items.append(attr)
+            return items
+
+        def stat(self, path):
+            try:
+                return SFTPAttributes.from_stat(os.stat(self._path(path)))
+            except OSError as exc:
+                return SFTPServer.convert_errno(exc.errno)
+
+        lstat = stat
+
+        def open(self, path, flags, attr):
+            try:
+                fd = os.open(self._path(path), flags, 0o644)
+            except OSError as exc:
+                return SFTPServer.convert_errno(exc.errno)
+            if flags & os.O_WRONLY:
+                mode = 'ab' if flags & os.O_APPEND else 'wb'
+            elif flags & os.O_RDWR:
+                mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+            else:
+                mode = 'rb'
+            handle = _Handle(flags)
+            handle.filename = path
+            handle.readfile = handle.writefile = os.fdopen(fd, mode)
+            return handle
+
+        def remove(self, path):
+            os.remove(self._path(path))
+            return SFTP_OK
+
+        def rename(self, old, new):
+            os.rename(self._path(old), self._path(new))
+            return SFTP_OK
+
+        posix_rename = rename
+
+        def mkdir(self, path, attr):
+            os.mkdir(self._path(path))
+            return SFTP_OK
+
+    return Interface
+
+
+def _run(channel, command, root, env):
+    proc = subprocess.Popen(['bash', '-c', command], cwd=root, env=env,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+
+    def pump_in():
+        try:
+            while True:
+                data = channel.recv(256 * 1024)
+                if not data:
+                    break
+                proc.stdin.write(data)
+                proc.stdin.flush()
+        except Exception:
+            pass
+        try:
+            proc.stdin.close()
+        except Exception:
+            pass
+
+    def pump(src, send):
+        while True:
+            data = src.read1(256 * 1024)
+            if not data:
+                break
+            send(data)
+
+    threading.Thread(target=pump_in, daemon=True).start()
+    threads = [threading.Thread(target=pump, args=(proc.stdout,
+                                                   channel.sendall)),
+               threading.Thread(target=pump, args=(proc.stderr,
+                                                   channel.sendall_stderr))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    channel.send_exit_status(proc.wait())
+    channel.shutdown_write()
+    channel.close()
+
+
+class _Server(paramiko.ServerInterface):
+    def __init__(self, root, env):
+        self.root = root
+        self.env = env
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=_run, daemon=True,
+                         args=(channel, command.decode('utf-8'), self.root,
+                               self.env)).start()
+        return True
+
+
+def serve(root, env, port=0):
+    """Starts a server in a background thread
+    Returns its port and the counter of bytes on the wire
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', port))
+    sock.listen(100)
+    counter = Counter()
+
+    def loop():
+        while True:
+            client, _ = sock.accept()
+            transport = paramiko.Transport(_CountingSocket(client, counter))
+            transport.add_server_key(HOST_KEY)
+            transport.set_subsystem_handler('sftp', SFTPServer,
+                                            _sftp_interface(root))
+            transport.start_server(server=_Server(root, env))
+    threading.Thread(target=loop, daemon=True).start()
+    return sock.getsockname()[1], counter
@@ -0,0 +1,73 @@
+"""Measures the throughput of chunked downloads and uploads with several
+streams against a ssh server
+python3 benchmarks/streams.py --address HOST --user USER --key KEY.pem
+"""
+import argparse
+import os
+import sys
+import time
+
+import paramiko
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from process.transfer import download, upload  # noqa: E402
+
+LOCAL_FILE = 'streams.bench'
+REMOTE_FILE = '/tmp/streams.bench'
+
+
+def _connect(args):
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    key = paramiko.RSAKey.from_private_key_file(args.key) if args.key else None
+    ssh.connect(args.address, port=args.port, username=args.user, pkey=key,
+                password=args.password, look_for_keys=False,
+                allow_agent=False)
+    return ssh
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Multi-stream transfer '
+                                                 'benchmark')
+    parser.add_argument('--address', required=True)
+    parser.add_argument('--port', default=22, type=int)
+    parser.add_argument('--user', default=None)
+    parser.add_argument('--key', default=None)
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--size', default=256, type=int,
+                        help='Size in MB of the file transferred')
+    parser.add_argument('--chunk-size', default=8, type=int,
+                        help='Size in MB of every chunk')
+    parser.add_argument('--streams', default='1,2,4,8',
+                        help='Comma separated amounts of streams to measure')
+    args = parser.parse_args()
+
+    counts = [int(item) for item in args.streams.split(',')]
+    connections = [_connect(args) for _ in range(max(counts))]
+    chunk_size = args.chunk_size * 1024 * 1024
+    with open(LOCAL_FILE, 'wb') as file:
+        for _ in range(args.size):
+            file.write(os.urandom(1024 * 1024))
+    size = os.path.getsize(LOCAL_FILE)
+    try:
+        print('streams  upload MB/s  download MB/s')
+        for count in counts:
+            start = time.time()
+            upload(connections[:count], LOCAL_FILE, REMOTE_FILE, dict(),
+                   lambda: None, chunk_size)
+            up = size / (time.time() - start) / 1024 / 1024
+            start = time.time()
+            download(connections[:count], REMOTE_FILE, LOCAL_FILE, dict(),
+                     lambda: None, chunk_size)
+            down = size / (time.time() - start) / 1024 / 1024
+            print('{:>7}  {:>11.1f}  {:>13.1f}'.format(count, up, down))
+    finally:
+        os.remove(LOCAL_FILE)
+        connections[0].exec_command('rm -f {}'.format(REMOTE_FILE))
+        for ssh in connections:
+            ssh.close()
+
+
+if __name__ == '__main__':
+    main()
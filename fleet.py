@@ -0,0 +1,151 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import copy
+import json
+import os.path
+import posixpath
+import re
+import threading
+import time
+
+from migration import Migration
+from process.pool import ConnectionPool
+import lib
+import metrics
+
+
+def load_manifest(path):
+    """Loads the sites of a fleet manifest
+    The manifest is a list of site configurations with the keys of
+    example.json, or an object with that list in "sites" and the values
+    shared by all of them in "defaults"
+    Returns the shared values and the list of sites
+    """
+    with open(path) as file:
+        data = json.load(file)
+    if isinstance(data, list):
+        return dict(), data
+    return data.get('defaults', dict()), data['sites']
+
+
+def _site_name(idx, site):
+    name = site.get('name') or '{}-{}'.format(idx, site.get('src_address'))
+    return re.sub('[^A-Za-z0-9_.-]', '_', name)
+
+
+class Fleet(object):
+    """Migrates many sites with a bounded pool of migrations
+
+    A site starts when there is a free worker and the migrations already
+    running against its source and destination machines are below the
+    limits of each host. Every site keeps its resume state in its own work
+    directory and its remote temporary files in its own directory.
+    """
+
+    def __init__(self, args, defaults):
+        self.args = args
+        # The sites in the same machines share their connections
+        self.pool = ConnectionPool()
+        shared, sites = load_manifest(args.fleet)
+        self.sites = list()
+        for idx, site in enumerate(sites):
+            name = _site_name(idx, site)
+            site_args = copy.copy(args)
+            # The values given in argv win over the site ones and the site
+            # ones over the shared ones
+            lib.apply_values(site_args, site, defaults)
+            lib.apply_values(site_args, shared, defaults)
+            site_args.work_dir = os.path.join(args.work_dir, name)
+            site_args.tmp_dir = posixpath.join(site_args.tmp_dir,
+                                               'wp-migration.' + name)
+            # The fleet writes the measures of all the sites together
+            site_args.report = None
+            site_args.trace = None
+            self.sites.append({'name': name, 'args': site_args,
+                               'status': 'pending', 'duration': 0,
+                               'bytes': 0, 'steps': list()})
+
+    def _hosts(self, site):
+        return (site['args'].src_address, site['args'].dest_address)
+
+    def _ready(self, site, busy):
+        src, dest = self._hosts(site)
+        return (busy['src'].get(src, 0) < self.args.src_host_limit and
+                busy['dest'].get(dest, 0) < self.args.dest_host_limit)
+
+    def _migrate(self, site):
+        # The log lines of the steps waiting in the event loop of the site
+        # are told apart by the name of its thread
+        threading.current_thread().name = site['name']
+        lib.log.info('Site %s starts', site['name'])
+        migration = Migration(site['args'], site['name'], self.pool)
+        try:
+            success = migration.execute()
+        finally:
+            site['duration'] = migration.duration
+            site['bytes'] = migration.bytes
+            site['steps'] = migration.steps
+        lib.log.info('Site %s %s', site['name'],
+                     'done' if success else 'failed')
+        return success
+
+    def run(self):
+        """Migrates every site
+        Returns True when all of them were migrated
+        """
+        start = time.time()
+        busy = {'src': dict(), 'dest': dict()}
+        pending = list(self.sites)
+        running = dict()
+        with ThreadPoolExecutor(max_workers=self.args.fleet_workers,
+                                thread_name_prefix='fleet') as executor:
+            while pending or running:
+                for site in list(pending):
+                    if len(running) >= self.args.fleet_workers:
+                        break
+                    if not self._ready(site, busy):
+                        continue
+                    pending.remove(site)
+                    src, dest = self._hosts(site)
+                    busy['src'][src] = busy['src'].get(src, 0) + 1
+                    busy['dest'][dest] = busy['dest'].get(dest, 0) + 1
+                    site['status'] = 'running'
+                    running[executor.submit(self._migrate, site)] = site
+                if not running:
+                    break
+                complete, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in complete:
+                    site = running.pop(future)
+                    src, dest = self._hosts(site)
+                    busy['src'][src] -= 1
+                    busy['dest'][dest] -= 1
+                    exc = future.exception()
+                    if exc is not None:
+                        lib.log.error('Site %s: %s', site['name'], exc)
+                        site['status'] = 'failed'
+                    else:
+                        site['status'] = 'done' if future.result() \
+                            else 'failed'
+        self.pool.close()
+        self.summary(time.time() - start)
+        measures = [(site['name'], site['steps']) for site in self.sites]
+        if self.args.report:
+            metrics.write_report(self.args.report, measures)
+        if self.args.trace:
+            metrics.write_trace(self.args.trace, measures)
+        return all(site['status'] == 'done' for site in self.sites)
+
+    def summary(self, elapsed):
+        """Logs a table with the result of every site"""
+        width = max([len(site['name']) for site in self.sites] + [4])
+        lib.log.info('%s  %-7s  %10s  %12s', 'Site'.ljust(width), 'Status',
+                     'Duration', 'Transferred')
+        for site in self.sites:
+            lib.log.info('%s  %-7s  %9.1fs  %9.1f MB',
+                         site['name'].ljust(width), site['status'],
+                         site['duration'], site['bytes'] / 1024 / 1024)
+        lib.log.info('%s  %-7s  %9.1fs  %9.1f MB', 'Total'.ljust(width),
+                     '%d/%d' % (sum(site['status'] == 'done'
+                                    for site in self.sites),
+                                len(self.sites)),
+                     elapsed,
+                     sum(site['bytes'] for site in self.sites) / 1024 / 1024)
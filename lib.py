@@ -1,3 +1,16 @@
 import logging
 
 log = logging.getLogger('')
+
+
+def apply_values(args, data, defaults):
+    """Sets the values of data in args
+    Only the arguments which still have their default value are changed, so
+    the values given in argv are kept
+    """
+    for item in dir(args):
+        if item[0] == '_':
+            continue
+        if item in data and \
+                args.__getattribute__(item) == defaults.get(item, None):
+            args.__setattr__(item, data[item])
@@ -3,7 +3,9 @@
 import argparse
 import json
 import logging
+import os
 
+from fleet import Fleet
 from migration import Migration
 import lib
 
@@ -15,12 +17,7 @@ def load_from_json(args, defaults):
     try:
         with open(args.json_file) as file:
             data = json.load(file)
-        for item in dir(args):
-            if item[0] == '_':
-                continue
-            if item in data and \
-                    args.__getattribute__(item) == defaults.get(item, None):
-                args.__setattr__(item, data[item])
+        lib.apply_values(args, data, defaults)
     except Exception as exc:
         lib.log.error(exc)
 
@@ -38,6 +35,64 @@ def handle_options():
     parser.add_argument('-n', '--no-cache', action='store_true',
                         help='Run the client without cache')
 
+    parser.add_argument('--jobs', action='store', default=4, type=int,
+                        help='Maximum amount of steps running at the same '
+                             'time')
+
+    parser.add_argument('--work-dir', action='store', default='.', type=str,
+                        help='Directory of this machine for the resume state '
+                             'and the downloaded files')
+    parser.add_argument('--tmp-dir', action='store', default='/tmp',
+                        type=str,
+                        help='Directory of the remote machines for the '
+                             'temporary files')
+
+    parser.add_argument('--fleet', action='store', type=str,
+                        help='Migrate every site of a json manifest')
+    parser.add_argument('--fleet-workers', action='store', default=4,
+                        type=int,
+                        help='Maximum amount of sites migrated at the same '
+                             'time')
+    parser.add_argument('--src-host-limit', action='store', default=1,
+                        type=int,
+                        help='Maximum amount of sites migrated at the same '
+                             'time from the same source machine')
+    parser.add_argument('--dest-host-limit', action='store', default=1,
+                        type=int,
+                        help='Maximum amount of sites migrated at the same '
+                             'time into the same destination machine')
+
+    parser.add_argument('--keepalive', action='store', default=30, type=int,
+                        help='Seconds between ssh keepalive messages')
+    parser.add_argument('--retries', action='store', default=3, type=int,
+                        help='Times a connection is tried again, and a step '
+                             'is executed again after a connection dropped')
+    parser.add_argument('--command-timeout', action='store', type=int,
+                        help='Seconds a remote command may run before it is '
+                             'stopped, without limit by default')
+    parser.add_argument('--max-channels', action='store', default=10,
+                        type=int,
+                        help='Maximum amount of channels open at the same '
+                             'time in every ssh connection')
+    parser.add_argument('--ciphers', action='store', type=str,
+                        default='aes128-gcm@openssh.com,aes128-ctr',
+                        help='Comma separated ssh ciphers tried first')
+    parser.add_argument('--ssh-compression', action='store_true',
+                        help='Enable the compression of the ssh transport')
+    parser.add_argument('--window-size', action='store', default=16,
+                        type=int,
+                        help='Size in MB of the ssh channel windows')
+    parser.add_argument('--packet-size', action='store', default=32,
+                        type=int,
+                        help='Maximum size in KB of the ssh packets')
+
+    parser.add_argument('--report', action='store', type=str,
+                        help='Write the time, remote command time, bytes and '
+                             'throughput of every step in a json file')
+    parser.add_argument('--trace', action='store', type=str,
+                        help='Write the timeline of the steps and remote '
+                             'commands in a Chrome trace file')
+
     parser.add_argument('--dest-sudo', action='store_true',
                         help='The destination username is not root and needs '
                              'sudo')
@@ -45,6 +100,110 @@ def handle_options():
     parser.add_argument('--fast-copy', action='store_true',
                         help='Transfer backup directly from source to '
                              'destination')
+    parser.add_argument('--stream', action='store_true',
+                        help='Stream the wordpress files from the source tar '
+                             'into the destination tar without tar files')
+    parser.add_argument('--stream-db', action='store_true',
+                        help='Stream the database from the source export '
+                             'into the destination import without dump '
+                             'files')
+
+    parser.add_argument('--phase', action='store', type=str,
+                        choices=['presync', 'cutover'],
+                        help='presync copies the site while the source '
+                             'stays live, cutover then transfers the files, '
+                             'tables and ranges changed since the presync')
+
+    parser.add_argument('--atomic-swap', action='store_true',
+                        help='Write the files and the tables next to the '
+                             'destination site, which keeps running until '
+                             'they take its place at the end')
+
+    parser.add_argument('--backup-dir', action='store', type=str,
+                        help='Directory of the destination for the backups '
+                             'of the site, by default the wordpress path '
+                             'with the .backups suffix')
+    parser.add_argument('--backup-keep', action='store', default=3, type=int,
+                        help='Backups of the destination kept, the oldest '
+                             'ones are removed, 0 does not back it up')
+
+    parser.add_argument('--verify', action='store_true',
+                        help='Compare the files and the tables of the '
+                             'destination with the source at the end')
+    parser.add_argument('--verify-only', action='store_true',
+                        help='Only compare the files and the tables of an '
+                             'already migrated destination with the source')
+    parser.add_argument('--plan', action='store_true',
+                        help='Only estimate the bytes and the time of every '
+                             'step of the migration and check the free '
+                             'space, nothing is migrated')
+
+    parser.add_argument('--exclude', action='append', type=str,
+                        help='Leave out of the transfer the source files '
+                             'matching a pattern like node_modules or '
+                             'wp-content/cache, it can be repeated')
+    parser.add_argument('--include', action='append', type=str,
+                        help='Transfer the source files matching a pattern '
+                             'even if they are excluded, it can be repeated')
+    parser.add_argument('--no-default-excludes', action='store_true',
+                        help='Transfer the caches, backups and logs which '
+                             'are excluded by default')
+
+    parser.add_argument('--compression', action='store', type=str,
+                        default='none',
+                        help='Compression for the tar files and the database '
+                             'dumps: none, gzip, zstd or lz4, optionally '
+                             'with a level (zstd:9), or auto to pick the '
+                             'fastest one for the link')
+
+    parser.add_argument('--db-workers', action='store', default=1, type=int,
+                        help='Split the database in groups of tables which '
+                             'are exported, transferred and imported in '
+                             'parallel')
+    parser.add_argument('--db-chunk-size', action='store', default=0,
+                        type=int,
+                        help='Split the tables bigger than this size in MB '
+                             'in ranges of their primary key, which are '
+                             'exported, transferred and imported on their '
+                             'own, 0 does not split them. Every range is '
+                             'read in its own transaction, so the chunks '
+                             'need --phase, whose cutover migrates again the '
+                             'ranges written meanwhile')
+
+    parser.add_argument('--search-replace', action='store', type=str,
+                        choices=['builtin', 'wp'],
+                        help='Replace the site url in the database dump '
+                             'while it goes through this machine, or with '
+                             'wp search-replace in the source. builtin by '
+                             'default, except for the fix destination '
+                             'hostname flow, which runs wp search-replace '
+                             'in the destination')
+
+    parser.add_argument('--replace-workers', action='store',
+                        default=os.cpu_count() or 1, type=int,
+                        help='Processes which replace the site url in the '
+                             'database dump')
+
+    parser.add_argument('--chunk-size', action='store', default=8, type=int,
+                        help='Size in MB of the verified chunks used to '
+                             'download and upload files')
+
+    parser.add_argument('--streams', action='store', default=1, type=int,
+                        help='Number of ssh connections used at the same '
+                             'time to download and upload a file')
+
+    parser.add_argument('--cache-dir', action='store', type=str,
+                        help='Keep the downloaded files by content in this '
+                             'directory, so the next migrations of the site '
+                             'only download the files not cached')
+    parser.add_argument('--cache-size', action='store', default=10,
+                        type=int,
+                        help='Size in GB of the cache, the least recently '
+                             'used files are removed over it')
+
+    parser.add_argument('--delta', action='store_true',
+                        help='Transfer only the new and changed files and '
+                             'remove only the deleted ones')
 
     parser.add_argument('--fix-destination-hostname', action='store_true',
                         help='Change the hostname on wp_config and in the DB')
@@ -57,6 +216,20 @@ def handle_options():
                         help='Omit users in migration')
     parser.add_argument('--no-posts', action='store_true',
                         help='Omit posts in migration')
+    parser.add_argument('--schema-only', action='append', type=str,
+                        metavar='PATTERN',
+                        help='Migrate the tables matching the pattern '
+                             'without their rows, it can be repeated')
+    parser.add_argument('--where', action='append', type=str,
+                        metavar='TABLE:CONDITION',
+                        help='Migrate only the rows of the table matching '
+                             'the sql condition, it can be repeated')
+    parser.add_argument('--site', action='append', type=str,
+                        metavar='SITE[=DOMAIN]',
+                        help='Migrate only this site of a multisite network, '
+                             'given by its blog id or its url, optionally '
+                             'moving it to another domain, it can be '
+                             'repeated')
 
     # Parameter to accept json
     parser.add_argument('-j', '--json-file', action='store', type=str,
@@ -108,7 +281,7 @@ def handle_options():
     if args.json_file is not None:
         load_from_json(args, defaults)
 
-    return args
+    return args, defaults
 
 
 def main():
@@ -121,15 +294,27 @@ def main():
            '%(message)s')
     shr.setFormatter(logging.Formatter(fmt, "%H:%M:%S"))
     lib.log.addHandler(shr)
-    args = handle_options()
+    args, defaults = handle_options()
+    if args.fleet:
+        # The thread names tell the sites apart
+        shr.setFormatter(logging.Formatter(
+            fmt.replace('%(filename)s', '%(threadName)s'), "%H:%M:%S"))
     levels = {'debug': logging.DEBUG, 'info': logging.INFO,
               'warning': logging.WARNING, 'error': logging.ERROR}
     lib.log.setLevel(levels[args.log_level])
     logging.getLogger("paramiko").setLevel(logging.WARNING)
     del levels
     lib.log.debug(args)
-    if args is not None:
-        Migration(args).execute()
+    try:
+        if args.fleet:
+            success = Fleet(args, defaults).run()
+        else:
+            success = Migration(args).execute()
+    except Exception as exc:
+        lib.log.error(exc)
+        success = False
+    if not success:
+        exit(-1)
 
 if __name__ == '__main__':
     main()
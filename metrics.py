@@ -0,0 +1,241 @@
+import contextvars
+import json
+import re
+import threading
+import time
+
+import lib
+
+# Seconds between the progress lines of a transfer
+PROGRESS_INTERVAL = 5
+
+# Lane of the trace where the current step is drawn, by default the thread
+# running it
+LANE = contextvars.ContextVar('lane', default=None)
+
+
+def _lane():
+    return LANE.get() or threading.current_thread().name
+
+
+class StepStats(object):
+    """Measures of a process: wall time, time spent in remote commands,
+    bytes transferred and times it was executed again
+    """
+
+    def __init__(self, key, name):
+        self.key = key
+        self.name = name
+        self.status = 'skipped'
+        self.start = None
+        self.end = None
+        self.thread = None
+        self.bytes = 0
+        self.retries = 0
+        # Other measures of the process, like the hits of a cache
+        self.info = dict()
+        # Remote commands as (command, thread, start, end)
+        self.commands = list()
+        self.lock = threading.Lock()
+
+    def begin(self):
+        self.start = time.time()
+        self.thread = _lane()
+
+    def finish(self, status):
+        self.end = time.time()
+        self.status = status
+
+    def add_bytes(self, amount):
+        with self.lock:
+            self.bytes += amount
+
+    def add_command(self, command, thread, start, end):
+        with self.lock:
+            self.commands.append((command, thread, start, end))
+
+    @property
+    def wall_time(self):
+        if self.start is None:
+            return 0
+        return (self.end or time.time()) - self.start
+
+    @property
+    def command_time(self):
+        with self.lock:
+            return sum(end - start for _, _, start, end in self.commands)
+
+    def to_dict(self, origin):
+        wall = self.wall_time
+        return {'key': self.key, 'name': self.name, 'status': self.status,
+                'start': None if self.start is None else self.start - origin,
+                'wall_time': wall, 'command_time': self.command_time,
+                'commands': len(self.commands), 'bytes': self.bytes,
+                'throughput': self.bytes / wall if wall else 0,
+                'retries': self.retries, 'info': self.info}
+
+
+class Session(object):
+    """Connection which records the remote commands in the stats of a
+    process
+    """
+
+    def __init__(self, con, stats):
+        # A session read from the view of another process is measured in
+        # this one
+        self.con = con.con if isinstance(con, Session) else con
+        self.stats = stats
+
+    def exec_command(self, command, timeout=None):
+        start = time.time()
+        thread = _lane()
+
+        def done():
+            self.stats.add_command(command, thread, start, time.time())
+        return self.con.exec_command(command, timeout=timeout, done=done)
+
+    def open_sftp(self):
+        return self.con.open_sftp()
+
+    def get_transport(self):
+        return self.con.get_transport()
+
+    def close(self):
+        self.con.close()
+
+
+class Connections(object):
+    """View of the connections of a migration for a process
+    The connections read from it record their commands in the stats of the
+    process
+    """
+
+    def __init__(self, cons, stats):
+        self.cons = cons
+        self.stats = stats
+
+    def __getitem__(self, key):
+        return Session(self.cons[key], self.stats)
+
+    def __setitem__(self, key, value):
+        self.cons[key] = value
+
+    def __contains__(self, key):
+        return key in self.cons
+
+
+class Pool(object):
+    """View of a connection pool for a process"""
+
+    def __init__(self, pool, stats):
+        self.pool = pool
+        self.stats = stats
+
+    def get(self, args, direction, idx=0):
+        return Session(self.pool.get(args, direction, idx), self.stats)
+
+    @property
+    def drops(self):
+        return self.pool.drops
+
+
+class Progress(object):
+    """Logs the throughput and the time left of a transfer
+    A line is logged every PROGRESS_INTERVAL seconds at most
+    """
+
+    def __init__(self, name, total=None):
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.start = time.time()
+        self.last = self.start
+        self.lock = threading.Lock()
+
+    def update(self, amount):
+        with self.lock:
+            self.done += amount
+            now = time.time()
+            if now - self.last < PROGRESS_INTERVAL:
+                return
+            self.last = now
+            speed = self.done / (now - self.start)
+            if self.total:
+                left = max(self.total - self.done, 0)
+                eta = left / speed if speed else 0
+                lib.log.info('%s: %.1f of %.1f MB, %.1f MB/s, %ds left',
+                             self.name, self.done / 1024 / 1024,
+                             self.total / 1024 / 1024, speed / 1024 / 1024,
+                             eta)
+            else:
+                lib.log.info('%s: %.1f MB, %.1f MB/s', self.name,
+                             self.done / 1024 / 1024, speed / 1024 / 1024)
+
+
+def _label(command):
+    """Shortens a command for the trace, the passwords are removed"""
+    command = command.replace('set -o pipefail; ', '')
+    command = re.sub(r'MYSQL_PWD=\S+ ', '', command)
+    command = re.sub(r'(-u \S+ )-p\S+', r'\1-p***', command)
+    command = re.sub(r"(DB_PASSWORD', ')[^/]*", r'\1***', command)
+    return command[:80]
+
+
+def write_report(path, sites):
+    """Writes the stats of the migrations as json
+    sites is a list of (name, list of StepStats)
+    """
+    origin = min([stats.start for _, steps in sites for stats in steps
+                  if stats.start is not None] or [0])
+    data = list()
+    for name, steps in sites:
+        started = [stats for stats in steps if stats.start is not None]
+        wall = (max(stats.end or time.time() for stats in started) -
+                min(stats.start for stats in started)) if started else 0
+        data.append({'name': name, 'wall_time': wall,
+                     'bytes': sum(stats.bytes for stats in steps),
+                     'steps': [stats.to_dict(origin) for stats in steps]})
+    with open(path, 'w') as file:
+        file.write(json.dumps({'sites': data}, indent=2))
+
+
+def write_trace(path, sites):
+    """Writes the stats of the migrations in the Chrome trace event format
+    It opens in chrome://tracing and in Perfetto, every site is a process,
+    the steps and the remote commands are drawn in the thread running them
+    sites is a list of (name, list of StepStats)
+    """
+    events = list()
+    threads = dict()
+
+    def tid(pid, thread):
+        if (pid, thread) not in threads:
+            threads[(pid, thread)] = len(threads)
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                           'tid': threads[(pid, thread)],
+                           'args': {'name': thread}})
+        return threads[(pid, thread)]
+
+    for pid, (name, steps) in enumerate(sites):
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                       'args': {'name': name or 'migration'}})
+        for stats in steps:
+            if stats.start is None:
+                continue
+            events.append({
+                'name': stats.name, 'cat': 'step', 'ph': 'X', 'pid': pid,
+                'tid': tid(pid, stats.thread), 'ts': stats.start * 1e6,
+                'dur': stats.wall_time * 1e6,
+                'args': {'bytes': stats.bytes, 'retries': stats.retries,
+                         'status': stats.status}})
+            for command, thread, start, end in list(stats.commands):
+                label = _label(command)
+                events.append({
+                    'name': label.split(' ', 1)[0], 'cat': 'command',
+                    'ph': 'X', 'pid': pid, 'tid': tid(pid, thread),
+                    'ts': start * 1e6,
+                    'dur': (end - start) * 1e6,
+                    'args': {'command': label, 'step': stats.name}})
+    with open(path, 'w') as file:
+        file.write(json.dumps({'traceEvents': events,
+                               'displayTimeUnit': 'ms'}))
@@ -1,71 +1,232 @@
 import json
 import os
 import os.path
+import time
 
 import process.common
 import process.all
+import process.backup
+import process.cache
+import process.compression
+import process.database
+import process.delta
 import process.fix
+import process.multisite
+import process.plan
+import process.pool
+import process.presync
+import process.probe
+import process.replace
+import process.scan
+import process.stream
+import process.swap
+import process.verify
 import lib
+import metrics
+import scheduler
 
 
 class Migration(object):
-    """Migration class handler"""
+    """Migration class handler
+    Every migration keeps its resume state in its work directory, so
+    several migrations can run in the same process sharing the pool of
+    connections
+    """
 
-    def __init__(self, args):
+    def __init__(self, args, name='', pool=None):
         self.args = args
-        self.info = {'step': 0, 'conf': dict()}
-        self.ssh_src = None
-        self.ssh_dest = None
+        self.name = name
+        self.info = {'done': list(), 'conf': dict()}
+        self.cons = dict()
+        self.own_pool = pool is None
+        self.pool = process.pool.ConnectionPool() if pool is None else pool
+        self.duration = 0
         self.processes = list()
         if self.args.fix_destination_hostname:
             self._init_processes_fix_destination()
+        elif self.args.verify_only:
+            self._init_processes_verify()
+        elif self.args.plan:
+            self._init_processes_plan()
         else:
             self._init_processes_normal()
 
+    @property
+    def bytes(self):
+        """Bytes transferred by the processes executed"""
+        return sum(proc.stats.bytes for proc in self.processes)
+
+    @property
+    def steps(self):
+        """Measures of every process"""
+        return [proc.stats for proc in self.processes]
+
     def _init_processes_normal(self):
+        # The phases synchronize the files, the cutover only transfers the
+        # files changed since the presync. The selected sites are
+        # synchronized too, so the destination keeps the uploads of its
+        # other sites
+        delta = (self.args.delta or self.args.phase is not None or
+                 bool(self.args.site))
+        if self.args.atomic_swap and delta:
+            raise Exception('The atomic swap writes a new copy of the site, '
+                            'it does not work with --delta, --phase nor '
+                            '--site')
+        if self.args.backup_keep < 0:
+            raise Exception('The amount of backups kept can not be negative')
+        if self.args.db_chunk_size and not self.args.phase:
+            # Every range is exported in its own transaction, only the
+            # cutover makes the chunked tables consistent again
+            raise Exception('The ranges of the chunked tables are not a '
+                            'single snapshot, --db-chunk-size needs --phase')
+        if ((self.args.where or self.args.db_chunk_size or self.args.site)
+                and not process.replace.local_replace(self.args)):
+            # wp search-replace exports whole tables
+            raise Exception('The row filters, the chunks and the sites need '
+                            '--search-replace builtin and they do not work '
+                            'with --fast-copy')
         self.info['type'] = 'all'
+        # The presync backed up the destination before writing it, the
+        # cutover runs while the source does not write and only migrates
+        backup = self.args.backup_keep and self.args.phase != 'cutover'
         self.processes.append(process.common.SSHConnectSourceProcess())
         # Force to always connect to the source
         self.processes[-1].required = True
         self.processes.append(process.common.SSHConnectDestinationProcess())
         # Force to always connect to the destination
         self.processes[-1].required = True
-        self.processes.append(process.all.DestGetDBCredentialsProcess())
-        self.processes.append(process.all.DestGetSiteUrlProcess())
-        self.processes.append(process.all.SrcGetSiteUrlProcess())
-        self.processes.append(process.all.SrcGetTableListProcess())
-        self.processes.append(process.all.SrcDoDBBackupProcess())
-        self.processes.append(process.all.SrcDoTarProcess())
+        # The backup of the files only waits for the destination
+        # connection, it is made while the source works. With the atomic
+        # swap the site is renamed into the backup when it is replaced
+        if backup and not self.args.atomic_swap:
+            self.processes.append(process.backup.DestSnapshotFilesProcess())
+        if self.args.fast_copy and self.args.dest_filekey:
+            # It needs to upload only if the destination has a filekey
+            self.processes.append(process.all.SrcCopyDestinationFileKeyProcess())
+        # The credentials, the urls, the tables and their sizes are read
+        # loading wordpress once in every machine
+        self.processes.append(process.probe.ProbeSitesProcess())
+        if self.args.site:
+            self.processes.append(process.multisite.SrcSelectSitesProcess())
+        # The exclude rules and their savings are known before any file is
+        # transferred
+        self.processes.append(process.scan.SrcScanFilesProcess())
+        self.processes.append(process.compression.SrcResolveCompressionProcess(
+            self.args.compression == 'auto', self.args.fast_copy))
+        if backup:
+            self.processes.append(process.backup.DestDumpDatabaseProcess())
+        # With several database workers or chunks the dump is split in
+        # groups of tables and ranges of rows which are exported,
+        # transferred and imported on their own, and when it is streamed no
+        # dump file is staged
+        grouped = (self.args.db_workers > 1 or self.args.db_chunk_size or
+                   self.args.stream_db or self.args.phase or self.args.site)
+        if self.args.phase:
+            # The tables and ranges are checked before they are exported
+            self.processes.append(
+                process.presync.SrcChecksumDatabaseProcess())
+        if not grouped:
+            self.processes.append(process.all.SrcDoDBBackupProcess())
+        # The files are staged as tar files unless they are streamed or
+        # synchronized
+        staged = not (self.args.stream or delta)
+        # With a cache the tar file is built here from the cached files and
+        # the files which were not cached
+        cached = staged and self.args.cache_dir and not self.args.fast_copy
+        if staged and not cached:
+            self.processes.append(process.all.SrcDoTarProcess())
+        if delta or cached:
+            self.processes.append(process.delta.SrcBuildManifestProcess())
         if self.args.fast_copy:
-            if self.args.dest_filekey:
-                # It needs to upload only if the destination has a filekey
-                self.processes.append(process.all.SrcCopyDestinationFileKeyProcess())
-            self.processes.append(process.all.SrcDownloadDBBackupProcess())
-            self.processes.append(process.all.SrcDownloadTarProcess())
+            if not grouped:
+                self.processes.append(process.all.SrcDownloadDBBackupProcess())
+            if staged:
+                self.processes.append(process.all.SrcDownloadTarProcess())
         else:
             # If the user selected fast copy, the tool won't need to upload
             # anything, because the backup is transferred directly from source
             # to destination
-            self.processes.append(process.all.SrcDownloadDBBackupProcess())
-            self.processes.append(process.all.SrcDownloadTarProcess())
-            self.processes.append(process.all.DestUploadDatabaseDumpProcess())
-            self.processes.append(process.all.DestUploadTarProcess())
-        self.processes.append(process.all.DestCreateDBBackupProcess())
-        self.processes.append(process.all.DestCreateWPBackupProcess())
-        self.processes.append(process.all.DestErasePreviousWordpressProcess())
-        self.processes.append(process.all.DestDecompressWordpressProcess())
+            if not grouped:
+                self.processes.append(process.all.SrcDownloadDBBackupProcess())
+            if cached:
+                self.processes.append(process.cache.SrcDownloadCachedTarProcess())
+            elif staged:
+                self.processes.append(process.all.SrcDownloadTarProcess())
+            if not grouped and process.replace.local_replace(self.args):
+                # The source only exports the database, the urls are
+                # replaced here before the dump is uploaded
+                self.processes.append(process.replace.LocalReplaceDumpProcess())
+            if not grouped:
+                self.processes.append(process.all.DestUploadDatabaseDumpProcess())
+            if staged:
+                self.processes.append(process.all.DestUploadTarProcess())
+        # It does not need the destination files, so it runs while they are
+        # being transferred
+        if self.args.stream_db:
+            self.processes.append(process.database.DestStreamDatabaseProcess())
+        elif grouped:
+            self.processes.append(process.database.DestParallelDatabaseProcess())
+        if delta:
+            # Only the changed files are transferred and only the removed
+            # files are erased
+            self.processes.append(process.delta.DestBuildManifestProcess())
+            self.processes.append(process.delta.DestSyncDeltaProcess())
+        else:
+            self.processes.append(process.all.DestErasePreviousWordpressProcess())
+            if self.args.stream:
+                # The files go from the source tar straight into the
+                # destination tar, so nothing is staged in any machine
+                self.processes.append(process.stream.DestStreamWordpressProcess())
+            else:
+                self.processes.append(process.all.DestDecompressWordpressProcess())
         self.processes.append(process.common.DestReplaceConfProcess())
-        self.processes.append(process.all.DestImportDBDumpProcess())
-        if self.args.no_posts:
-            self.processes.append(process.all.DestTruncatePostsProcess())
+        if not grouped:
+            self.processes.append(process.all.DestImportDBDumpProcess())
+        if self.args.atomic_swap:
+            # The site is served from its previous files and tables until
+            # this moment
+            self.processes.append(process.swap.DestSwapProcess())
+        if self.args.verify:
+            self.processes.append(process.verify.VerifySitesProcess())
+
+    def _init_processes_verify(self):
+        self.info['type'] = 'verify'
+        self.processes.append(process.common.SSHConnectSourceProcess())
+        self.processes[-1].required = True
+        self.processes.append(process.common.SSHConnectDestinationProcess())
+        self.processes[-1].required = True
+        # The files and the tables left out by the arguments are left out
+        # of the comparison too
+        self.processes.append(process.probe.ProbeSitesProcess())
+        if self.args.site:
+            self.processes.append(process.multisite.SrcSelectSitesProcess())
+        self.processes.append(process.scan.SrcScanFilesProcess())
+        self.processes.append(process.verify.VerifySitesProcess())
+
+    def _init_processes_plan(self):
+        # The steps of the migration with the same arguments are estimated,
+        # none of them is run
+        self._init_processes_normal()
+        steps = self.processes
+        self.processes = list()
+        self.info['type'] = 'plan'
+        self.processes.append(process.common.SSHConnectSourceProcess())
+        self.processes[-1].required = True
+        self.processes.append(process.common.SSHConnectDestinationProcess())
+        self.processes[-1].required = True
+        self.processes.append(process.probe.ProbeSitesProcess())
+        if self.args.site:
+            self.processes.append(process.multisite.SrcSelectSitesProcess())
+        self.processes.append(process.scan.SrcScanFilesProcess())
+        self.processes.append(process.compression.SrcResolveCompressionProcess(
+            self.args.compression == 'auto', self.args.fast_copy))
+        self.processes.append(process.plan.PlanMigrationProcess(steps))
 
     def _init_processes_fix_destination(self):
         if self.args.current_site is None or self.args.current_site == '':
-            lib.log.error('Missing current site')
-            exit(-1)
+            raise Exception('Missing current site')
         if self.args.new_site is None or self.args.new_site == '':
-            lib.log.error('Missing new site')
-            exit(-1)
+            raise Exception('Missing new site')
         self.info['conf']['wp-config'] = \
             {'DOMAIN_CURRENT_SITE': self.args.new_site,
              'SRC_DOMAIN_CURRENT_SITE': self.args.current_site}
@@ -78,43 +239,66 @@ class Migration(object):
         self.processes.append(process.common.DestReplaceConfProcess())
 
     def execute(self):
-        """Will loop over the list of processes to execute each of them"""
+        """Runs the processes, the ones which do not depend on each other
+        are executed concurrently
+        Returns True when the migration is complete
+        """
+        start = time.time()
+        os.makedirs(self.args.work_dir, exist_ok=True)
+        # The plan keeps the resume state of the migration it estimates
+        info_file = process.common.local_path(
+            self.args, '.plan.json' if self.info['type'] == 'plan'
+            else '.info.json')
         tmp_info = None
-        if not self.args.no_cache and os.path.exists('.info.json'):
-            with open('.info.json') as file:
+        if not self.args.no_cache and os.path.exists(info_file):
+            with open(info_file) as file:
                 lib.log.debug('Loading json file')
                 tmp_info = json.loads(file.read())
 
-        if tmp_info and ((self.args.fix_destination_hostname and
-             tmp_info['type'] == 'fix') or
-            (not self.args.fix_destination_hostname and
-             tmp_info['type'] == 'all')):
-            self.info = tmp_info
+        if tmp_info and tmp_info['type'] == self.info['type']:
+            if 'step' in tmp_info:
+                # Resume state written before the steps were tracked by
+                # name, its steps and its configuration are not the ones of
+                # the current steps
+                lib.log.warning('The resume state in %s was written by an '
+                                'older version, the migration starts over',
+                                info_file)
+            else:
+                self.info = tmp_info
+        if self.info['type'] == 'all' and self.args.backup_keep:
+            # A resumed migration keeps writing the backup it started
+            self.info['conf'].setdefault('backup', process.backup.stamp())
 
-        tmp = [item for item in self.processes[:self.info['step']]
-               if item.required]
-        omit_count = len(tmp)
-        tmp.extend(self.processes[self.info['step']:])
-        self.info['process_list'] = {idx:str(item) for idx, item in enumerate(self.processes)}
-        index = 0
-        for proc in tmp:
-            try:
-                proc.init()
-                lib.log.info('Starts "%s"', proc.name)
-                proc.execute(self.args, self.info['conf'])
-                lib.log.info('Done "%s"', proc.name)
-                # It does not add another step when doing a required step
-                # from the second run
-                if index >= omit_count:
-                    self.info['step'] += 1
-                index += 1
-                with open('.info.json', 'w') as file:
-                    file.write(json.dumps(self.info, indent=2, sort_keys=True))
-                lib.log.debug(self.info)
-            except Exception as exc:
-                lib.log.error(exc)
-                break
-        else:
-            os.remove('.info.json')
+        self.info['process_list'] = [item.key for item in self.processes]
+        for proc in self.processes:
+            proc.init()
+            proc.stats = metrics.StepStats(proc.key, proc.name)
+            # The commands run through these views are measured in the
+            # stats of the process
+            proc.cons = metrics.Connections(self.cons, proc.stats)
+            proc.pool = metrics.Pool(self.pool, proc.stats)
+
+        def save():
+            with open(info_file, 'w') as file:
+                file.write(json.dumps(self.info, indent=2, sort_keys=True))
+            lib.log.debug(self.info)
+
+        sched = scheduler.Scheduler(self.processes, self.info['done'],
+                                    self.args.jobs, self.name,
+                                    self.args.retries)
+        try:
+            success = sched.run(self.args, self.info['conf'], save)
+        finally:
+            if self.own_pool:
+                self.pool.close()
+            self.duration = time.time() - start
+            if self.args.report:
+                metrics.write_report(self.args.report,
+                                     [(self.name, self.steps)])
+            if self.args.trace:
+                metrics.write_trace(self.args.trace,
+                                    [(self.name, self.steps)])
+        if success:
+            os.remove(info_file)
             lib.log.info('Migration complete')
-        process.common.AbstractProcess.close_connections()
+        return success
@@ -0,0 +1,90 @@
+import asyncio
+
+import lib
+
+READ_SIZE = 256 * 1024
+
+
+class _Command(object):
+    """Remote command whose output is read by the event loop
+    paramiko signals the data of a channel through the pipe of its fileno,
+    so the loop waits for many commands without a thread for each one
+    """
+
+    def __init__(self, channel, output):
+        self.channel = channel
+        self.output = output
+        self.stdout = list()
+        self.stderr = list()
+        self.loop = asyncio.get_running_loop()
+        self.eof = self.loop.create_future()
+
+    def _read(self):
+        try:
+            while self.channel.recv_ready():
+                data = self.channel.recv(READ_SIZE)
+                if self.output is None:
+                    self.stdout.append(data)
+                else:
+                    self.output(data)
+            while self.channel.recv_stderr_ready():
+                self.stderr.append(self.channel.recv_stderr(READ_SIZE))
+            # A dropped connection closes the channel without an end
+            if (self.channel.eof_received or self.channel.closed) and not (
+                    self.channel.recv_ready() or
+                    self.channel.recv_stderr_ready()):
+                self._stop()
+                self.eof.set_result(None)
+        except Exception as exc:
+            self._stop()
+            self.eof.set_exception(exc)
+
+    def _stop(self):
+        self.loop.remove_reader(self.channel.fileno())
+
+    async def wait(self, chunks):
+        self.loop.add_reader(self.channel.fileno(), self._read)
+        try:
+            try:
+                for chunk in chunks:
+                    await asyncio.to_thread(self.channel.sendall, chunk)
+                self.channel.shutdown_write()
+            except OSError:
+                # The command ended without reading all its input, its
+                # status tells if it failed
+                pass
+            await self.eof
+            # The exit status may come after the end of the output
+            return await asyncio.to_thread(self.channel.recv_exit_status)
+        finally:
+            if not self.eof.done():
+                self._stop()
+                self.eof.cancel()
+
+
+async def command(ssh, cmd, stdin=None, output=None, timeout=None):
+    """Runs a command in a remote machine without blocking the event loop
+    stdin is an optional iterable of bytes for the command input and
+    output(data) optionally receives its output as it arrives. When the
+    command does not finish in timeout seconds, or the task running it is
+    cancelled, its channel is closed
+    Returns the output when output is not given
+    """
+    lib.log.debug(cmd)
+    # Opening the channel waits for a free slot of the connection. The
+    # files are kept, the input of the channel is closed with its file
+    files = await asyncio.to_thread(ssh.exec_command, cmd)
+    channel = files[1].channel
+    remote = _Command(channel, output)
+    try:
+        status = await asyncio.wait_for(remote.wait(stdin or list()),
+                                        timeout or None)
+    except asyncio.TimeoutError:
+        raise Exception('The command did not finish in {} seconds: {}'
+                        .format(timeout, cmd))
+    finally:
+        # It stops the remote command when it did not finish
+        channel.close()
+    if status != 0:
+        raise Exception(b''.join(remote.stderr).decode('utf-8'))
+    return b''.join(remote.stdout)
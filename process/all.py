@@ -1,60 +1,33 @@
-
 import os.path
-import re
 
 from scp import SCPClient
 
 import lib
-from process.common import AbstractProcess
-
-class DestCreateDBBackupProcess(AbstractProcess):
-    """Creates wp database dump"""
-
-    def init(self):
-        self.target = AbstractProcess.DEST
-        self.name = 'Creating wordpress tar file from destination'
-
-    def execute(self, args, conf):
-        ssh = AbstractProcess.CONS[self.target]
-        cmd = 'tar -cf /tmp/wp.tar.gz {}'.format(args.dest_wpath)
-        lib.log.debug(cmd)
-        _, stdout, stderr = ssh.exec_command(cmd)
-        status = stdout.channel.recv_exit_status()
-        if status != 0:
-            raise Exception(stderr.read().decode('utf-8'))
-
+import metrics
+from process.common import (AbstractProcess, AsyncProcess, fast_copy_file,
+                            files_path, local_path, stream_connections,
+                            tmp_path)
+from process.compression import compress, decompress
+from process.database import export_command, import_command
+from process.replace import local_replace
+from process.scan import archive_command, exclude_input
+from process.transfer import download, upload
 
 class DestCopyWPBackupProcess(AbstractProcess):
     """Copies the extracted files into the destination folder"""
+    inputs = ('dest:wpath',)
+    outputs = ('dest:wpath',)
 
     def init(self):
         self.target = AbstractProcess.DEST
         self.name = 'Copying source backup into destination folder'
 
     def execute(self, args, conf):
-        ssh = AbstractProcess.CONS[self.target]
+        ssh = self.cons[self.target]
         sudo = 'sudo ' if args.dest_sudo else ''
-        cmd = '{}cp -r /tmp/{}/. {}/'.format(sudo,
-                                             args.src_wpath,
-                                             args.dest_wpath)
-        lib.log.debug(cmd)
-        _, stdout, stderr = ssh.exec_command(cmd)
-        status = stdout.channel.recv_exit_status()
-        if status != 0:
-            raise Exception(stderr.read().decode('utf-8'))
-
-
-class DestCreateWPBackupProcess(AbstractProcess):
-    """Creates wp database dump"""
-
-    def init(self):
-        self.target = AbstractProcess.DEST
-        self.name = 'Creating database dump from destination'
-
-    def execute(self, args, conf):
-        ssh = AbstractProcess.CONS[self.target]
-        cmd = ('wp --allow-root --path={} db export --add-drop-table '
-               '/tmp/mysql.dump'.format(args.dest_wpath))
+        cmd = '{}cp -r {}/{}/. {}/'.format(sudo, args.tmp_dir,
+                                           args.src_wpath,
+                                           args.dest_wpath)
         lib.log.debug(cmd)
         _, stdout, stderr = ssh.exec_command(cmd)
         status = stdout.channel.recv_exit_status()
@@ -62,180 +35,122 @@ class DestCreateWPBackupProcess(AbstractProcess):
             raise Exception(stderr.read().decode('utf-8'))
 
 
-class DestGetDBCredentialsProcess(AbstractProcess):
-    """Saves the dest wp-config.php configuration"""
-
-    def init(self):
-        self.target = AbstractProcess.DEST
-        self.name = 'Reading wp-config.php from destination'
-
-    def execute(self, args, conf):
-        ssh = AbstractProcess.CONS[self.target]
-        cmd = 'cat {}/wp-config.php'.format(args.dest_wpath)
-        lib.log.debug(cmd)
-        _, stdout, stderr = ssh.exec_command(cmd)
-        status = stdout.channel.recv_exit_status()
-        if status != 0:
-            raise Exception(stderr.read().decode('utf-8'))
-        content = stdout.read().decode('utf-8').replace('\n', ' ')
-        conf['wp-config'] = {'DB_NAME': None, 'DB_USER': None,
-                             'DB_PASSWORD': None}
-        simple = (".*({0})'[^']*'([^']+)"
-                  .format('|'.join([key for key in conf['wp-config']])))
-        match = re.match(''.join(simple for key in conf['wp-config']),
-                         content)
-        if match:
-            items = match.groups()
-            for idx in range(0, len(items), 2):
-                conf['wp-config'][items[idx]] = items[idx + 1]
-        for key in conf['wp-config']:
-            if conf['wp-config'][key] is None:
-                raise Exception('Missing field "{}" in wp-config.php in '
-                                'source machine'.format(key))
-
-
-class DestDecompressWordpressProcess(AbstractProcess):
+class DestDecompressWordpressProcess(AsyncProcess):
     """Decompresses wordpress tar file in destination"""
+    inputs = ('conf:compression', 'dest:/tmp/wp.src.tar.gz')
+    outputs = ('dest:wpath',)
 
     def init(self):
         self.target = AbstractProcess.DEST
         self.name = 'Decompressing wordpress source in destination'
 
-    def execute(self, args, conf):
-        ssh = AbstractProcess.CONS[self.target]
+    async def run(self, args, conf):
         sudo = 'sudo ' if args.dest_sudo else ''
-        cmd = '{0}mkdir -p {1}; {0}tar -xf /tmp/wp.src.tar.gz -C {1}'.format(sudo, args.dest_wpath)
-        lib.log.debug(cmd)
-        _, stdout, stderr = ssh.exec_command(cmd, timeout=200)
-        status = stdout.channel.recv_exit_status()
-        if status != 0:
-            raise Exception(stderr.read().decode('utf-8'))
+        cmd = 'set -o pipefail; {0}mkdir -p {1}; {2}'.format(
+            sudo, files_path(args),
+            decompress(conf, '{}tar -xf - -C {}'.format(sudo, files_path(args)),
+                       tmp_path(args, 'wp.src.tar.gz')))
+        await self.command(args, cmd)
 
 
-class DestErasePreviousWordpressProcess(AbstractProcess):
-    """Erases wordpress folder from detsination before replacing it"""
+class DestErasePreviousWordpressProcess(AsyncProcess):
+    """Erases wordpress folder from detsination before replacing it
+    With the atomic swap it erases what is left of a previous attempt in
+    the directory the files are written to, the site is kept
+    """
+    outputs = ('dest:wpath',)
 
     def init(self):
         self.target = AbstractProcess.DEST
         self.name = 'Erasing previous wordpress contents from destination'
 
-    def execute(self, args, conf):
-        ssh = AbstractProcess.CONS[self.target]
+    async def run(self, args, conf):
         sudo = 'sudo ' if args.dest_sudo else ''
-        cmd = '{}rm -rf {}'.format(sudo, args.dest_wpath)
-        lib.log.debug(cmd)
-        _, stdout, stderr = ssh.exec_command(cmd)
-        status = stdout.channel.recv_exit_status()
-        if status != 0:
-            raise Exception(stderr.read().decode('utf-8'))
-
-
-class DestGetSiteUrlProcess(AbstractProcess):
-    """Gets the site url using wp binary"""
-
-    def init(self):
-        self.target = AbstractProcess.DEST
-        self.name = 'Get site url from destination'
-
-    def execute(self, args, conf):
-        ssh = AbstractProcess.CONS[self.target]
-        cmd = ('wp --allow-root --path={} option get siteurl'
-               .format(args.dest_wpath))
-        lib.log.debug(cmd)
-        _, stdout, stderr = ssh.exec_command(cmd)
-        status = stdout.channel.recv_exit_status()
-        if status != 0:
-            raise Exception(stderr.read().decode('utf-8'))
-        content = stdout.read().decode('utf-8').replace('\n', '')
-        conf['wp-config']['DOMAIN_CURRENT_SITE'] = \
-            re.sub('http(s)?://', '', content)
+        cmd = '{}rm -rf {}'.format(sudo, files_path(args))
+        await self.command(args, cmd)
 
 
-class DestImportDBDumpProcess(AbstractProcess):
+class DestImportDBDumpProcess(AsyncProcess):
     """Imports the dump into destination"""
+    inputs = ('conf:compression', 'conf:wp-config', 'conf:db_host',
+              'dest:/tmp/mysql.src.dump', 'dest:wpath')
+    outputs = ('dest:db',)
 
     def init(self):
         self.target = AbstractProcess.DEST
         self.name = 'Importing DB dump in destination'
 
-    def execute(self, args, conf):
-        ssh = AbstractProcess.CONS[self.target]
-        cmd = ('wp --allow-root --path={} db import /tmp/mysql.src.dump'
-               .format(args.dest_wpath))
-        lib.log.debug(cmd)
-        _, stdout, stderr = ssh.exec_command(cmd)
-        status = stdout.channel.recv_exit_status()
-        if status != 0:
-            raise Exception(stderr.read().decode('utf-8'))
-
-
-class DestTruncatePostsProcess(AbstractProcess):
-    """Imports the dump into destination"""
-
-    def init(self):
-        self.target = AbstractProcess.DEST
-        self.name = 'Importing DB dump in destination'
-
-    def execute(self, args, conf):
-        ssh = AbstractProcess.CONS[self.target]
-        tmp = conf['wp-config']
-        cmd = ('tmp=($(mysql -u {0} -p{1} {2} -sNe \'show tables\' '
-               '| grep post)); for table in ${{tmp[@]}}; '
-               'do mysql -u {0} -p{1} {2} -e "truncate table $table"; done')
-        lib.log.debug(cmd)
-        cmd = (cmd.format(tmp['DB_USER'], tmp['DB_PASSWORD'], tmp['DB_NAME']))
-        lib.log.debug(cmd)
-        _, stdout, stderr = ssh.exec_command(cmd)
-        status = stdout.channel.recv_exit_status()
-        content = stderr.read().decode('utf-8').replace('\n', '')
-        if status != 0 or 'ERROR' in content:
-            raise Exception(content)
+    async def run(self, args, conf):
+        if args.atomic_swap:
+            # The site keeps its tables until the swap
+            cmd = import_command(args, conf)
+        else:
+            cmd = ('wp --allow-root --path={} db import -'
+                   .format(args.dest_wpath))
+        cmd = 'set -o pipefail; ' + decompress(
+            conf, cmd, tmp_path(args, 'mysql.src.dump'))
+        await self.command(args, cmd)
 
 
 class DestUploadDatabaseDumpProcess(AbstractProcess):
     """Uploads wp database dump"""
+    inputs = ('local:mysql.dump', 'local:mysql.replaced.dump')
+    outputs = ('dest:/tmp/mysql.src.dump',)
 
     def init(self):
         self.target = AbstractProcess.DEST
         self.name = 'Uploading database dump to destination'
 
     def execute(self, args, conf):
-        ssh = AbstractProcess.CONS[self.target]
-        scp = SCPClient(ssh.get_transport(), socket_timeout=300.0)
-        scp.put('mysql.dump', '/tmp/mysql.src.dump')
+        state = conf.setdefault('transfer:mysql.src.dump', dict())
+        name = 'mysql.replaced.dump' if local_replace(args) else 'mysql.dump'
+        self.add_bytes(upload(
+            stream_connections(self.pool, args, self.target, args.streams),
+            local_path(args, name), tmp_path(args, 'mysql.src.dump'),
+            state, self.checkpoint, args.chunk_size * 1024 * 1024,
+            metrics.Progress(self.name)))
+        del conf['transfer:mysql.src.dump']
 
 
 class DestUploadTarProcess(AbstractProcess):
     """Uploads wordpress tar file"""
+    inputs = ('local:wp.tar.gz',)
+    outputs = ('dest:/tmp/wp.src.tar.gz',)
 
     def init(self):
         self.target = AbstractProcess.DEST
         self.name = 'Uploading wordpress tar file dump to destination'
 
     def execute(self, args, conf):
-        ssh = AbstractProcess.CONS[self.target]
-        scp = SCPClient(ssh.get_transport(), socket_timeout=300.0)
-        scp.put('wp.tar.gz', '/tmp/wp.src.tar.gz')
+        state = conf.setdefault('transfer:wp.src.tar.gz', dict())
+        self.add_bytes(upload(
+            stream_connections(self.pool, args, self.target, args.streams),
+            local_path(args, 'wp.tar.gz'), tmp_path(args, 'wp.src.tar.gz'),
+            state, self.checkpoint, args.chunk_size * 1024 * 1024,
+            metrics.Progress(self.name)))
+        del conf['transfer:wp.src.tar.gz']
 
 
 class SrcCopyDestinationFileKeyProcess(AbstractProcess):
     """Upload the destination file key to the source"""
+    inputs = ('ssh:dest',)
+    outputs = ('src:/tmp/tmp_key.pem', 'dest:authorized_keys')
 
     def init(self):
         self.target = AbstractProcess.SRC
         self.name = 'Uploading destination file key to source'
 
     def execute(self, args, conf):
-        ssh = AbstractProcess.CONS[self.target]
-        dest_filekey = '/tmp/tmp_key.pem'
+        ssh = self.cons[self.target]
+        dest_filekey = tmp_path(args, 'tmp_key.pem')
         _, stdout, stderr = ssh.exec_command('rm -f {}'.format(dest_filekey))
         scp = SCPClient(ssh.get_transport(), socket_timeout=300.0)
         scp.put(args.dest_filekey, dest_filekey)
         if os.system('ssh-keygen -y -f {0} > {0}.pub'.format(args.dest_filekey)) != 0:
             raise Exception('Unable to create the key')
-        ssh_dest = AbstractProcess.CONS[AbstractProcess.DEST]
+        ssh_dest = self.cons[AbstractProcess.DEST]
         scp = SCPClient(ssh_dest.get_transport(), socket_timeout=300.0)
-        pub_key = '/tmp/tmp_key.pub'
+        pub_key = tmp_path(args, 'tmp_key.pub')
         scp.put('{}.pub'.format(args.dest_filekey), pub_key)
         key_path = '/{}/.ssh/authorized_keys' if args.dest_user == 'root' else '/home/{}/.ssh/authorized_keys'
         key_path = key_path.format(args.dest_user)
@@ -245,152 +160,89 @@ class SrcCopyDestinationFileKeyProcess(AbstractProcess):
             if stdout.channel.recv_exit_status() != 0:
                 raise Exception(stderr.read())
 
-class SrcDoDBBackupProcess(AbstractProcess):
+class SrcDoDBBackupProcess(AsyncProcess):
     """Creates the wp backup for the database"""
+    inputs = ('conf:compression', 'conf:wp-config', 'conf:tables')
+    outputs = ('src:/tmp/mysql.dump',)
 
     def init(self):
         self.target = AbstractProcess.SRC
         self.name = 'Creating wordpress database dump from source'
 
-    def execute(self, args, conf):
-        ssh = AbstractProcess.CONS[self.target]
-        cmd = ('wp --allow-root --path={} search-replace --network --precise '
-               '{} {} {} --export=/tmp/mysql.dump'
-               .format(args.src_wpath,
-                       conf['wp-config']['SRC_DOMAIN_CURRENT_SITE'],
-                       conf['wp-config']['DOMAIN_CURRENT_SITE'],
-                       ' '.join(conf['tables'])))
-        lib.log.debug(cmd)
-        _, stdout, stderr = ssh.exec_command(cmd)
-        status = stdout.channel.recv_exit_status()
-        if status != 0:
-            raise Exception(stderr.read().decode('utf-8'))
+    async def run(self, args, conf):
+        cmd = 'set -o pipefail; ' + compress(
+            conf, export_command(args, conf, conf['tables']),
+            tmp_path(args, 'mysql.dump'))
+        await self.command(args, cmd)
 
 
-class SrcDoTarProcess(AbstractProcess):
+class SrcDoTarProcess(AsyncProcess):
     """Creates a tar file of the wordpress path from the source"""
+    inputs = ('conf:compression', 'conf:excludes')
+    outputs = ('src:/tmp/wp.tar.gz',)
 
     def init(self):
         self.target = AbstractProcess.SRC
         self.name = 'Creating tar file'
 
-    def execute(self, args, conf):
-        ssh = AbstractProcess.CONS[self.target]
-        cmd = 'cd {}; tar -cf /tmp/wp.tar.gz .'.format(args.src_wpath)
-        lib.log.debug(cmd)
-        _, stdout, stderr = ssh.exec_command(cmd)
-        status = stdout.channel.recv_exit_status()
-        if status != 0:
-            raise Exception(stderr.read().decode('utf-8'))
+    async def run(self, args, conf):
+        # tar changes the directory itself, so a relative --tmp-dir is
+        # still relative to the home directory
+        cmd = 'set -o pipefail; ' + compress(
+            conf, archive_command(args), tmp_path(args, 'wp.tar.gz'))
+        await self.command(args, cmd, exclude_input(conf))
 
 
 class SrcDownloadDBBackupProcess(AbstractProcess):
     """Downloads the wp backup for the database"""
+    inputs = ('src:/tmp/mysql.dump', 'src:/tmp/tmp_key.pem',
+              'dest:authorized_keys')
+    outputs = ('local:mysql.dump', 'dest:/tmp/mysql.src.dump')
 
     def init(self):
         self.target = AbstractProcess.SRC
         self.name = 'Downloading wordpress database dump from source'
 
     def execute(self, args, conf):
-        ssh = AbstractProcess.CONS[self.target]
         if args.fast_copy:
-            cmd = 'scp -oStrictHostKeyChecking=no -P {} '.format(args.dest_port)
-            dest_filekey = '/tmp/tmp_key.pem'
-            if args.dest_filekey:
-                cmd += '-i {} '.format(dest_filekey)
-
-            cmd += '/tmp/mysql.dump '
-            if args.dest_user:
-                cmd += '{}@'.format(args.dest_user)
-            cmd += '{}:/tmp/mysql.src.dump'.format(args.dest_address)
-            lib.log.debug(cmd)
-            _, stdout, stderr = ssh.exec_command(cmd)
-            status = stdout.channel.recv_exit_status()
-            if status != 0:
-                raise Exception(stderr.read().decode('utf-8'))
+            self.add_bytes(fast_copy_file(
+                self.cons, args, tmp_path(args, 'mysql.dump'),
+                tmp_path(args, 'mysql.src.dump')))
         else:
-            scp = SCPClient(ssh.get_transport(), socket_timeout=300.0)
-            scp.get('/tmp/mysql.dump')
+            state = conf.setdefault('transfer:mysql.dump', dict())
+            self.add_bytes(download(
+                stream_connections(self.pool, args, self.target,
+                                   args.streams),
+                tmp_path(args, 'mysql.dump'), local_path(args, 'mysql.dump'),
+                state, self.checkpoint, args.chunk_size * 1024 * 1024,
+                metrics.Progress(self.name)))
+            del conf['transfer:mysql.dump']
 
 
 class SrcDownloadTarProcess(AbstractProcess):
     """Downloads all the backup files from the server"""
+    inputs = ('src:/tmp/wp.tar.gz', 'src:/tmp/tmp_key.pem',
+              'dest:authorized_keys')
+    outputs = ('local:wp.tar.gz', 'dest:/tmp/wp.src.tar.gz')
 
     def init(self):
         self.target = AbstractProcess.SRC
         self.name = 'Downloading tar file from source'
 
     def execute(self, args, conf):
-        ssh = AbstractProcess.CONS[self.target]
         if args.fast_copy:
-            cmd = 'scp -oStrictHostKeyChecking=no -P {} '.format(args.dest_port)
-            dest_filekey = '/tmp/tmp_key.pem'
-            if args.dest_filekey:
-                cmd += '-i {} '.format(dest_filekey)
-
-            cmd += '/tmp/wp.tar.gz '
-            if args.dest_user:
-                cmd += '{}@'.format(args.dest_user)
-            cmd += '{}:/tmp/wp.src.tar.gz'.format(args.dest_address)
-            lib.log.debug(cmd)
-            _, stdout, stderr = ssh.exec_command(cmd)
-            status = stdout.channel.recv_exit_status()
-            if status != 0:
-                raise Exception(stderr.read().decode('utf-8'))
+            self.add_bytes(fast_copy_file(
+                self.cons, args, tmp_path(args, 'wp.tar.gz'),
+                tmp_path(args, 'wp.src.tar.gz')))
         else:
-            scp = SCPClient(ssh.get_transport(), socket_timeout=300.0)
-            scp.get('/tmp/wp.tar.gz')
+            state = conf.setdefault('transfer:wp.tar.gz', dict())
+            self.add_bytes(download(
+                stream_connections(self.pool, args, self.target,
+                                   args.streams),
+                tmp_path(args, 'wp.tar.gz'), local_path(args, 'wp.tar.gz'),
+                state, self.checkpoint, args.chunk_size * 1024 * 1024,
+                metrics.Progress(self.name)))
+            del conf['transfer:wp.tar.gz']
             # It checks if the file exists
-            if not os.path.exists('wp.tar.gz'):
+            if not os.path.exists(local_path(args, 'wp.tar.gz')):
                 raise Exception('Tar file does not exist')
-
-
-class SrcGetTableListProcess(AbstractProcess):
-    """Gathers the list of tables
-    """
-
-    def init(self):
-        self.target = AbstractProcess.SRC
-        self.name = 'Get list of tables'
-
-    def execute(self, args, conf):
-        ssh = AbstractProcess.CONS[self.target]
-        cmd = ('wp --allow-root --path={} db tables \'wp_*\' --format=csv'
-               .format(args.src_wpath))
-        lib.log.debug(cmd)
-        _, stdout, stderr = ssh.exec_command(cmd)
-        content = stdout.read().decode('utf-8').replace('\n', '')
-        status = stdout.channel.recv_exit_status()
-        if status != 0:
-            raise Exception(stderr.read().decode('utf-8'))
-        conf['tables'] = content.split(',')
-        tmp = list()
-        if args.no_users:
-            for item in conf['tables']:
-                if 'user' in item:
-                    continue
-                tmp.append(item)
-            conf['tables'] = tmp
-
-
-class SrcGetSiteUrlProcess(AbstractProcess):
-    """Gathers the siteurl for the source machine
-    The siteurl helps when it executes the search and replace in the database
-    """
-
-    def init(self):
-        self.target = AbstractProcess.SRC
-        self.name = 'Get site url from source'
-
-    def execute(self, args, conf):
-        ssh = AbstractProcess.CONS[self.target]
-        cmd = ('wp --allow-root --path={} option get siteurl'
-               .format(args.src_wpath))
-        lib.log.debug(cmd)
-        _, stdout, stderr = ssh.exec_command(cmd)
-        content = stdout.read().decode('utf-8').replace('\n', '')
-        status = stdout.channel.recv_exit_status()
-        if status != 0:
-            raise Exception(stderr.read().decode('utf-8'))
-        conf['wp-config']['SRC_DOMAIN_CURRENT_SITE'] = \
-            re.sub('http(s)?://', '', content)
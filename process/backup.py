@@ -0,0 +1,102 @@
+import posixpath
+import time
+
+from process.common import AbstractProcess, AsyncProcess
+from process.compression import CODECS, compress
+
+# Name of the backup of every migration, sorting the names sorts them by age
+STAMP_FORMAT = '%Y%m%d-%H%M%S'
+STAMP_PATTERN = '^[0-9]{8}-[0-9]{6}$'
+
+
+def stamp():
+    """Returns the name of the backup of a migration starting now"""
+    return time.strftime(STAMP_FORMAT)
+
+
+def backup_dir(args):
+    """Returns the directory of the destination with the backups
+    By default it is a sibling of the wordpress path, so the files are in
+    the same file system and they can be hardlinked
+    """
+    if args.backup_dir:
+        return args.backup_dir.rstrip('/')
+    return args.dest_wpath.rstrip('/') + '.backups'
+
+
+def backup_path(args, conf):
+    """Returns the directory of the backup of the migration"""
+    return posixpath.join(backup_dir(args), conf['backup'])
+
+
+def make_backup_command(args, conf):
+    """Returns the command which creates the directory of the backup
+    It belongs to the ssh user, so the dumps are written without sudo
+    """
+    sudo = 'sudo ' if args.dest_sudo else ''
+    return '{0}mkdir -p {1} && {0}chown "$(id -un)" {1}'.format(
+        sudo, backup_path(args, conf))
+
+
+def prune_command(args):
+    """Returns the command which removes the oldest backups, the last ones
+    up to the limit of the arguments are kept
+    """
+    sudo = 'sudo ' if args.dest_sudo else ''
+    return ("ls -1 {0} | grep -E '{1}' | sort | head -n -{2} | "
+            "xargs -r -I {{}} {3}rm -rf {0}/{{}}"
+            .format(backup_dir(args), STAMP_PATTERN, args.backup_keep, sudo))
+
+
+class DestSnapshotFilesProcess(AsyncProcess):
+    """Keeps the destination files in the backup of the migration
+    The files are hardlinked instead of copied, so the snapshot takes
+    neither time nor space. The migration never writes into them: the site
+    is erased before the new files are extracted, tar replaces the files it
+    extracts and sed -i writes a new wp-config.php. When the backups are in
+    another file system the files are copied, with reflinks where the file
+    system supports them
+    """
+    inputs = ('dest:wpath',)
+    outputs = ('dest:backup:files',)
+
+    def init(self):
+        self.target = AbstractProcess.DEST
+        self.name = 'Snapshotting destination files'
+
+    async def run(self, args, conf):
+        sudo = 'sudo ' if args.dest_sudo else ''
+        files = posixpath.join(backup_path(args, conf), 'files')
+        # A snapshot left by a failed attempt is made again
+        cmd = ('[ ! -e {1} ] || {{ {2} && {0}rm -rf {3} && '
+               '{{ {0}cp -al {1} {3} 2>/dev/null || {{ {0}rm -rf {3} && '
+               '{0}cp -a --reflink=auto {1} {3}; }}; }}; }}'
+               .format(sudo, args.dest_wpath.rstrip('/'),
+                       make_backup_command(args, conf), files))
+        await self.command(args, cmd)
+
+
+class DestDumpDatabaseProcess(AsyncProcess):
+    """Dumps the destination database in the backup of the migration and
+    removes the oldest backups
+    The dump is a consistent snapshot which does not lock the tables of the
+    site
+    """
+    inputs = ('conf:compression', 'dest:wpath', 'dest:db')
+    outputs = ('dest:backup:database',)
+
+    def init(self):
+        self.target = AbstractProcess.DEST
+        self.name = 'Creating database dump from destination'
+
+    async def run(self, args, conf):
+        setting = conf.get('compression', {'codec': 'none'})
+        name = 'database.sql' + CODECS.get(setting['codec'], dict()).get(
+            'extension', '')
+        cmd = 'set -o pipefail; {} && {}'.format(
+            make_backup_command(args, conf), compress(
+                conf, 'wp --allow-root --path={} db export --add-drop-table '
+                '--single-transaction -'.format(args.dest_wpath),
+                posixpath.join(backup_path(args, conf), name)))
+        await self.command(args, cmd)
+        await self.command(args, prune_command(args))
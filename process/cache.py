@@ -0,0 +1,287 @@
+import hashlib
+import os
+import subprocess
+import tarfile
+import tempfile
+import time
+
+import lib
+import metrics
+from process.common import AbstractProcess, feed, local_path, pump
+from process.compression import compress, local_command
+from process.delta import load_manifest, null_names
+
+READ_SIZE = 1024 * 1024
+
+
+class ContentCache(object):
+    """Files of this machine stored by their sha1
+
+    An object is kept in <root>/<first two digits>/<sha1> and its
+    modification time is the last time a migration used it, so the least
+    recently used objects are removed when the cache grows over its limit.
+    """
+
+    def __init__(self, root, limit):
+        self.root = root
+        self.limit = limit
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def get(self, digest):
+        """Returns the path of an object, or None when it is not cached"""
+        path = self._path(digest)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def add(self, source):
+        """Stores the content of a file object
+        Returns its sha1 and size
+        """
+        os.makedirs(self.root, exist_ok=True)
+        digest = hashlib.sha1()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=self.root, delete=False) as tmp:
+            try:
+                while True:
+                    data = source.read(READ_SIZE)
+                    if not data:
+                        break
+                    digest.update(data)
+                    tmp.write(data)
+                    size += len(data)
+            except Exception:
+                os.remove(tmp.name)
+                raise
+        path = self._path(digest.hexdigest())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp.name, path)
+        return digest.hexdigest(), size
+
+    def evict(self, since):
+        """Removes the least recently used objects until the cache fits in
+        its limit
+        The objects used after since are kept, a migration may need them
+        Returns the amount of bytes removed
+        """
+        if not os.path.isdir(self.root):
+            return 0
+        objects = list()
+        for entry in os.scandir(self.root):
+            # The files in the root are the objects being written
+            if not entry.is_dir():
+                continue
+            for item in os.scandir(entry.path):
+                stat = item.stat()
+                objects.append((stat.st_mtime, stat.st_size, item.path))
+        total = sum(size for _, size, _ in objects)
+        removed = 0
+        for mtime, size, path in sorted(objects):
+            if total - removed <= self.limit or mtime >= since:
+                break
+            os.remove(path)
+            removed += size
+        return removed
+
+
+def _remote_entries(ssh, path, excludes):
+    """Returns the directories, files and links of path with their
+    metadata as (type, mode, mtime, uid, gid, user, group, link, name)
+    The excluded paths and everything inside them are left out
+    """
+    cmd = ('cd {} && find . -printf '
+           '"%y\\0%m\\0%T@\\0%U\\0%G\\0%u\\0%g\\0%l\\0%P\\0"'.format(path))
+    lib.log.debug(cmd)
+    _, stdout, stderr = ssh.exec_command(cmd)
+    content = stdout.read().decode('utf-8', 'surrogateescape')
+    status = stdout.channel.recv_exit_status()
+    if status != 0:
+        raise Exception(stderr.read().decode('utf-8'))
+    items = content.split('\0')[:-1]
+    entries = list()
+    for idx in range(0, len(items), 9):
+        entry = items[idx:idx + 9]
+        parts = entry[8].split('/')
+        if any('/'.join(parts[:end]) in excludes
+               for end in range(1, len(parts) + 1)):
+            continue
+        entries.append(entry)
+    return sorted(entries, key=lambda item: item[8])
+
+
+class _Reader(object):
+    """File object reading from a function"""
+
+    def __init__(self, read):
+        self.read = read
+
+
+class SrcDownloadCachedTarProcess(AbstractProcess):
+    """Downloads the wordpress files through the cache of this machine
+    Only the files whose content is not cached are downloaded, then the
+    tar file is built here from the cache with the metadata of the source
+    files
+    """
+    inputs = ('conf:compression', 'conf:excludes',
+              'local:.manifest.src.json')
+    outputs = ('local:wp.tar.gz',)
+
+    def init(self):
+        self.target = AbstractProcess.SRC
+        self.name = 'Downloading wordpress files through the cache'
+
+    def execute(self, args, conf):
+        start = time.time()
+        ssh = self.cons[self.target]
+        cache = ContentCache(args.cache_dir,
+                             args.cache_size * 1024 * 1024 * 1024)
+        manifest = load_manifest(args, 'src', args.src_address,
+                                 args.src_wpath)
+        entries = _remote_entries(ssh, args.src_wpath,
+                                  set(conf.get('excludes', list())))
+        digests = dict()
+        missing = dict()
+        shared = list()
+        hits = [0, 0]
+        files = [entry for entry in entries if entry[0] == 'f']
+        for entry in files:
+            name = entry[8]
+            digest = manifest[name][2] if name in manifest else None
+            digests[name] = digest
+            if digest is not None and cache.get(digest) is not None:
+                hits[0] += 1
+                hits[1] += manifest[name][0]
+            elif digest is None or digest not in missing:
+                # The files with the same content are downloaded once
+                missing[digest or name] = name
+            else:
+                shared.append(name)
+        downloaded = self._fetch(ssh, args, conf, list(missing.values()),
+                                 cache, digests, manifest)
+        # When the file downloaded changed since the manifest, the files
+        # which had the same content are downloaded on their own
+        stale = [name for name in shared if cache.get(digests[name]) is None]
+        if stale:
+            downloaded += self._fetch(ssh, args, conf, stale, cache, digests,
+                                      manifest)
+        self._build(conf, entries, digests, cache,
+                    local_path(args, 'wp.tar.gz'))
+        evicted = cache.evict(start)
+
+        total = sum(manifest[entry[8]][0] for entry in files
+                    if entry[8] in manifest)
+        self.stats.info['cache'] = {
+            'files': len(files), 'hits': hits[0], 'bytes': total,
+            'saved': hits[1], 'downloaded': downloaded, 'evicted': evicted}
+        lib.log.info('Cache served %d of %d files (%.0f%%), %.1f of %.1f MB '
+                     'saved, %.1f MB downloaded', hits[0], len(files),
+                     100.0 * hits[0] / len(files) if files else 0,
+                     hits[1] / 1024 / 1024, total / 1024 / 1024,
+                     downloaded / 1024 / 1024)
+
+    def _fetch(self, ssh, args, conf, names, cache, digests, manifest):
+        """Downloads the files in names into the cache
+        The progress counts the content of the files, their sizes in the
+        manifest are its total
+        Returns the amount of bytes received
+        """
+        if not names:
+            return 0
+        cmd = 'set -o pipefail; ' + compress(
+            conf, 'tar -cf - -C {} --null -T -'.format(args.src_wpath))
+        lib.log.debug(cmd)
+        stdin, stdout, stderr = ssh.exec_command(cmd)
+        thread = feed(stdin, null_names(names))
+        progress = metrics.Progress(self.name, sum(
+            manifest[name][0] for name in names if name in manifest))
+        received = [0]
+
+        def read(size):
+            data = stdout.channel.recv(size)
+            received[0] += len(data)
+            return data
+
+        procs = list()
+        errors = list()
+        threads = [thread]
+        source = _Reader(read)
+        command = local_command(conf, 'decompress')
+        if command is not None:
+            procs.append(subprocess.Popen(command, stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE))
+            threads.append(pump(read, procs[0].stdin.write, errors, procs,
+                                procs[0].stdin.close))
+            source = procs[0].stdout
+        try:
+            with tarfile.open(fileobj=source, mode='r|') as tar:
+                for member in tar:
+                    if member.isfile():
+                        # The content may have changed since the manifest
+                        digests[member.name], _ = cache.add(
+                            tar.extractfile(member))
+                        progress.update(member.size)
+        except Exception as exc:
+            errors.append(exc)
+            stdout.channel.close()
+            for proc in procs:
+                proc.kill()
+        for item in threads:
+            item.join()
+        status = stdout.channel.recv_exit_status()
+        if status != 0:
+            raise Exception(stderr.read().decode('utf-8'))
+        for proc in procs:
+            if proc.wait() != 0 and not errors:
+                errors.append(Exception('Unable to decompress the files'))
+        if errors:
+            raise errors[0]
+        self.add_bytes(received[0])
+        return received[0]
+
+    def _build(self, conf, entries, digests, cache, target):
+        """Writes the tar file of the entries with the cached contents"""
+        command = local_command(conf, 'compress')
+        with open(target, 'wb') as file:
+            proc = None
+            output = file
+            if command is not None:
+                proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                        stdout=file)
+                output = proc.stdin
+            try:
+                with tarfile.open(fileobj=output, mode='w|',
+                                  format=tarfile.GNU_FORMAT) as tar:
+                    for entry in entries:
+                        self._add(tar, entry, digests, cache)
+            finally:
+                if proc is not None:
+                    proc.stdin.close()
+                    if proc.wait() != 0:
+                        raise Exception('Unable to compress the tar file')
+
+    def _add(self, tar, entry, digests, cache):
+        kind, mode, mtime, uid, gid, user, group, link, name = entry
+        info = tarfile.TarInfo('./' + name if name else '.')
+        info.mode = int(mode, 8)
+        info.mtime = int(float(mtime))
+        info.uid, info.gid = int(uid), int(gid)
+        info.uname, info.gname = user, group
+        if kind == 'd':
+            info.type = tarfile.DIRTYPE
+            tar.addfile(info)
+        elif kind == 'l':
+            info.type = tarfile.SYMTYPE
+            info.linkname = link
+            tar.addfile(info)
+        elif kind == 'f':
+            digest = digests.get(name)
+            path = None if digest is None else cache.get(digest)
+            if path is None:
+                raise Exception('File "{}" is not in the cache'.format(name))
+            info.size = os.path.getsize(path)
+            with open(path, 'rb') as source:
+                tar.addfile(info, source)
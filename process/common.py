@@ -1,9 +1,15 @@
 from abc import ABCMeta, abstractmethod
-
-import paramiko
-from paramiko import SSHClient
+import asyncio
+import os.path
+import posixpath
+import shlex
+import threading
 
 import lib
+import metrics
+from process import aio
+
+RELAY_BUFFER_SIZE = 256 * 1024
 
 
 class AbstractProcess(object):
@@ -11,17 +17,47 @@ class AbstractProcess(object):
     __metaclass__ = ABCMeta
     DEST = 0
     SRC = 1
-    CONS = dict()
+    # Resources read and written by the process. A resource is a conf key
+    # ('conf:tables'), a file in a machine ('src:/tmp/mysql.dump',
+    # 'local:wp.tar.gz') or a whole remote asset ('dest:wpath', 'dest:db')
+    inputs = ()
+    outputs = ()
 
     def __init__(self):
         self.name = None
         self.target = None
         self.required = False
+        # Connections of the migration running the process by target, it is
+        # shared by all the processes of the same migration
+        self.cons = dict()
+        # Pool the connections are taken from
+        self.pool = None
+        # Measures of the execution, they are replaced by the migration
+        self.stats = metrics.StepStats(self.key, None)
+
+    @property
+    def key(self):
+        """Identifies the process in the resume state"""
+        return type(self).__name__
+
+    def resources(self):
+        """Returns the sets of resources read and written by the process
+        The connection of the target machine is always read
+        """
+        inputs = set(self.inputs)
+        inputs.add('ssh:dest' if self.target == AbstractProcess.DEST
+                   else 'ssh:src')
+        return inputs, set(self.outputs)
+
+    def checkpoint(self):
+        """Saves the resume state while the process is running
+        The scheduler replaces it before executing the process
+        """
+        pass
 
-    @staticmethod
-    def close_connections():
-        for key in AbstractProcess.CONS:
-            AbstractProcess.CONS[key].close()
+    def add_bytes(self, amount):
+        """Counts bytes transferred, it can be called from several threads"""
+        self.stats.add_bytes(amount)
 
     @abstractmethod
     def init(self):
@@ -33,81 +69,279 @@ class AbstractProcess(object):
         """Implements the command to be run"""
         pass
 
+    async def run(self, args, conf):
+        """Executes the process in the event loop of the scheduler
+        A synchronous process runs in a thread of the loop
+        """
+        await asyncio.to_thread(self.execute, args, conf)
+
+
+class AsyncProcess(AbstractProcess):
+    """Process implemented as a coroutine
+    Its remote commands are multiplexed with the ones of the other
+    processes in the event loop, instead of blocking a thread each one
+    """
+
+    def execute(self, args, conf):
+        asyncio.run(self.run(args, conf))
+
+    @abstractmethod
+    async def run(self, args, conf):
+        """Implements the command to be run"""
+        pass
+
+    async def command(self, args, cmd, stdin=None, output=None, target=None):
+        """Runs a command in the target machine, or in the given one,
+        limited by the command timeout of the arguments, see aio.command
+        """
+        ssh = self.cons[self.target if target is None else target]
+        return await aio.command(ssh, cmd, stdin, output,
+                                 args.command_timeout)
+
+
+def local_path(args, name):
+    """Returns the path of a file kept in this machine"""
+    return os.path.join(args.work_dir, name)
+
+
+def tmp_path(args, name):
+    """Returns the path of a temporary file in the remote machines"""
+    return posixpath.join(args.tmp_dir, name)
 
-def _ssh_connect(args, direction):
-    """Creates an ssh connection using the arguments provided"""
+
+def files_path(args):
+    """Returns the directory of the destination the files are written to
+    With the atomic swap they go to a sibling of the wordpress path, which
+    takes its place once the migration is complete
+    """
+    if args.atomic_swap and not args.fix_destination_hostname:
+        return args.dest_wpath.rstrip('/') + '.new'
+    return args.dest_wpath
+
+
+def stream_connections(pool, args, target, count):
+    """Returns count connections to the target machine, each one with its
+    own transport
+    The first one is the connection of the target
+    """
+    direction = 'dest' if target == AbstractProcess.DEST else 'src'
+    return [pool.get(args, direction, idx) for idx in range(count)]
+
+
+def dest_ssh_command(args, cmd):
+    """Wraps a command so the source machine runs it in the destination
+    It is used by the fast copy flow, the destination key was uploaded to
+    the source by SrcCopyDestinationFileKeyProcess
+    """
+    ssh_cmd = 'ssh -oStrictHostKeyChecking=no -p {} '.format(args.dest_port)
+    if args.dest_filekey:
+        ssh_cmd += '-i {} '.format(tmp_path(args, 'tmp_key.pem'))
+    if args.dest_user:
+        ssh_cmd += '{}@'.format(args.dest_user)
+    ssh_cmd += '{} {}'.format(args.dest_address, shlex.quote(cmd))
+    return ssh_cmd
+
+
+def fast_copy_file(cons, args, src_file, dest_file):
+    """Copies a file from the source directly into the destination
+    The source runs scp with the destination key uploaded by
+    SrcCopyDestinationFileKeyProcess
+    Returns the size of the file
+    """
+    ssh = cons[AbstractProcess.SRC]
+    cmd = 'stat -c %s {0} && scp -oStrictHostKeyChecking=no -P {1} '.format(
+        src_file, args.dest_port)
+    if args.dest_filekey:
+        cmd += '-i {} '.format(tmp_path(args, 'tmp_key.pem'))
+    cmd += '{} '.format(src_file)
+    if args.dest_user:
+        cmd += '{}@'.format(args.dest_user)
+    cmd += '{}:{}'.format(args.dest_address, dest_file)
+    lib.log.debug(cmd)
+    _, stdout, stderr = ssh.exec_command(cmd)
+    content = stdout.read().decode('utf-8')
+    status = stdout.channel.recv_exit_status()
+    if status != 0:
+        raise Exception(stderr.read().decode('utf-8'))
+    return int(content.split()[0])
+
+
+def relay(src_channel, dest_channel, size=RELAY_BUFFER_SIZE, progress=None):
+    """Copies everything the source channel outputs into the destination
+    channel input
+    Only one buffer is kept in memory, the ssh windows of both channels
+    throttle the remote commands when one side is slower than the other
+    Returns the amount of bytes relayed
+    """
+    total = 0
+    while True:
+        data = src_channel.recv(size)
+        if not data:
+            break
+        dest_channel.sendall(data)
+        total += len(data)
+        if progress is not None:
+            progress.update(len(data))
+    dest_channel.shutdown_write()
+    return total
+
+
+def pump(read, write, errors, procs, end=None):
+    """Copies the data returned by read into write in its own thread
+    end is called after the last write. When it fails the error is added to
+    errors and the local processes in procs are stopped, so the other side
+    does not wait for them
+    """
+    def run():
+        try:
+            while True:
+                data = read(RELAY_BUFFER_SIZE)
+                if not data:
+                    break
+                write(data)
+            if end is not None:
+                end()
+        except Exception as exc:
+            errors.append(exc)
+            for proc in procs:
+                proc.kill()
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def feed(stdin, chunks):
+    """Writes the chunks into the input of a remote command and closes it
+    It runs in its own thread so the command output can be read meanwhile
+    """
+    def writer():
+        for chunk in chunks:
+            stdin.write(chunk)
+        stdin.flush()
+        stdin.channel.shutdown_write()
+    thread = threading.Thread(target=writer)
+    thread.start()
+    return thread
+
+
+def pipe(cons, args, src_cmd, dest_cmd, src_input=None, rewrite=None):
+    """Feeds the output of src_cmd in the source into dest_cmd in the
+    destination
+    With fast copy the source pipes it directly through ssh, otherwise this
+    machine relays it between both channels
+    src_input is an optional iterable of bytes for the src_cmd input
+    rewrite(read, write, progress) optionally changes the data relayed by
+    this machine, it is not used with fast copy
+    Returns the amount of bytes relayed by this machine
+    """
+    ssh_src = cons[AbstractProcess.SRC]
+    src_cmd = 'set -o pipefail; ' + src_cmd
+    dest_cmd = 'set -o pipefail; ' + dest_cmd
+    if args.fast_copy:
+        cmd = '{} | {}'.format(src_cmd, dest_ssh_command(args, dest_cmd))
+        lib.log.debug(cmd)
+        stdin, stdout, stderr = ssh_src.exec_command(cmd)
+        thread = feed(stdin, src_input or list())
+        status = stdout.channel.recv_exit_status()
+        thread.join()
+        if status != 0:
+            raise Exception(stderr.read().decode('utf-8'))
+        return 0
+
+    ssh_dest = cons[AbstractProcess.DEST]
+    lib.log.debug(src_cmd)
+    src_stdin, src_stdout, src_stderr = ssh_src.exec_command(src_cmd)
+    thread = feed(src_stdin, src_input or list())
+    lib.log.debug(dest_cmd)
+    dest_stdin, dest_stdout, dest_stderr = ssh_dest.exec_command(dest_cmd)
+    total = 0
+    failure = None
     try:
-        ssh = SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.load_system_host_keys()
-        address = args.__getattribute__(direction + '_address')
-        port = args.__getattribute__(direction + '_port')
-        if isinstance(port, str):
-            port = int(port)
-        user = args.__getattribute__(direction + '_user')
-        passw = args.__getattribute__(direction + '_passw')
-        fkey = args.__getattribute__(direction + '_filekey')
-        lib.log.info('Connecting to %s', address)
-        if passw:
-            ssh.connect(address, port=port, username=user, password=passw)
-        elif fkey:
-            key = paramiko.RSAKey.from_private_key_file(fkey)
-            # In case you need to set an user
-            if user:
-                ssh.connect(address, port=port, username=user, pkey=key)
-            else:
-                ssh.connect(address, port=port, pkey=key)
-        lib.log.info('Connection successful')
-        return ssh
+        if rewrite is None:
+            total = relay(src_stdout.channel, dest_stdin.channel,
+                          progress=metrics.Progress('Relaying'))
+        else:
+            total = rewrite(src_stdout.channel.recv,
+                            dest_stdin.channel.sendall,
+                            metrics.Progress('Relaying'))
+            dest_stdin.channel.shutdown_write()
+        lib.log.debug('%d bytes relayed', total)
     except Exception as exc:
-        # 'dict_keys' object is not subscriptable
-        # It means that the connection was not successful
-        lib.log.error('Unable to connect: ' + str(exc))
-        exit(-1)
-    return None
+        # The destination closed the channel, its error explains why
+        src_stdout.channel.close()
+        failure = exc
+    thread.join()
+    src_status = src_stdout.channel.recv_exit_status()
+    dest_status = dest_stdout.channel.recv_exit_status()
+    errors = list()
+    if src_status != 0:
+        errors.append(src_stderr.read().decode('utf-8'))
+    if dest_status != 0:
+        errors.append(dest_stderr.read().decode('utf-8'))
+    if errors:
+        raise Exception(''.join(errors))
+    if failure is not None:
+        raise failure
+    return total
+
+
+def _make_tmp_dir(ssh, args):
+    """Creates the directory of the temporary files in a remote machine"""
+    cmd = 'mkdir -p {}'.format(args.tmp_dir)
+    lib.log.debug(cmd)
+    _, stdout, stderr = ssh.exec_command(cmd)
+    status = stdout.channel.recv_exit_status()
+    if status != 0:
+        raise Exception(stderr.read().decode('utf-8'))
 
 
 class SSHConnectSourceProcess(AbstractProcess):
     """Creates wp database dump"""
+    outputs = ('ssh:src',)
 
     def init(self):
         self.target = AbstractProcess.SRC
         self.name = 'Connecting to source'
 
     def execute(self, args, conf):
-        AbstractProcess.CONS[self.target] = _ssh_connect(args, 'src')
+        self.cons[self.target] = self.pool.get(args, 'src')
+        _make_tmp_dir(self.cons[self.target], args)
 
 
 class SSHConnectDestinationProcess(AbstractProcess):
     """Creates wp database dump"""
+    outputs = ('ssh:dest',)
 
     def init(self):
         self.target = AbstractProcess.DEST
         self.name = 'Connecting to destination'
 
     def execute(self, args, conf):
-        AbstractProcess.CONS[self.target] = _ssh_connect(args, 'dest')
+        self.cons[self.target] = self.pool.get(args, 'dest')
+        _make_tmp_dir(self.cons[self.target], args)
 
 
 class DestReplaceConfProcess(AbstractProcess):
     """Replaces database credentials in wp-config.php"""
+    inputs = ('conf:wp-config', 'dest:wpath')
+    outputs = ('dest:wpath',)
 
     def init(self):
         self.target = AbstractProcess.DEST
         self.name = 'Replacing original database credential in wp-config.php'
 
     def execute(self, args, conf):
-        ssh = AbstractProcess.CONS[self.target]
-        for key in conf['wp-config']:
-            sudo = 'sudo ' if args.dest_sudo else ''
-            cmd = ("{0}sed -i \"s/{1}'[^']*'[^']*/{1}', '{2}/g\""
-                   " {3}/wp-config.php".format(sudo,
-                                               key,
-                                               conf['wp-config'][key],
-                                               args.dest_wpath))
-            lib.log.debug(cmd)
-            _, stdout, _ = ssh.exec_command(cmd)
-            status = stdout.channel.recv_exit_status()
-            if status != 0:
-                lib.log.warning('Unable to execute %s (status = %d)', cmd,
-                                status)
+        ssh = self.cons[self.target]
+        sudo = 'sudo ' if args.dest_sudo else ''
+        # Every key is replaced in the same pass over the file
+        expressions = ' '.join(
+            "-e \"s/{0}'[^']*'[^']*/{0}', '{1}/g\"".format(key, value)
+            for key, value in conf['wp-config'].items())
+        cmd = '{}sed -i {} {}/wp-config.php'.format(sudo, expressions,
+                                                   files_path(args))
+        lib.log.debug(cmd)
+        _, stdout, _ = ssh.exec_command(cmd)
+        status = stdout.channel.recv_exit_status()
+        if status != 0:
+            lib.log.warning('Unable to execute %s (status = %d)', cmd,
+                            status)
@@ -0,0 +1,215 @@
+import shlex
+import shutil
+import time
+
+import lib
+from process.common import AbstractProcess, dest_ssh_command, tmp_path
+
+# Commands used to compress and decompress with every codec, the level is
+# formatted into the compress command
+CODECS = {
+    'gzip': {'compress': 'gzip -{} -c', 'decompress': 'gzip -dc',
+             'levels': range(1, 10), 'default': 6, 'extension': '.gz'},
+    'zstd': {'compress': 'zstd -{} -q -c -T0', 'decompress': 'zstd -dcq',
+             'levels': range(1, 20), 'default': 3, 'extension': '.zst'},
+    'lz4': {'compress': 'lz4 -{} -q -c', 'decompress': 'lz4 -dcq',
+            'levels': range(1, 13), 'default': 1, 'extension': '.lz4'},
+}
+
+# Codecs and levels measured by the auto mode
+CANDIDATES = [('gzip', 1), ('gzip', 6), ('zstd', 1), ('zstd', 3),
+              ('zstd', 9), ('lz4', 1)]
+
+PROBE_SIZE = 8 * 1024 * 1024
+PROBE_FILE = 'wp.probe'
+
+NONE = {'codec': 'none', 'level': None}
+
+
+def parse(value):
+    """Parses a compression option like "none", "gzip" or "zstd:9" """
+    codec, _, level = value.partition(':')
+    if codec == 'none':
+        return dict(NONE)
+    if codec not in CODECS:
+        raise Exception('Unknown compression "{}"'.format(value))
+    level = int(level) if level else CODECS[codec]['default']
+    if level not in CODECS[codec]['levels']:
+        raise Exception('Invalid level {} for {}'.format(level, codec))
+    return {'codec': codec, 'level': level}
+
+
+def compress(conf, cmd, target=None):
+    """Appends the compressor to a command which writes to stdout
+    When target is given the compressed output is written to that file
+    """
+    setting = conf.get('compression', NONE)
+    if setting['codec'] != 'none':
+        codec = CODECS[setting['codec']]
+        cmd = '{} | {}'.format(cmd, codec['compress'].format(setting['level']))
+    if target:
+        cmd = '{} > {}'.format(cmd, target)
+    return cmd
+
+
+def decompress(conf, cmd, source=None):
+    """Prepends the decompressor to a command which reads from stdin
+    When source is given the compressed input is read from that file
+    """
+    setting = conf.get('compression', NONE)
+    redirect = ' < {}'.format(source) if source else ''
+    if setting['codec'] == 'none':
+        return cmd + redirect
+    return '{}{} | {}'.format(CODECS[setting['codec']]['decompress'],
+                              redirect, cmd)
+
+
+def local_command(conf, action):
+    """Returns the arguments of the compress or decompress action of the
+    codec in this machine, or None when the data is not compressed
+    """
+    setting = conf.get('compression', NONE)
+    if setting['codec'] == 'none':
+        return None
+    command = CODECS[setting['codec']][action]
+    if action == 'compress':
+        command = command.format(setting['level'])
+    return shlex.split(command)
+
+
+def _exec(ssh, cmd):
+    lib.log.debug(cmd)
+    _, stdout, stderr = ssh.exec_command(cmd)
+    content = stdout.read().decode('utf-8')
+    status = stdout.channel.recv_exit_status()
+    if status != 0:
+        raise Exception(stderr.read().decode('utf-8'))
+    return content
+
+
+def _available(ssh):
+    """Returns the codecs installed in a machine"""
+    cmd = ' '.join('command -v {} > /dev/null && echo {};'.format(codec, codec)
+                   for codec in CODECS)
+    return _exec(ssh, cmd + ' true').split()
+
+
+def make_sample(ssh, args):
+    """Writes the first bytes of the tar of the source files in a temporary
+    file of the source, returns its path and its size
+    """
+    probe = tmp_path(args, PROBE_FILE)
+    _exec(ssh, 'tar -cf - -C {} . 2> /dev/null | head -c {} > {}'
+          .format(args.src_wpath, PROBE_SIZE, probe))
+    return probe, int(_exec(ssh, 'wc -c < {}'.format(probe)))
+
+
+def direct_link(ssh, args):
+    """Returns whether the source reaches the destination on its own, which
+    fast copy needs
+    Nothing is installed, the key of the destination has to be in the
+    source already
+    """
+    if not args.fast_copy:
+        return False
+    cmd = dest_ssh_command(args, 'true')
+    if args.dest_filekey:
+        cmd = '[ -e {} ] && {}'.format(tmp_path(args, 'tmp_key.pem'), cmd)
+    lib.log.debug(cmd)
+    _, stdout, _ = ssh.exec_command(cmd)
+    return stdout.channel.recv_exit_status() == 0
+
+
+def link_speed(ssh, args, probe, sample, direct):
+    """Returns the bytes per second from the source to the next machine
+    The next machine is the destination when the link is direct, otherwise
+    it is this machine
+    """
+    if direct:
+        cmd = ('s=$(date +%s%N); cat {} | {}; echo $(($(date +%s%N) - s))'
+               .format(probe,
+                       dest_ssh_command(args, 'cat > /dev/null')))
+        elapsed = int(_exec(ssh, cmd)) / 1e9
+    else:
+        cmd = 'cat {}'.format(probe)
+        lib.log.debug(cmd)
+        start = time.time()
+        _, stdout, stderr = ssh.exec_command(cmd)
+        while stdout.read(PROBE_SIZE):
+            pass
+        elapsed = time.time() - start
+        if stdout.channel.recv_exit_status() != 0:
+            raise Exception(stderr.read().decode('utf-8'))
+    return sample / max(elapsed, 1e-9)
+
+
+def measure(ssh, probe, codec, level):
+    """Compresses the sample, returns its size and the seconds spent"""
+    cmd = ('s=$(date +%s%N); {} < {} | wc -c; echo $(($(date +%s%N) - s))'
+           .format(CODECS[codec]['compress'].format(level), probe))
+    size, elapsed = _exec(ssh, cmd).split()
+    return int(size), int(elapsed) / 1e9
+
+
+class SrcResolveCompressionProcess(AbstractProcess):
+    """Selects the compression used for the tar files and the dumps
+    In auto mode it compresses a sample of the source files with every
+    candidate and measures the link throughput, then it picks the codec
+    which minimises the transfer time
+    """
+    outputs = ('conf:compression',)
+
+    def __init__(self, auto=False, fast_copy=False):
+        super().__init__()
+        # Only the auto mode uses the destination, and the link from the
+        # source to it with fast copy
+        self.auto = auto
+        self.fast_copy = fast_copy
+
+    def resources(self):
+        inputs, outputs = super().resources()
+        if self.auto:
+            inputs.add('ssh:dest')
+        if self.auto and self.fast_copy:
+            inputs |= {'src:/tmp/tmp_key.pem', 'dest:authorized_keys'}
+        return inputs, outputs
+
+    def init(self):
+        self.target = AbstractProcess.SRC
+        self.name = 'Selecting compression'
+
+    def execute(self, args, conf):
+        if args.compression != 'auto':
+            conf['compression'] = parse(args.compression)
+            return
+        ssh = self.cons[self.target]
+        ssh_dest = self.cons[AbstractProcess.DEST]
+        codecs = set(_available(ssh)) & set(_available(ssh_dest))
+        if args.search_replace != 'wp' and not args.fast_copy:
+            # The dump is decompressed here to replace its urls
+            codecs &= set(codec for codec in CODECS if shutil.which(codec))
+        candidates = [item for item in CANDIDATES if item[0] in codecs]
+        probe, sample = make_sample(ssh, args)
+        try:
+            if not sample:
+                conf['compression'] = dict(NONE)
+                return
+            link = link_speed(ssh, args, probe, sample,
+                              direct_link(ssh, args))
+            # Seconds per byte of every codec: the size of the compressed
+            # data over the link plus the time to compress it
+            costs = {('none', None): 1.0 / link}
+            for codec, level in candidates:
+                size, elapsed = measure(ssh, probe, codec, level)
+                costs[(codec, level)] = (size / sample / link +
+                                         elapsed / sample)
+                lib.log.debug('%s:%s ratio %.2f, %.1f MB/s', codec, level,
+                              sample / max(size, 1),
+                              sample / max(elapsed, 1e-9) / 1024 / 1024)
+        finally:
+            _exec(ssh, 'rm -f {}'.format(probe))
+        codec, level = min(costs, key=costs.get)
+        conf['compression'] = {'codec': codec, 'level': level}
+        lib.log.info('Link throughput %.1f MB/s, selected compression %s%s',
+                     link / 1024 / 1024, codec,
+                     '' if level is None else ':{}'.format(level))
@@ -0,0 +1,423 @@
+from concurrent.futures import ThreadPoolExecutor
+import fnmatch
+import functools
+import os
+import shlex
+import threading
+
+import lib
+import metrics
+from process.common import (AbstractProcess, fast_copy_file, local_path,
+                            pipe, tmp_path)
+from process.compression import compress, decompress
+from process.multisite import NETWORK_USERS, table_blog
+from process.replace import local_replace, replace_file, replacer, rewrite
+from process.transfer import download, upload
+
+# Prefixes of the tables imported by the atomic swap and of the tables they
+# replaced
+SHADOW_PREFIX = 'wpm_new_'
+OLD_PREFIX = 'wpm_old_'
+# Renames the tables of the statements of a dump, the rows are not changed
+SHADOW_FILTER = ("sed -E 's/^(DROP TABLE IF EXISTS|CREATE TABLE|LOCK TABLES|"
+                 "INSERT INTO|REPLACE INTO|\\/\\*!40000 ALTER TABLE) `/"
+                 "\\1 `{}/'".format(SHADOW_PREFIX))
+
+
+def row_filters(args):
+    """Returns the conditions of the rows exported by table, given as
+    table:condition in the arguments
+    """
+    filters = dict()
+    for item in args.where or list():
+        table, sep, condition = item.partition(':')
+        if not sep or not table or not condition:
+            raise Exception('Invalid row filter "{}", it must be '
+                            'table:condition'.format(item))
+        filters[table] = condition
+    return filters
+
+
+def selection(args, tables):
+    """Splits the tables by what the export keeps of them
+    Returns the tables exported whole, the tables exported with a row filter
+    along with their condition and the tables of which only the schema is
+    exported
+    """
+    patterns = list(args.schema_only or list())
+    if args.no_posts:
+        patterns.append('*post*')
+    filters = row_filters(args)
+    whole, filtered, schema = list(), list(), list()
+    for table in tables:
+        if any(fnmatch.fnmatchcase(table, item) for item in patterns):
+            schema.append(table)
+        elif table in filters:
+            filtered.append((table, filters[table]))
+        else:
+            whole.append(table)
+    return whole, filtered, schema
+
+
+def _export(args):
+    return 'wp --allow-root --path={} db export'.format(args.src_wpath)
+
+
+def schema_command(args, tables):
+    """Returns the command which exports the schema of the tables without
+    their rows
+    """
+    return '{} --add-drop-table --no-data --tables={} -'.format(
+        _export(args), ','.join(tables))
+
+
+def export_command(args, conf, tables):
+    """Returns the command which exports the tables to stdout replacing the
+    source site url by the destination one
+    When this machine replaces the url the tables are only exported. The
+    rows left out by the arguments are not exported at all, the tables keep
+    their schema so the destination ends up with them empty
+    """
+    whole, filtered, schema = selection(args, tables)
+    cmds = list()
+    if whole and local_replace(args):
+        cmds.append('{} --add-drop-table --tables={} -'.format(
+            _export(args), ','.join(whole)))
+    elif whole:
+        cmds.append('wp --allow-root --path={} search-replace --network '
+                    '--precise {} {} {} --export'
+                    .format(args.src_wpath,
+                            conf['wp-config']['SRC_DOMAIN_CURRENT_SITE'],
+                            conf['wp-config']['DOMAIN_CURRENT_SITE'],
+                            ' '.join(whole)))
+    # The options wp does not know are passed to mysqldump
+    for table, condition in filtered:
+        cmds.append('{} --add-drop-table --tables={} --where={} -'.format(
+            _export(args), table, shlex.quote(condition)))
+    if schema:
+        cmds.append(schema_command(args, schema))
+    if len(cmds) == 1:
+        return cmds[0]
+    return '{{ {}; }}'.format(' && '.join(cmds))
+
+
+def chunk_export_command(args, table, condition, merge=None):
+    """Returns the command which exports the rows of a table matching the
+    condition, without the statements which create the table
+    Every chunk is read in its own transaction and it does not lock the
+    table, so the chunks of a table are imported at the same time. The rows
+    merged into a table replace the ones with the same key, or they are
+    left out when merge is ignore
+    """
+    modes = {None: '', 'replace': ' --replace', 'ignore': ' --insert-ignore'}
+    return ('{} --no-create-info --skip-add-locks --single-transaction{} '
+            '--tables={} --where={} -'.format(
+                _export(args), modes[merge], table, shlex.quote(condition)))
+
+
+def mysql_command(conf):
+    """Returns the mysql client command for the destination database
+    The password goes in the environment so it is not shown by ps
+    """
+    tmp = conf['wp-config']
+    cmd = 'MYSQL_PWD={} mysql -u {}'.format(shlex.quote(tmp['DB_PASSWORD']),
+                                            shlex.quote(tmp['DB_USER']))
+    host, _, port = conf.get('db_host', 'localhost').partition(':')
+    if host not in ('', 'localhost'):
+        cmd += ' -h {}'.format(shlex.quote(host))
+    if port.startswith('/'):
+        cmd += ' --socket={}'.format(shlex.quote(port))
+    elif port:
+        cmd += ' -P {}'.format(port)
+    return '{} {}'.format(cmd, shlex.quote(tmp['DB_NAME']))
+
+
+def import_command(args, conf):
+    """Returns the command which imports a dump read from stdin into the
+    destination database
+    With the atomic swap the tables are created with the shadow prefix, so
+    the site keeps its tables until they are swapped
+    """
+    if not args.atomic_swap:
+        return mysql_command(conf)
+    # Grouped so the input redirected to the command goes to the filter
+    return '{{ {} | {}; }}'.format(SHADOW_FILTER, mysql_command(conf))
+
+
+def balance(tables, sizes, count):
+    """Splits the tables in count groups of similar size
+    The biggest tables are placed first, each one in the lightest group, or
+    in the one with less tables when the sizes are not known
+    """
+    groups = [{'size': 0, 'tables': list()} for _ in range(count)]
+    for table in sorted(tables, key=lambda item: sizes.get(item, 0),
+                        reverse=True):
+        group = min(groups, key=lambda item: (item['size'],
+                                              len(item['tables'])))
+        group['tables'].append(table)
+        group['size'] += sizes.get(table, 0)
+    return [group['tables'] for group in groups if group['tables']]
+
+
+def chunk_ranges(column, low, high, count):
+    """Splits the values of the primary key from low to high in count
+    ranges of the same width and returns their conditions
+    The first range has no lower bound and the last one no upper bound, so
+    the rows added after the ranges were planned are exported too
+    """
+    width = -(-(high - low + 1) // count)
+    conditions = list()
+    for idx in range(count):
+        bounds = list()
+        if idx > 0:
+            bounds.append('`{}` >= {}'.format(column, low + idx * width))
+        if idx < count - 1:
+            bounds.append('`{}` < {}'.format(column, low + (idx + 1) * width))
+        conditions.append(' AND '.join(bounds))
+    return conditions
+
+
+def plan(args, conf, done):
+    """Returns the units of the database migration which are not in done
+    A unit is exported, transferred and imported on its own: a group of
+    whole tables, the schema of the chunked tables, a range of rows of a
+    chunked table or the rows of a network table which belong to the
+    selected sites. The tables bigger than the chunk size of the arguments
+    are chunked when they have a numeric primary key. With selected sites
+    the tables of every site are a group. done has the tables and the
+    chunks already imported
+    """
+    limit = args.db_chunk_size * 1024 * 1024
+    sizes = conf.get('table_sizes', dict())
+    keys = conf.get('table_keys', dict())
+    whole, filtered, _ = selection(args, conf['tables'])
+    filters = dict(filtered)
+    units = list()
+    # The rows of the network tables which belong to the selected sites are
+    # merged into the destination tables
+    for table, rows in sorted(conf.get('site_rows', dict()).items()):
+        key = '{}:sites'.format(table)
+        if key not in done:
+            units.append(dict(rows, done=[key], tables=[table],
+                              serial=table in NETWORK_USERS))
+    chunked = list()
+    chunks = list()
+    for table in whole + list(filters):
+        if not limit or table not in keys:
+            continue
+        column, low, high = keys[table]
+        count = min(-(-sizes.get(table, 0) // limit), high - low + 1)
+        if count < 2:
+            continue
+        chunked.append(table)
+        for idx, condition in enumerate(chunk_ranges(column, low, high,
+                                                     count)):
+            key = '{}:{}'.format(table, idx)
+            if key in done:
+                continue
+            if table in filters:
+                condition = '({}) AND {}'.format(filters[table], condition)
+            chunks.append({'done': [key], 'tables': [table],
+                           'where': condition})
+    # The chunks are imported into the tables the schema unit creates, it
+    # is not imported again once any chunk is
+    if chunked and ':schema' not in done:
+        units.append({'done': [':schema'], 'tables': chunked,
+                      'schema': True})
+    units.extend(chunks)
+    rest = [item for item in conf['tables']
+            if item not in chunked and item not in done]
+    if 'sites' not in conf:
+        for tables in balance(rest, sizes, args.db_workers):
+            units.append({'done': tables, 'tables': tables})
+        return units
+    # Every selected site is a unit of its own, the biggest ones go first
+    sites = dict()
+    for table in rest:
+        sites.setdefault(table_blog(table), list()).append(table)
+    for tables in sorted(sites.values(), key=lambda item: sum(
+            sizes.get(table, 0) for table in item), reverse=True):
+        units.append({'done': tables, 'tables': tables})
+    return units
+
+
+def unit_export_command(args, conf, unit):
+    """Returns the command which exports a unit of plan to stdout"""
+    if 'where' in unit:
+        return chunk_export_command(args, unit['tables'][0], unit['where'],
+                                    unit.get('merge'))
+    if unit.get('schema'):
+        return schema_command(args, unit['tables'])
+    return export_command(args, conf, unit['tables'])
+
+
+def unit_import_command(args, conf, unit, source=None):
+    """Returns the command which imports the export of a unit, read from
+    the source file or from stdin
+    A chunk deletes the rows of its range first, so the chunk imported
+    again after a failure does not repeat them, and the merged rows delete
+    the ones of the selected sites, so the rows removed from the source are
+    removed from the destination. A unit with a stage imports its rows into
+    that temporary table, the statements after it copy them
+    """
+    if 'where' not in unit:
+        return decompress(conf, import_command(args, conf), source)
+    table = unit['tables'][0]
+    if args.atomic_swap:
+        table = SHADOW_PREFIX + table
+    cmds = list()
+    delete = unit.get('delete', unit['where'])
+    if delete is not None:
+        cmds.append('echo {}'.format(shlex.quote(
+            'DELETE FROM `{}` WHERE {};'.format(table, delete))))
+    dump = decompress(conf, 'cat', source)
+    if 'stage' in unit:
+        cmds.append('echo {}'.format(shlex.quote(
+            'CREATE TEMPORARY TABLE `{}` LIKE `{}`;'.format(unit['stage'],
+                                                            table))))
+        dump += ' | sed {}'.format(shlex.quote(
+            's/^INSERT INTO `{}` /INSERT INTO `{}` /'.format(table,
+                                                            unit['stage'])))
+    cmds.append(dump)
+    cmds.extend('echo {}'.format(shlex.quote(sql))
+                for sql in unit.get('after', list()))
+    return '{{ {}; }} | {}'.format('; '.join(cmds),
+                                   import_command(args, conf))
+
+
+def migrate_units(args, conf, migrate, checkpoint):
+    """Runs migrate(idx, unit) for every unit of the database not imported
+    yet, in the database workers of the arguments
+    The units imported are recorded in the resume state as they finish, so
+    a failure only repeats the units which were not imported
+    """
+    done = conf.setdefault('database:done', list())
+    units = plan(args, conf, done)
+    lib.log.info('Database split in %d units', len(units))
+    lock = threading.Lock()
+
+    def run(idx, unit):
+        migrate(idx, unit)
+        with lock:
+            done.extend(unit['done'])
+            checkpoint()
+
+    # The chunks wait for the tables they are imported into, and the users
+    # are merged one table after the other
+    for idx, unit in enumerate(units):
+        if unit.get('schema') or unit.get('serial'):
+            run(idx, unit)
+    with ThreadPoolExecutor(max_workers=args.db_workers) as executor:
+        futures = [executor.submit(run, idx, unit)
+                   for idx, unit in enumerate(units)
+                   if not unit.get('schema') and not unit.get('serial')]
+        # It waits for every unit before raising the first error
+        errors = [future.exception() for future in futures]
+    for exc in errors:
+        if exc is not None:
+            raise exc
+    del conf['database:done']
+
+
+class DestParallelDatabaseProcess(AbstractProcess):
+    """Exports, transfers and imports the database in groups of tables and
+    chunks of the biggest tables
+    Every unit of the plan is exported in its own channel, it is transferred
+    as soon as its export finishes and imported while the other units are
+    still being exported
+    """
+    inputs = ('conf:compression', 'conf:wp-config', 'conf:db_host',
+              'conf:tables', 'conf:table_sizes', 'conf:table_keys',
+              'conf:sites', 'conf:site_rows', 'ssh:src',
+              'src:/tmp/tmp_key.pem', 'dest:authorized_keys')
+    outputs = ('src:/tmp/mysql.*.dump', 'local:mysql.*.dump',
+               'dest:/tmp/mysql.src.*.dump', 'dest:db')
+
+    def init(self):
+        self.target = AbstractProcess.DEST
+        self.name = 'Migrating database in parallel groups of tables'
+
+    def execute(self, args, conf):
+        migrate_units(args, conf, lambda idx, unit: self._migrate(
+            args, conf, idx, unit), self.checkpoint)
+
+    def _migrate(self, args, conf, idx, unit):
+        src_file = tmp_path(args, 'mysql.{}.dump'.format(idx))
+        dest_file = tmp_path(args, 'mysql.src.{}.dump'.format(idx))
+        self._run(AbstractProcess.SRC, 'set -o pipefail; ' + compress(
+            conf, unit_export_command(args, conf, unit), src_file))
+        lib.log.info('Unit %d exported', idx)
+        if args.fast_copy:
+            self.add_bytes(fast_copy_file(self.cons, args, src_file,
+                                          dest_file))
+        else:
+            # The units not imported are exported again when the process is
+            # resumed, so their transfers are not recorded in the resume
+            # state
+            local_file = local_path(args, os.path.basename(src_file))
+            chunk_size = args.chunk_size * 1024 * 1024
+            self.add_bytes(download(
+                [self.cons[AbstractProcess.SRC]], src_file, local_file,
+                dict(), lambda: None, chunk_size,
+                metrics.Progress('Downloading unit {}'.format(idx))))
+            if local_replace(args):
+                exported = local_file + '.export'
+                os.rename(local_file, exported)
+                # The units share the workers
+                replace_file(conf, exported, local_file, replacer(
+                    args, conf, max(args.replace_workers // args.db_workers,
+                                    1)))
+                os.remove(exported)
+            self.add_bytes(upload(
+                [self.cons[AbstractProcess.DEST]], local_file, dest_file,
+                dict(), lambda: None, chunk_size,
+                metrics.Progress('Uploading unit {}'.format(idx))))
+            os.remove(local_file)
+        self._run(AbstractProcess.SRC, 'rm -f {}'.format(src_file))
+        cmd = unit_import_command(args, conf, unit, dest_file)
+        self._run(AbstractProcess.DEST, 'set -o pipefail; {} && rm -f {}'
+                  .format(cmd, dest_file))
+        lib.log.info('Unit %d imported', idx)
+
+    def _run(self, target, cmd):
+        ssh = self.cons[target]
+        lib.log.debug(cmd)
+        _, stdout, stderr = ssh.exec_command(cmd)
+        status = stdout.channel.recv_exit_status()
+        if status != 0:
+            raise Exception(stderr.read().decode('utf-8'))
+
+
+class DestStreamDatabaseProcess(AbstractProcess):
+    """Pipes the export of the source into the mysql client of the
+    destination
+    The import starts with the first bytes of the export and no dump file
+    is written in any machine. With several database workers every unit of
+    the plan is piped in its own channels
+    """
+    inputs = ('conf:compression', 'conf:wp-config', 'conf:db_host',
+              'conf:tables', 'conf:table_sizes', 'conf:table_keys',
+              'conf:sites', 'conf:site_rows', 'ssh:src',
+              'src:/tmp/tmp_key.pem', 'dest:authorized_keys')
+    outputs = ('dest:db',)
+
+    def init(self):
+        self.target = AbstractProcess.DEST
+        self.name = 'Streaming database from source to destination'
+
+    def execute(self, args, conf):
+        migrate_units(args, conf, lambda idx, unit: self._stream(
+            args, conf, unit), self.checkpoint)
+
+    def _stream(self, args, conf, unit):
+        transform = None
+        if local_replace(args):
+            # The units share the workers
+            engine = replacer(args, conf, max(args.replace_workers //
+                                              args.db_workers, 1))
+            transform = functools.partial(rewrite, conf, engine)
+        self.add_bytes(pipe(
+            self.cons, args, compress(conf, unit_export_command(args, conf,
+                                                                unit)),
+            unit_import_command(args, conf, unit), rewrite=transform))
+        lib.log.info('%d tables imported', len(unit['tables']))
@@ -0,0 +1,213 @@
+import json
+import os.path
+
+import lib
+from process.common import AbstractProcess, feed, local_path, pipe
+from process.compression import compress, decompress
+from process.scan import load_rules
+
+# Checksums of the manifest entries which are not regular files, the target
+# follows the one of a symbolic link
+DIR = 'dir'
+LINK = 'link:'
+
+
+def _manifest_file(args, direction):
+    return local_path(args, '.manifest.{}.json'.format(direction))
+
+
+def load_manifest(args, direction, address, path):
+    """Returns the cached manifest, it is discarded when it belongs to
+    another machine or wordpress path
+    """
+    if not os.path.exists(_manifest_file(args, direction)):
+        return dict()
+    with open(_manifest_file(args, direction)) as file:
+        data = json.load(file)
+    if data.get('address') != address or data.get('path') != path:
+        return dict()
+    return data['files']
+
+
+def _save_manifest(args, direction, address, path, files):
+    with open(_manifest_file(args, direction), 'w') as file:
+        file.write(json.dumps({'address': address, 'path': path,
+                               'files': files}))
+
+
+def null_names(names):
+    """Encodes a list of file names separated by NUL"""
+    return (name.encode('utf-8', 'surrogateescape') + b'\0' for name in names)
+
+
+def _remote_stat(ssh, path, sudo):
+    """Returns the size, the modification time and the checksum of every
+    file, directory and symbolic link in path
+    The checksum of a file is None, it is hashed later. The directories and
+    the links have no size, they only differ by their checksum
+    """
+    cmd = ('[ -d {1} ] || exit 0; cd {1} && {0}find . -mindepth 1 '
+           '\\( -type f -o -type d -o -type l \\) '
+           '-printf "%y\\0%P\\0%s\\0%T@\\0%l\\0"'.format(sudo, path))
+    lib.log.debug(cmd)
+    _, stdout, stderr = ssh.exec_command(cmd)
+    content = stdout.read().decode('utf-8', 'surrogateescape')
+    status = stdout.channel.recv_exit_status()
+    if status != 0:
+        raise Exception(stderr.read().decode('utf-8'))
+    items = content.split('\0')[:-1]
+    entries = dict()
+    for idx in range(0, len(items), 5):
+        kind, name, size, mtime, target = items[idx:idx + 5]
+        checksum = {'f': None, 'd': DIR}.get(kind, LINK + target)
+        # tar keeps the mtime in seconds, so the fraction is dropped to
+        # compare files extracted by tar
+        entries[name] = [int(size) if kind == 'f' else 0,
+                         int(mtime.split('.')[0]), checksum]
+    return entries
+
+
+def _kind(entry):
+    """Returns the kind of a manifest entry: DIR, LINK or None for a file"""
+    return next((kind for kind in (DIR, LINK)
+                 if entry[2].startswith(kind)), None)
+
+
+def _remote_hash(ssh, path, sudo, names):
+    """Returns the sha1 of the files in path listed in names"""
+    if not names:
+        return dict()
+    cmd = 'cd {} && {}xargs -0 -r sha1sum -z --'.format(path, sudo)
+    lib.log.debug(cmd)
+    stdin, stdout, stderr = ssh.exec_command(cmd)
+    thread = feed(stdin, null_names(names))
+    content = stdout.read().decode('utf-8', 'surrogateescape')
+    thread.join()
+    status = stdout.channel.recv_exit_status()
+    if status != 0:
+        raise Exception(stderr.read().decode('utf-8'))
+    hashes = dict()
+    for line in content.split('\0')[:-1]:
+        digest, name = line.split('  ', 1)
+        hashes[name] = digest
+    return hashes
+
+
+def build_manifest(ssh, args, conf, direction, address, path, sudo=''):
+    """Builds the manifest of path, a dict of name -> [size, mtime, sha1]
+    The directories and the symbolic links are in it too, with DIR or LINK
+    and their target instead of the sha1. Only the files which are new or
+    whose size or mtime changed since the cached manifest are hashed again.
+    The excluded files are left out, so they are neither transferred nor
+    removed
+    """
+    cached = load_manifest(args, direction, address, path)
+    rules = load_rules(args, conf)
+    files = {name: item for name, item in _remote_stat(ssh, path, sudo).items()
+             if not rules.excluded(name)}
+    stale = [name for name, item in files.items() if item[2] is None and (
+        name not in cached or cached[name][:2] != item[:2] or
+        _kind(cached[name]) is not None)]
+    lib.log.info('%d entries found in %s, %d files need to be hashed',
+                 len(files), address, len(stale))
+    hashes = _remote_hash(ssh, path, sudo, stale)
+    for name, item in files.items():
+        if item[2] is None:
+            item[2] = hashes[name] if name in hashes else cached[name][2]
+    _save_manifest(args, direction, address, path, files)
+    return files
+
+
+class SrcBuildManifestProcess(AbstractProcess):
+    """Builds the manifest of the wordpress files in the source"""
+    inputs = ('conf:sites',)
+    outputs = ('local:.manifest.src.json',)
+
+    def init(self):
+        self.target = AbstractProcess.SRC
+        self.name = 'Building manifest of source files'
+
+    def execute(self, args, conf):
+        ssh = self.cons[self.target]
+        build_manifest(ssh, args, conf, 'src', args.src_address,
+                       args.src_wpath)
+
+
+class DestBuildManifestProcess(AbstractProcess):
+    """Builds the manifest of the wordpress files in the destination"""
+    inputs = ('conf:sites', 'dest:wpath')
+    outputs = ('local:.manifest.dest.json',)
+
+    def init(self):
+        self.target = AbstractProcess.DEST
+        self.name = 'Building manifest of destination files'
+
+    def execute(self, args, conf):
+        ssh = self.cons[self.target]
+        sudo = 'sudo ' if args.dest_sudo else ''
+        build_manifest(ssh, args, conf, 'dest', args.dest_address,
+                       args.dest_wpath, sudo)
+
+
+class DestSyncDeltaProcess(AbstractProcess):
+    """Transfers the new and changed files and removes the deleted ones
+    The changes are found comparing the manifests of both machines, the
+    directories and the symbolic links are created and removed like the
+    files. An entry which changed its kind is removed before the new one
+    is extracted
+    """
+    inputs = ('conf:compression', 'conf:excludes', 'local:.manifest.src.json',
+              'local:.manifest.dest.json', 'ssh:src', 'src:/tmp/tmp_key.pem', 'dest:authorized_keys')
+    outputs = ('dest:wpath', 'local:.manifest.dest.json')
+
+    def init(self):
+        self.target = AbstractProcess.DEST
+        self.name = 'Synchronizing changed files into destination'
+
+    def execute(self, args, conf):
+        src = load_manifest(args, 'src', args.src_address, args.src_wpath)
+        dest = load_manifest(args, 'dest', args.dest_address,
+                              args.dest_wpath)
+        changed = sorted(name for name in src if name not in dest or
+                         dest[name][::2] != src[name][::2])
+        removed = [name for name in dest if name not in src or
+                   _kind(dest[name]) != _kind(src[name])]
+        lib.log.info('%d entries to transfer, %d entries to remove',
+                     len(changed), len(removed))
+        sudo = 'sudo ' if args.dest_sudo else ''
+        if removed:
+            self._remove(removed, dest, args, sudo)
+        if changed:
+            # The directories are listed without their contents
+            archive = compress(conf, 'tar -cf - -C {} --no-recursion --null '
+                               '-T -'.format(args.src_wpath))
+            extract = '{0}mkdir -p {1}; {2}'.format(
+                sudo, args.dest_wpath,
+                decompress(conf, '{}tar -xf - -C {}'.format(sudo,
+                                                            args.dest_wpath)))
+            self.add_bytes(pipe(self.cons, args, archive, extract,
+                                null_names(changed)))
+        _save_manifest(args, 'dest', args.dest_address, args.dest_wpath, src)
+
+    def _remove(self, names, dest, args, sudo):
+        """Removes the files and the links, then the directories below
+        before their parents. A directory which still has excluded files
+        is kept
+        """
+        dirs = sorted((name for name in names if _kind(dest[name]) == DIR),
+                      reverse=True)
+        others = [name for name in names if _kind(dest[name]) != DIR]
+        for cmd, items in (('rm -f', others),
+                           ('rmdir --ignore-fail-on-non-empty', dirs)):
+            if not items:
+                continue
+            cmd = 'cd {} && {}xargs -0 -r {} --'.format(args.dest_wpath, sudo,
+                                                        cmd)
+            lib.log.debug(cmd)
+            ssh = self.cons[self.target]
+            stdin, stdout, stderr = ssh.exec_command(cmd)
+            thread = feed(stdin, null_names(items))
+            status = stdout.channel.recv_exit_status()
+            thread.join()
+            if status != 0:
+                raise Exception(stderr.read().decode('utf-8'))
@@ -1,16 +1,28 @@
+import os
+import shlex
 
 import lib
-from process.common import AbstractProcess
+import metrics
+from process.common import (AbstractProcess, RELAY_BUFFER_SIZE, feed,
+                            local_path)
+from process.replace import replacer
 
 class DestDoDBBackupProcess(AbstractProcess):
     """Creates the wp backup for the database"""
+    inputs = ('dest:wpath', 'conf:wp-config', 'conf:tables')
+    outputs = ('dest:db',)
 
     def init(self):
         self.target = AbstractProcess.DEST
         self.name = 'Creating wordpress database dump from source'
 
     def execute(self, args, conf):
-        ssh = AbstractProcess.CONS[self.target]
+        # wp replaces the tables where they are, they only go through this
+        # machine when it is asked for
+        if args.search_replace == 'builtin':
+            self._replace_locally(args, conf)
+            return
+        ssh = self.cons[self.target]
         cmd = ('wp --allow-root --path={} search-replace --network --precise '
                '{} {} {}'
                .format(args.dest_wpath,
@@ -23,17 +35,80 @@ class DestDoDBBackupProcess(AbstractProcess):
         if status != 0:
             raise Exception(stderr.read().decode('utf-8'))
 
+    def _replace_locally(self, args, conf):
+        """Exports the tables into this machine replacing the url while
+        they are received, then imports them back
+        The import does not start before the export ends, mysqldump keeps
+        the tables locked meanwhile
+        """
+        ssh = self.cons[self.target]
+        dump = local_path(args, 'mysql.fix.dump')
+        engine = replacer(args, conf)
+        cmd = ('wp --allow-root --path={} db export --add-drop-table '
+               '--tables={} -'.format(args.dest_wpath,
+                                      ','.join(conf['tables'])))
+        lib.log.debug(cmd)
+        _, stdout, stderr = ssh.exec_command(cmd)
+        progress = metrics.Progress(self.name, self._size(args, conf))
+        try:
+            with open(dump, 'wb') as file:
+                while True:
+                    data = stdout.channel.recv(RELAY_BUFFER_SIZE)
+                    if not data:
+                        break
+                    file.write(engine.feed(data))
+                    self.add_bytes(len(data))
+                    progress.update(len(data))
+                file.write(engine.close())
+        except Exception:
+            engine.abort()
+            raise
+        if stdout.channel.recv_exit_status() != 0:
+            raise Exception(stderr.read().decode('utf-8'))
+
+        cmd = 'wp --allow-root --path={} db import -'.format(args.dest_wpath)
+        lib.log.debug(cmd)
+        stdin, stdout, stderr = ssh.exec_command(cmd)
+        with open(dump, 'rb') as file:
+            thread = feed(stdin, iter(lambda: file.read(RELAY_BUFFER_SIZE),
+                                      b''))
+            status = stdout.channel.recv_exit_status()
+            thread.join()
+        if status != 0:
+            raise Exception(stderr.read().decode('utf-8'))
+        self.add_bytes(os.path.getsize(dump))
+        os.remove(dump)
+
+    def _size(self, args, conf):
+        """Returns the size of the data of the tables, which is about the
+        size of their dump, or None when it is not known
+        """
+        sql = ("SELECT SUM(data_length) FROM information_schema.tables "
+               "WHERE table_schema = DATABASE() AND table_name IN ({});"
+               .format(', '.join("'{}'".format(table)
+                                 for table in conf['tables'])))
+        cmd = ('wp --allow-root --path={} db query {} --skip-column-names'
+               .format(args.dest_wpath, shlex.quote(sql)))
+        lib.log.debug(cmd)
+        _, stdout, _ = self.cons[self.target].exec_command(cmd)
+        content = stdout.read().decode('utf-8').strip()
+        if stdout.channel.recv_exit_status() != 0 or not content.isdigit():
+            return None
+        return int(content)
+
 
 class DestGetTableListProcess(AbstractProcess):
     """Gathers the list of tables
     """
+    inputs = ('dest:wpath',)
+    outputs = ('conf:tables',)
 
     def init(self):
         self.target = AbstractProcess.DEST
         self.name = 'Get list of tables from destination'
 
     def execute(self, args, conf):
-        ssh = AbstractProcess.CONS[self.target]
+        ssh = self.cons[self.target]
         cmd = ('wp --allow-root --path={} db tables \'wp_*\' --format=csv'
                .format(args.dest_wpath))
         lib.log.debug(cmd)
@@ -0,0 +1,231 @@
+import re
+import shlex
+
+import lib
+from process.common import AbstractProcess
+
+# Tables of a network with the rows of every site, and the condition of the
+# rows which belong to the selected ones. {ids} are the blog ids of the
+# sites and {keys} the meta keys of the roles of their users
+NETWORK_ROWS = {
+    'wp_blogs': 'blog_id IN ({ids})',
+    'wp_blogmeta': 'blog_id IN ({ids})',
+    'wp_blog_versions': 'blog_id IN ({ids})',
+    'wp_registration_log': 'blog_id IN ({ids})',
+    'wp_users': ('ID IN (SELECT user_id FROM wp_usermeta '
+                 'WHERE meta_key IN ({keys}))'),
+    'wp_usermeta': ('user_id IN (SELECT user_id FROM wp_usermeta '
+                    'WHERE meta_key IN ({keys}))'),
+}
+# The users are shared by every site of the destination, the ones it
+# already has keep their rows. A user is the same one in both networks when
+# it has the same id and login, the merge is refused otherwise
+NETWORK_USERS = ('wp_users', 'wp_usermeta')
+# Temporary table the user meta is imported into, its rows are copied to
+# wp_usermeta without their ids, which differ between the two networks:
+# the meta of the selected sites, deleted first, and all the meta of the
+# users new to the destination
+USERMETA_STAGE = 'wp_usermeta_merge'
+USERMETA_COPY = ('INSERT INTO `wp_usermeta` (user_id, meta_key, meta_value) '
+                 'SELECT user_id, meta_key, meta_value FROM `{stage}` '
+                 'WHERE ({meta}) OR user_id NOT IN '
+                 '(SELECT user_id FROM `wp_usermeta`);')
+# Users listed when they do not match
+REPORT_USERS = 10
+# Tables of the network the destination keeps when sites are selected
+NETWORK_TABLES = ('wp_site', 'wp_sitemeta', 'wp_signups')
+SITE_TABLE = re.compile(r'^wp_(\d+)_')
+
+
+def table_blog(table):
+    """Returns the blog id of a table, the tables without one belong to the
+    main site, which is the blog 1. The tables of the network return None
+    """
+    if table in NETWORK_ROWS or table in NETWORK_TABLES:
+        return None
+    match = SITE_TABLE.match(table)
+    return match.group(1) if match else '1'
+
+
+def _roles_key(blog):
+    return 'wp_capabilities' if blog == '1' else 'wp_{}_capabilities'.format(
+        blog)
+
+
+def _meta_condition(blogs):
+    """Returns the condition of the user meta of the sites, which have the
+    prefix of their tables. The prefix of the main site is the one of the
+    network, without a blog id after it
+    """
+    conditions = list()
+    others = [blog for blog in blogs if blog != '1']
+    if others:
+        conditions.append("meta_key REGEXP '^wp_({})_'".format(
+            '|'.join(others)))
+    if '1' in blogs:
+        conditions.append("(meta_key REGEXP '^wp_' AND "
+                          "meta_key NOT REGEXP '^wp_[0-9]+_')")
+    return ' OR '.join(conditions)
+
+
+def merge_rows(table, condition, blogs, sites):
+    """Returns how the rows of a network table matching the condition are
+    merged into the destination: the condition of the rows deleted first,
+    None to delete nothing, the mode of the insert and the statements run
+    after it
+    The sites moved to another domain get it in wp_blogs with the root path,
+    a site of a subdirectory network keeps its domain and its path apart
+    """
+    after = list()
+    if table == 'wp_blogs':
+        for blog in blogs:
+            domain = sites[blog][1]
+            if domain:
+                after.append("UPDATE `wp_blogs` SET domain = '{}', "
+                             "path = '/' WHERE blog_id = {};".format(
+                                 domain.replace("'", "''"), blog))
+    if table == 'wp_users':
+        return {'where': condition, 'delete': None, 'merge': 'ignore',
+                'after': after}
+    if table == 'wp_usermeta':
+        meta = _meta_condition(blogs)
+        return {'where': condition, 'delete': meta, 'merge': None,
+                'stage': USERMETA_STAGE,
+                'after': [USERMETA_COPY.format(stage=USERMETA_STAGE,
+                                               meta=meta)]}
+    return {'where': condition, 'delete': condition, 'merge': 'replace',
+            'after': after}
+
+
+def _quote(value):
+    return "'{}'".format(value.replace('\\', '\\\\').replace("'", "''"))
+
+
+def _users(ssh, wpath, sql):
+    """Returns the id -> login of the users printed by the sql"""
+    cmd = 'wp --allow-root --path={} db query {} --skip-column-names'.format(
+        wpath, shlex.quote(sql))
+    lib.log.debug(cmd)
+    _, stdout, stderr = ssh.exec_command(cmd)
+    content = stdout.read().decode('utf-8')
+    if stdout.channel.recv_exit_status() != 0:
+        raise Exception(stderr.read().decode('utf-8'))
+    users = dict()
+    for line in content.split('\n'):
+        items = line.split('\t')
+        if len(items) == 2:
+            users[items[0]] = items[1]
+    return users
+
+
+def user_conflicts(src, dest):
+    """Returns the users of the source whose id or login belong to another
+    user of the destination
+    """
+    logins = {login: user for user, login in dest.items()}
+    return sorted(
+        '{} ({})'.format(login, user) for user, login in src.items()
+        if dest.get(user, login) != login or
+        logins.get(login, user) != user)
+
+
+def select_sites(args, blogs):
+    """Returns the sites of the network selected by the arguments, a dict of
+    blog id -> [url, domain in the destination or None]
+    A site is given by its blog id or by its url, the domain and the path
+    without the last slash, optionally followed by =domain
+    """
+    urls = {str(blog): (domain + path).rstrip('/')
+            for blog, domain, path in blogs}
+    sites = dict()
+    for item in args.site:
+        name, _, domain = item.partition('=')
+        found = [blog for blog, url in urls.items() if name in (blog, url)]
+        if not found:
+            raise Exception('There is no site "{}" in the source network'
+                            .format(name))
+        sites[found[0]] = [urls[found[0]], domain or None]
+    return sites
+
+
+def upload_rules(sites):
+    """Returns the exclude and the include patterns which leave out the
+    uploads of the sites not selected
+    The uploads of the main site are the rest of the uploads directory
+    """
+    includes = ['wp-content/blogs.dir/{}'.format(blog) for blog in sites]
+    includes += ['wp-content/uploads/sites/{}'.format(blog) for blog in sites
+                 if blog != '1']
+    uploads = 'sites/*' if '1' in sites else '*'
+    return ['wp-content/blogs.dir/*', 'wp-content/uploads/' + uploads], \
+        includes
+
+
+def site_domains(conf):
+    """Returns the (url, domain) pairs of the sites given a domain of their
+    own in the destination
+    """
+    return [(url, domain) for url, domain in conf.get('sites', dict()).values()
+            if domain]
+
+
+class SrcSelectSitesProcess(AbstractProcess):
+    """Narrows the migration to the sites of the network selected by the
+    arguments
+    Only the tables of those sites are migrated, and the rows of the network
+    tables which belong to them are merged into the destination ones, so
+    the destination keeps its other sites and its users. The uploads of the
+    other sites are left out of the files
+    """
+    inputs = ('conf:tables', 'conf:blogs', 'ssh:dest')
+    outputs = ('conf:tables', 'conf:sites', 'conf:site_rows')
+
+    def init(self):
+        self.target = AbstractProcess.SRC
+        self.name = 'Selecting sites of source network'
+
+    def execute(self, args, conf):
+        if not conf.get('blogs'):
+            raise Exception('The source is not a multisite network, the '
+                            'sites can not be selected')
+        conf['sites'] = select_sites(args, conf['blogs'])
+        blogs = sorted(conf['sites'], key=int)
+        ids = ', '.join(blogs)
+        keys = ', '.join("'{}'".format(_roles_key(blog)) for blog in blogs)
+        conf['site_rows'] = {
+            table: merge_rows(table, condition.format(ids=ids, keys=keys),
+                              blogs, conf['sites'])
+            for table, condition in NETWORK_ROWS.items()
+            if table in conf['tables']}
+        if 'wp_users' in conf['site_rows']:
+            self._check_users(args, conf['site_rows']['wp_users']['where'])
+        conf['tables'] = [table for table in conf['tables']
+                          if table_blog(table) in conf['sites']]
+        lib.log.info('%d of %d sites selected, %d tables', len(blogs),
+                     len(conf['blogs']), len(conf['tables']))
+
+    def _check_users(self, args, condition):
+        """Refuses to merge the users of the selected sites when the
+        destination has other users with their ids or their logins, their
+        rows and the ones of their meta would be mixed up
+        """
+        src = _users(self.cons[self.target], args.src_wpath,
+                     'SELECT ID, user_login FROM wp_users WHERE {};'
+                     .format(condition))
+        if not src:
+            return
+        dest = _users(self.cons[AbstractProcess.DEST], args.dest_wpath,
+                      'SELECT ID, user_login FROM wp_users WHERE ID IN ({}) '
+                      'OR user_login IN ({});'.format(
+                          ', '.join(src),
+                          ', '.join(_quote(login)
+                                    for login in src.values())))
+        conflicts = user_conflicts(src, dest)
+        if conflicts:
+            raise Exception('{} users of the selected sites have the id or '
+                            'the login of another user of the destination, '
+                            'they can not be merged: {}'.format(
+                                len(conflicts),
+                                ', '.join(conflicts[:REPORT_USERS])))
+        lib.log.info('%d users of the selected sites, %d of them already in '
+                     'the destination', len(src), len(dest))
@@ -0,0 +1,324 @@
+import os
+import shlex
+import shutil
+import statistics
+import time
+
+import lib
+import scheduler
+from process.common import AbstractProcess, files_path
+from process.compression import (NONE, PROBE_SIZE, direct_link, link_speed,
+                                 make_sample, measure)
+from process.database import selection
+from process.replace import local_replace
+
+# Round trips timed to measure the latency of every machine
+LATENCY_SAMPLES = 5
+# Tables listed by the plan
+REPORT_TABLES = 10
+
+# Bytes per second assumed for the work which does not cross the link, the
+# estimates only need to get their order of magnitude right
+DISK_RATE = 100 * 1024 * 1024
+EXPORT_RATE = 30 * 1024 * 1024
+IMPORT_RATE = 10 * 1024 * 1024
+REPLACE_RATE = 40 * 1024 * 1024
+# Remote commands of a step besides its work
+STEP_COMMANDS = 2
+
+# Where every step writes the archive of the files, the dump of the
+# database or the site: the temporary directory of the source or of the
+# destination, the work directory of this machine or the wordpress path of
+# the destination. next is the machine the source sends its files to, the
+# destination with fast copy and this machine otherwise, and relay is this
+# machine unless the data goes with fast copy. The delta flow writes the
+# changed files over the ones the destination already has
+STAGED = {
+    'SrcDoTarProcess': [('src', 'files')],
+    'SrcDoDBBackupProcess': [('src', 'db')],
+    'SrcDownloadTarProcess': [('next', 'files')],
+    'SrcDownloadCachedTarProcess': [('local', 'files')],
+    'SrcDownloadDBBackupProcess': [('next', 'db')],
+    'LocalReplaceDumpProcess': [('local', 'db')],
+    'DestUploadDatabaseDumpProcess': [('dest', 'db')],
+    'DestUploadTarProcess': [('dest', 'files')],
+    'DestParallelDatabaseProcess': [('src', 'db'), ('relay', 'db'),
+                                    ('dest', 'db')],
+    'DestDecompressWordpressProcess': [('site', 'site')],
+    'DestStreamWordpressProcess': [('site', 'site')],
+}
+
+
+def costs(facts):
+    """Returns the bytes transferred and the seconds of the work of every
+    step, by step, given the facts measured by the plan
+    The transfers of the delta flow and of the cache are the whole site, the
+    files which changed are not known before the manifests are built
+    """
+    files = facts['files'] * facts['ratio']
+    db = facts['db'] * facts['ratio']
+    down, up = facts['down'], facts['up']
+    relay = min(down, up)
+    export = facts['db'] / EXPORT_RATE / facts['db_workers']
+    load = facts['db'] / IMPORT_RATE / facts['db_workers']
+    replace = facts['replace']
+    # The units of the parallel flow are downloaded and uploaded again
+    # unless they go with fast copy, and they are transferred while other
+    # units are exported and imported
+    relayed = 1 if facts['fast_copy'] else 2
+    units = db / down + (0 if facts['fast_copy'] else db / up)
+    return {
+        'SrcResolveCompressionProcess': (0, facts['sample'] / down),
+        'SrcChecksumDatabaseProcess': (0, facts['db'] / DISK_RATE),
+        'SrcDoDBBackupProcess': (0, facts['db'] / EXPORT_RATE),
+        'SrcDoTarProcess': (0, facts['files'] / DISK_RATE),
+        'SrcBuildManifestProcess': (0, facts['files'] / DISK_RATE),
+        'DestBuildManifestProcess': (0, facts['files'] / DISK_RATE),
+        'SrcDownloadDBBackupProcess': (db, db / down),
+        'SrcDownloadTarProcess': (files, files / down),
+        'SrcDownloadCachedTarProcess': (files, files / down),
+        'LocalReplaceDumpProcess': (0, replace),
+        'DestUploadDatabaseDumpProcess': (db, db / up),
+        'DestUploadTarProcess': (files, files / up),
+        'DestDecompressWordpressProcess': (0, facts['files'] / DISK_RATE),
+        'DestStreamWordpressProcess': (
+            files, max(files / relay, facts['files'] / DISK_RATE)),
+        'DestSyncDeltaProcess': (files, files / relay),
+        'DestImportDBDumpProcess': (0, facts['db'] / IMPORT_RATE),
+        'DestStreamDatabaseProcess': (
+            db, max(db / relay, export, load, replace)),
+        'DestParallelDatabaseProcess': (
+            db * relayed, max(units, export + load + replace)),
+        'VerifySitesProcess': (
+            0, (facts['files'] + facts['db']) / DISK_RATE),
+    }
+
+
+def critical_path(steps, seconds, jobs):
+    """Returns the seconds of the longest chain of steps which wait for
+    each other, the scheduler runs the rest at the same time
+    """
+    depends = scheduler.Scheduler(steps, list(), jobs).depends
+    finish = dict()
+    for step in steps:
+        finish[step] = seconds[step] + max(
+            (finish[item] for item in depends[step]), default=0)
+    return max(finish.values(), default=0)
+
+
+def df_command(path):
+    """Returns the command which prints the file system of path, or of its
+    closest parent when it does not exist yet, and its free space
+    """
+    return ('p={}; while [ ! -e "$p" ]; do p=$(dirname "$p"); done; '
+            'df -Pk "$p" | tail -n 1'.format(shlex.quote(path)))
+
+
+def _exec(ssh, cmd, data=None):
+    lib.log.debug(cmd)
+    stdin, stdout, stderr = ssh.exec_command(cmd)
+    if data is not None:
+        stdin.write(data)
+        stdin.flush()
+        stdin.channel.shutdown_write()
+    content = stdout.read().decode('utf-8')
+    status = stdout.channel.recv_exit_status()
+    if status != 0:
+        raise Exception(stderr.read().decode('utf-8'))
+    return content
+
+
+def _latency(ssh):
+    """Returns the median seconds of a remote command which does nothing"""
+    times = list()
+    for _ in range(LATENCY_SAMPLES):
+        start = time.time()
+        _exec(ssh, 'true')
+        times.append(time.time() - start)
+    return statistics.median(times)
+
+
+def _upload_speed(ssh, size):
+    """Returns the bytes per second from this machine to a remote one"""
+    data = os.urandom(size)
+    start = time.time()
+    _exec(ssh, 'cat > /dev/null', data)
+    return size / max(time.time() - start, 1e-9)
+
+
+class PlanMigrationProcess(AbstractProcess):
+    """Estimates the bytes and the time of every step of a migration
+    without running them
+    The link is measured with a sample of the source files, the sizes of
+    the files and the tables come from the scan and the probe, and the
+    steps are the ones the migration would run with the same arguments.
+    Nothing is installed in the machines, with fast copy the link from the
+    source to the destination is only measured when the source already has
+    the key of the destination.
+    The free space of the places the migration writes to is checked against
+    the archives, the dumps and the site staged in them
+    """
+    inputs = ('conf:files', 'conf:tables', 'conf:table_sizes',
+              'conf:compression', 'ssh:dest')
+
+    def __init__(self, steps):
+        super().__init__()
+        # Steps of the migration being planned
+        self.steps = steps
+
+    def init(self):
+        self.target = AbstractProcess.SRC
+        self.name = 'Planning migration'
+
+    def execute(self, args, conf):
+        for step in self.steps:
+            step.init()
+        facts = self._facts(args, conf)
+        work = costs(facts)
+        seconds = dict()
+        plan = list()
+        lib.log.info('Steps of the migration:')
+        for step in self.steps:
+            size, elapsed = work.get(step.key, (0, 0))
+            latency = facts['latency'][step.target]
+            seconds[step] = elapsed + latency * STEP_COMMANDS
+            plan.append({'key': step.key, 'name': step.name, 'bytes': size,
+                         'seconds': seconds[step]})
+            lib.log.info('%10.1f MB %9.1f s  %s', size / 1024 / 1024,
+                         seconds[step], step.name)
+        total = critical_path(self.steps, seconds, args.jobs)
+        lib.log.info('Estimated time %.0f s with the steps running at the '
+                     'same time, %.0f s one after the other', total,
+                     sum(seconds.values()))
+        self.stats.info['plan'] = {'steps': plan, 'seconds': total}
+        self._check_space(args, facts)
+
+    def _facts(self, args, conf):
+        """Measures the link and gathers the sizes the estimates need"""
+        ssh = self.cons[AbstractProcess.SRC]
+        ssh_dest = self.cons[AbstractProcess.DEST]
+        setting = conf.get('compression', NONE)
+        direct = direct_link(ssh, args)
+        if args.fast_copy and not direct:
+            lib.log.info('The source can not connect to the destination yet, '
+                         'the link is measured through this machine')
+        probe, sample = make_sample(ssh, args)
+        try:
+            down = (link_speed(ssh, args, probe, sample, direct)
+                    if sample else 0)
+            ratio = 1.0
+            if sample and setting['codec'] != 'none':
+                size, _ = measure(ssh, probe, setting['codec'],
+                                  setting['level'])
+                ratio = size / sample
+        finally:
+            _exec(ssh, 'rm -f {}'.format(probe))
+        if direct:
+            # The data goes from the source straight to the destination
+            up = down
+        else:
+            up = _upload_speed(ssh_dest, PROBE_SIZE)
+        # A site too small for a sample is transferred in no time
+        down = down or up
+        if args.fast_copy and not direct:
+            # The source would send its data at the pace of the slowest link
+            down = up = min(down, up)
+        latency = {AbstractProcess.SRC: _latency(ssh),
+                   AbstractProcess.DEST: _latency(ssh_dest)}
+        lib.log.info('Link %.1f MB/s from the source, %.1f MB/s to the '
+                     'destination, %.0f ms and %.0f ms per command',
+                     down / 1024 / 1024, up / 1024 / 1024,
+                     latency[AbstractProcess.SRC] * 1000,
+                     latency[AbstractProcess.DEST] * 1000)
+        files = conf.get('files', {'count': 0, 'bytes': 0})
+        lib.log.info('Files: %d files, %.1f MB', files['count'],
+                     files['bytes'] / 1024 / 1024)
+        db = self._database(args, conf)
+        # This machine replaces the urls of the dumps in its workers
+        replace = 0
+        if local_replace(args):
+            replace = db / REPLACE_RATE / args.replace_workers
+        return {'files': files['bytes'], 'db': db, 'ratio': ratio,
+                'down': down, 'up': up, 'latency': latency,
+                'sample': sample if args.compression == 'auto' else 0,
+                'fast_copy': args.fast_copy, 'db_workers': args.db_workers,
+                'replace': replace}
+
+    def _database(self, args, conf):
+        """Logs the biggest tables with their rows, returns the size of the
+        tables exported with their rows
+        """
+        whole, filtered, _ = selection(args, conf['tables'])
+        tables = whole + [table for table, _ in filtered]
+        sizes = conf.get('table_sizes', dict())
+        sql = ('SELECT table_name, table_rows FROM information_schema.tables '
+               'WHERE table_schema = DATABASE();')
+        rows = dict()
+        output = _exec(self.cons[AbstractProcess.SRC],
+                       'wp --allow-root --path={} db query {} '
+                       '--skip-column-names'.format(args.src_wpath,
+                                                    shlex.quote(sql)))
+        for line in output.split('\n'):
+            items = line.split('\t')
+            if len(items) == 2 and items[1].isdigit():
+                rows[items[0]] = int(items[1])
+        total = sum(sizes.get(table, 0) for table in tables)
+        lib.log.info('Database: %d tables, %.1f MB, about %d rows',
+                     len(tables), total / 1024 / 1024,
+                     sum(rows.get(table, 0) for table in tables))
+        for table in sorted(tables, key=lambda item: sizes.get(item, 0),
+                            reverse=True)[:REPORT_TABLES]:
+            lib.log.info('%10.1f MB %10d rows  %s',
+                         sizes.get(table, 0) / 1024 / 1024,
+                         rows.get(table, 0), table)
+        return total
+
+    def _check_space(self, args, facts):
+        """Warns about the file systems which can not hold what the
+        migration stages in them
+        """
+        sizes = {'files': facts['files'] * facts['ratio'],
+                 'db': facts['db'] * facts['ratio'], 'site': facts['files']}
+        places = {'src': ('src', args.tmp_dir), 'dest': ('dest', args.tmp_dir),
+                  'site': ('dest', files_path(args)),
+                  'local': ('local', args.work_dir),
+                  'next': ('dest', args.tmp_dir) if args.fast_copy
+                  else ('local', args.work_dir),
+                  'relay': None if args.fast_copy
+                  else ('local', args.work_dir)}
+        needed = dict()
+        for step in self.steps:
+            for place, kind in STAGED.get(step.key, list()):
+                if places[place] is not None:
+                    needed[places[place]] = (needed.get(places[place], 0) +
+                                             sizes[kind])
+        # The places in the same file system share its free space
+        systems = dict()
+        for (machine, path), size in needed.items():
+            mount, free = self._free(machine, path)
+            system = systems.setdefault((machine, mount),
+                                        {'free': free, 'needed': 0,
+                                         'paths': list()})
+            system['needed'] += size
+            system['paths'].append(path)
+        for (machine, mount), system in sorted(systems.items()):
+            paths = ', '.join(system['paths'])
+            lib.log.info('%s:%s %.1f MB needed, %.1f MB free', machine, paths,
+                         system['needed'] / 1024 / 1024,
+                         system['free'] / 1024 / 1024)
+            if system['needed'] > system['free']:
+                lib.log.warning('%s:%s can not hold the %.1f MB staged in '
+                                'it, only %.1f MB are free', machine, paths,
+                                system['needed'] / 1024 / 1024,
+                                system['free'] / 1024 / 1024)
+
+    def _free(self, machine, path):
+        """Returns the mount point of the file system of a path and its free
+        bytes
+        """
+        if machine == 'local':
+            return os.path.abspath(path), shutil.disk_usage(path).free
+        target = (AbstractProcess.SRC if machine == 'src'
+                  else AbstractProcess.DEST)
+        fields = _exec(self.cons[target], df_command(path)).split()
+        return fields[-1], int(fields[3]) * 1024
@@ -0,0 +1,187 @@
+import threading
+import time
+
+import paramiko
+from paramiko import SSHClient, SSHException, Transport
+
+import lib
+
+
+class Connection(object):
+    """Pooled ssh connection with the SSHClient methods the processes use
+    The client is connected again when its transport dropped, and the
+    channels open at the same time are limited by a semaphore which is
+    released when the remote command exits or the channel is closed
+    """
+
+    def __init__(self, args, direction):
+        self.args = args
+        self.direction = direction
+        self.client = None
+        # Amount of times the client was connected
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.channels = threading.BoundedSemaphore(args.max_channels)
+
+    @property
+    def dropped(self):
+        """Checks if the transport was connected and it is not active now"""
+        if self.client is None:
+            return False
+        transport = self.client.get_transport()
+        return transport is None or not transport.is_active()
+
+    def connect(self):
+        """Connects the client when it is not connected or it dropped
+        A failed connection is tried again args.retries times
+        """
+        with self.lock:
+            if self.client is not None:
+                if not self.dropped:
+                    return self.client
+                lib.log.warning('Connection to %s dropped, reconnecting',
+                                self._option('address'))
+                self.client.close()
+                self.client = None
+            for attempt in range(self.args.retries + 1):
+                try:
+                    self.client = self._connect()
+                    break
+                except Exception as exc:
+                    if attempt == self.args.retries:
+                        raise Exception('Unable to connect to {}: {}'.format(
+                            self._option('address'), exc))
+                    lib.log.warning('Unable to connect to %s, retrying: %s',
+                                    self._option('address'), exc)
+                    time.sleep(2 ** attempt)
+            self.generation += 1
+            return self.client
+
+    def _option(self, name):
+        return self.args.__getattribute__(self.direction + '_' + name)
+
+    def _transport(self, sock, disabled_algorithms=None):
+        """Creates the transport with the tuned window and packet sizes
+        The ciphers in args.ciphers are moved to the front of the ones the
+        transport offers, so the server still picks another one when it
+        does not support them
+        """
+        transport = Transport(
+            sock, disabled_algorithms=disabled_algorithms,
+            default_window_size=self.args.window_size * 1024 * 1024,
+            default_max_packet_size=self.args.packet_size * 1024)
+        options = transport.get_security_options()
+        preferred = [item for item in self.args.ciphers.split(',')
+                     if item in options.ciphers]
+        options.ciphers = preferred + [item for item in options.ciphers
+                                       if item not in preferred]
+        return transport
+
+    def _connect(self):
+        ssh = SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.load_system_host_keys()
+        port = self._option('port')
+        if isinstance(port, str):
+            port = int(port)
+        user = self._option('user')
+        passw = self._option('passw')
+        fkey = self._option('filekey')
+        lib.log.info('Connecting to %s', self._option('address'))
+        # The key type is detected from the key file
+        ssh.connect(self._option('address'), port=port, username=user or None,
+                    password=passw or None,
+                    key_filename=None if passw else fkey or None,
+                    compress=self.args.ssh_compression,
+                    transport_factory=self._transport)
+        ssh.get_transport().set_keepalive(self.args.keepalive)
+        lib.log.info('Connection successful')
+        return ssh
+
+    def _release(self, channel, done=None):
+        """Releases the channel slot when the channel is done
+        done is called at that moment when it is given
+        """
+        def waiter():
+            channel.status_event.wait()
+            self.channels.release()
+            if done is not None:
+                done()
+        threading.Thread(target=waiter, daemon=True).start()
+
+    def _open(self, method):
+        """Opens a channel calling method with the client
+        It connects again once when the transport dropped
+        """
+        self.channels.acquire()
+        try:
+            for attempt in range(2):
+                client = self.connect()
+                try:
+                    return method(client)
+                except SSHException:
+                    if attempt or client.get_transport().is_active():
+                        raise
+        except Exception:
+            self.channels.release()
+            raise
+
+    def exec_command(self, command, timeout=None, done=None):
+        result = self._open(lambda client: client.exec_command(
+            command, timeout=timeout))
+        self._release(result[1].channel, done)
+        return result
+
+    def open_sftp(self):
+        sftp = self._open(lambda client: client.open_sftp())
+        self._release(sftp.get_channel())
+        return sftp
+
+    def get_transport(self):
+        return self.connect().get_transport()
+
+    def close(self):
+        with self.lock:
+            if self.client is not None:
+                self.client.close()
+                self.client = None
+
+
+class ConnectionPool(object):
+    """Keeps the ssh connections by host, port and user
+    The processes of a migration, and the migrations of a fleet, share the
+    connections to the same machine
+    """
+
+    def __init__(self):
+        self.cons = dict()
+        self.lock = threading.Lock()
+
+    def get(self, args, direction, idx=0):
+        """Returns a connection to the machine of a direction
+        Connections with another idx go to the same machine through another
+        transport
+        """
+        key = (args.__getattribute__(direction + '_address'),
+               int(args.__getattribute__(direction + '_port')),
+               args.__getattribute__(direction + '_user'), idx)
+        with self.lock:
+            if key not in self.cons:
+                self.cons[key] = Connection(args, direction)
+            con = self.cons[key]
+        con.connect()
+        return con
+
+    @property
+    def drops(self):
+        """Amount of transports which dropped, reconnected or not"""
+        with self.lock:
+            cons = list(self.cons.values())
+        return sum(max(con.generation - 1, 0) + int(con.dropped)
+                   for con in cons)
+
+    def close(self):
+        with self.lock:
+            for con in self.cons.values():
+                con.close()
+            self.cons.clear()
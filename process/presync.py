@@ -0,0 +1,145 @@
+import json
+import os.path
+import shlex
+
+import lib
+from process.common import AbstractProcess, AsyncProcess, local_path
+from process.database import plan
+
+
+# Columns which wordpress updates on every write of a row, the tables which
+# have them are compared by these columns instead of their whole rows
+MODIFIED = {'_posts': ('`post_modified_gmt`',),
+            '_comments': ('`comment_date_gmt`', '`comment_approved`')}
+
+
+def _presync_file(args):
+    return local_path(args, '.presync.json')
+
+
+def _modified(table, columns):
+    """Returns the modification columns of the table, or None when it does
+    not have them"""
+    for suffix, modified in MODIFIED.items():
+        if table.endswith(suffix) and set(modified) <= set(columns):
+            return list(modified)
+    return None
+
+
+def range_sql(key, table, columns, condition):
+    """Returns the sql which prints the key, the rows and a checksum of the
+    rows of the table matching the condition
+    Every row is hashed with its columns and which of them are null
+    """
+    nulls = 'CONCAT({})'.format(', '.join('ISNULL({})'.format(column)
+                                          for column in columns))
+    row = "CONCAT_WS('#', {}, {})".format(', '.join(columns), nulls)
+    return ("SELECT '{}', COUNT(*), COALESCE(BIT_XOR(CAST(CONV(LEFT(MD5({}), "
+            "16), 16, 10) AS UNSIGNED)), 0) FROM `{}` WHERE {}"
+            .format(key, row, table, condition))
+
+
+class SrcChecksumDatabaseProcess(AsyncProcess):
+    """Takes the checksums of the tables and of the ranges of the chunked
+    tables in the source
+    The presync keeps them in the work directory along with the ranges of
+    the chunked tables. The cutover takes them again and marks as imported
+    the tables and the ranges which did not change, so only the ones
+    modified since the presync are migrated again. The checksums are taken
+    before the export, a row changed meanwhile is migrated again. The posts
+    and the comments are only hashed by their modification columns, which
+    is much faster than hashing their contents while the source is frozen
+    """
+    inputs = ('conf:tables', 'conf:table_sizes', 'conf:table_keys')
+    outputs = ('conf:table_sizes', 'conf:table_keys', 'conf:database:done')
+
+    def init(self):
+        self.target = AbstractProcess.SRC
+        self.name = 'Taking checksums of source database'
+
+    async def run(self, args, conf):
+        if args.phase == 'cutover':
+            if not os.path.exists(_presync_file(args)):
+                raise Exception('There is no presync in {}, the cutover '
+                                'needs it'.format(args.work_dir))
+            with open(_presync_file(args)) as file:
+                presync = json.load(file)
+            # The ranges are the ones of the presync, the new tables are
+            # migrated whole
+            conf['table_keys'] = {name: key for name, key in
+                                  presync['keys'].items()
+                                  if name in conf['tables']}
+            conf['table_sizes'].update(presync['sizes'])
+        units = plan(args, conf, list())
+        checksums = await self._checksums(args, units)
+        if args.phase == 'presync':
+            with open(_presync_file(args), 'w') as file:
+                file.write(json.dumps({'keys': conf['table_keys'],
+                                       'sizes': conf['table_sizes'],
+                                       'checksums': checksums}))
+            return
+        changed = [key for key, value in checksums.items()
+                   if presync['checksums'].get(key) != value]
+        lib.log.info('%d of %d tables and ranges changed since the '
+                     'presync', len(changed), len(checksums))
+        # The chunked tables were created by the presync
+        conf['database:done'] = [':schema'] + [key for key in checksums
+                                               if key not in changed]
+
+    async def _checksums(self, args, units):
+        """Returns the checksum of every table and range of the units"""
+        tables = [table for unit in units
+                  if 'where' not in unit and not unit.get('schema')
+                  for table in unit['tables']]
+        ranges = [unit for unit in units if 'where' in unit]
+        checksums = dict()
+        candidates = [table for table in tables
+                      if table.endswith(tuple(MODIFIED))]
+        columns = (await self._columns(args, set(candidates))
+                   if candidates else dict())
+        # The tables with modification columns are hashed like a range
+        # covering all their rows
+        whole = [table for table in candidates
+                 if _modified(table, columns[table])]
+        ranges += [{'done': [table], 'tables': [table], 'where': '1=1'}
+                   for table in whole]
+        tables = [table for table in tables if table not in whole]
+        if tables:
+            sql = 'CHECKSUM TABLE {};'.format(', '.join(
+                '`{}`'.format(table) for table in tables))
+            # CHECKSUM TABLE prints the table with the name of the database
+            for table, line in zip(tables, await self._query(args, sql)):
+                checksums[table] = line.split('\t')[-1]
+        if ranges:
+            columns = await self._columns(
+                args, set(unit['tables'][0] for unit in ranges))
+            for table in columns:
+                columns[table] = (_modified(table, columns[table]) or
+                                  columns[table])
+            sql = ' UNION ALL '.join(
+                range_sql(unit['done'][0], unit['tables'][0],
+                          columns[unit['tables'][0]], unit['where'])
+                for unit in ranges) + ';'
+            for line in await self._query(args, sql):
+                key, rows, checksum = line.split('\t')
+                checksums[key] = '{}:{}'.format(rows, checksum)
+        return checksums
+
+    async def _columns(self, args, tables):
+        """Returns the quoted columns of every table in their order"""
+        sql = ("SELECT table_name, column_name "
+               "FROM information_schema.columns "
+               "WHERE table_schema = DATABASE() AND table_name IN ({}) "
+               "ORDER BY table_name, ordinal_position;".format(
+                   ', '.join("'{}'".format(table) for table in tables)))
+        columns = {table: list() for table in tables}
+        for line in await self._query(args, sql):
+            table, column = line.split('\t')
+            columns[table].append('`{}`'.format(column))
+        return columns
+
+    async def _query(self, args, sql):
+        output = await self.command(
+            args, 'wp --allow-root --path={} db query {} --skip-column-names'
+            .format(args.src_wpath, shlex.quote(sql)))
+        return [line for line in output.decode('utf-8').split('\n') if line]
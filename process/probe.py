@@ -0,0 +1,123 @@
+import asyncio
+import json
+import re
+import shlex
+
+from process.common import AbstractProcess, AsyncProcess
+
+# Prefix of the line with the facts, the plugins may print other lines
+# while wordpress is loaded
+MARKER = 'WPM-FACTS:'
+
+# Facts of the destination: the database credentials and the site url
+DEST_FACTS = '''
+echo "\\n{marker}" . json_encode(array(
+    "siteurl" => get_option("siteurl"),
+    "DB_NAME" => DB_NAME, "DB_USER" => DB_USER,
+    "DB_PASSWORD" => DB_PASSWORD, "DB_HOST" => DB_HOST)) . "\\n";
+'''
+
+# Facts of the source: the site url, the tables, their sizes, the range
+# of their primary key when it is a single numeric column and the sites of
+# the network
+SRC_FACTS = '''
+global $wpdb;
+$tables = WP_CLI::runcommand("db tables \\"wp_*\\" --format=csv",
+    array("return" => true, "launch" => false));
+$sizes = array();
+foreach ($wpdb->get_results("SELECT table_name, data_length + index_length
+        FROM information_schema.tables
+        WHERE table_schema = DATABASE()", ARRAY_N) as $row) {
+    $sizes[$row[0]] = (int) $row[1];
+}
+$keys = array();
+foreach ($wpdb->get_results("SELECT table_name, MIN(column_name)
+        FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND column_key = 'PRI'
+        GROUP BY table_name HAVING COUNT(*) = 1 AND MIN(data_type) IN
+        ('tinyint', 'smallint', 'mediumint', 'int', 'bigint')",
+        ARRAY_N) as $row) {
+    if (!in_array($row[0], explode(",", trim($tables)))) {
+        continue;
+    }
+    $range = $wpdb->get_row("SELECT MIN(`{$row[1]}`), MAX(`{$row[1]}`)
+        FROM `{$row[0]}`", ARRAY_N);
+    if ($range[0] !== null) {
+        $keys[$row[0]] = array($row[1], (int) $range[0], (int) $range[1]);
+    }
+}
+$blogs = array();
+if (is_multisite()) {
+    foreach ($wpdb->get_results("SELECT blog_id, domain, path
+            FROM {$wpdb->blogs}", ARRAY_N) as $row) {
+        $blogs[] = array((int) $row[0], $row[1], $row[2]);
+    }
+}
+echo "\\n{marker}" . json_encode(array(
+    "siteurl" => get_option("siteurl"), "tables" => $tables,
+    "sizes" => $sizes, "keys" => $keys, "blogs" => $blogs)) . "\\n";
+'''
+
+
+def probe_command(wpath, code):
+    """Returns the command which loads wordpress once and prints the facts
+    gathered by the php code
+    """
+    return 'wp --allow-root --path={} eval {}'.format(
+        wpath, shlex.quote(code.replace('{marker}', MARKER)))
+
+
+def parse_facts(output):
+    """Returns the facts printed by the command of probe_command"""
+    for line in reversed(output.decode('utf-8').splitlines()):
+        if line.startswith(MARKER):
+            return json.loads(line[len(MARKER):])
+    raise Exception('Unable to read the facts of the site: {}'
+                    .format(output.decode('utf-8', 'replace')[-200:]))
+
+
+def _domain(url):
+    return re.sub('http(s)?://', '', url)
+
+
+class ProbeSitesProcess(AsyncProcess):
+    """Gathers the facts of the source and the destination sites
+    Every machine loads wordpress once and prints all of them, both
+    machines are probed at the same time
+    """
+    inputs = ('ssh:src', 'dest:wpath')
+    outputs = ('conf:wp-config', 'conf:db_host', 'conf:tables',
+               'conf:table_sizes', 'conf:table_keys', 'conf:blogs')
+
+    def init(self):
+        self.target = AbstractProcess.DEST
+        self.name = 'Probing source and destination sites'
+
+    async def run(self, args, conf):
+        dest, src = await asyncio.gather(
+            self.command(args, probe_command(args.dest_wpath, DEST_FACTS)),
+            self.command(args, probe_command(args.src_wpath, SRC_FACTS),
+                         target=AbstractProcess.SRC))
+        dest = parse_facts(dest)
+        src = parse_facts(src)
+        conf['wp-config'] = {key: dest[key] for key in
+                             ('DB_NAME', 'DB_USER', 'DB_PASSWORD')}
+        for key in conf['wp-config']:
+            if not conf['wp-config'][key]:
+                raise Exception('Missing field "{}" in wp-config.php in '
+                                'destination machine'.format(key))
+        # The host is only needed to run the mysql client, it is not
+        # replaced in wp-config.php
+        conf['db_host'] = dest['DB_HOST'] or 'localhost'
+        conf['wp-config']['DOMAIN_CURRENT_SITE'] = _domain(dest['siteurl'])
+        conf['wp-config']['SRC_DOMAIN_CURRENT_SITE'] = _domain(src['siteurl'])
+        conf['tables'] = [item for item in src['tables'].strip().split(',')
+                          if item and not (args.no_users and 'user' in item)]
+        # An empty php array is encoded as a list
+        sizes = src['sizes'] or dict()
+        conf['table_sizes'] = {name: size for name, size in sizes.items()
+                               if name in conf['tables']}
+        keys = src.get('keys') or dict()
+        conf['table_keys'] = {name: key for name, key in keys.items()
+                              if name in conf['tables']}
+        conf['blogs'] = src.get('blogs') or list()
@@ -0,0 +1,306 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import re
+import subprocess
+
+import lib
+import metrics
+from process.common import AbstractProcess, local_path, pump
+from process.compression import local_command
+from process.multisite import site_domains
+
+# Lines of the dump are grouped in batches of about this size, a batch is
+# the unit of work of the worker processes
+BATCH_SIZE = 4 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+# String literal of a dump, the quotes inside it are escaped
+LITERAL = re.compile(rb"'[^'\\]*(?:\\.[^'\\]*)*'", re.DOTALL)
+ESCAPED = re.compile(rb'\\(.)', re.DOTALL)
+SERIALIZED = re.compile(rb's:(\d+):"')
+
+# Escape sequences written by mysqldump
+UNESCAPE = {b'0': b'\x00', b'n': b'\n', b'r': b'\r', b'Z': b'\x1a',
+            b't': b'\t', b'b': b'\b'}
+ESCAPE = ((b'\\', b'\\\\'), (b'\x00', b'\\0'), (b'\n', b'\\n'),
+          (b'\r', b'\\r'), (b'\x1a', b'\\Z'), (b"'", b"\\'"), (b'"', b'\\"'))
+
+
+def local_replace(args):
+    """Checks if the urls of the dumps are replaced by this machine
+    With fast copy the dumps do not go through this machine, so wp replaces
+    them in the source. It is the default
+    """
+    return args.search_replace != 'wp' and not args.fast_copy
+
+
+def _escape(value):
+    for char, escaped in ESCAPE:
+        value = value.replace(char, escaped)
+    return value
+
+
+def _unescape(value):
+    return ESCAPED.sub(lambda match: UNESCAPE.get(match.group(1),
+                                                  match.group(1)), value)
+
+
+def rules(search, replace):
+    """Returns the (search, replace) pairs applied to the values
+    Besides the plain text, the urls are also stored with their slashes
+    escaped by json_encode
+    """
+    search = search.encode('utf-8')
+    replace = replace.encode('utf-8')
+    pairs = [(search, replace)]
+    if b'/' in search:
+        pairs.append((search.replace(b'/', b'\\/'),
+                      replace.replace(b'/', b'\\/')))
+    return pairs
+
+
+def _plain(value, pairs):
+    for search, replace in pairs:
+        value = value.replace(search, replace)
+    return value
+
+
+def _value(value, pairs):
+    """Replaces the text of a value fixing the length of the php serialized
+    strings which contain it, also when they are nested in other ones
+    A string whose length does not match its content is replaced as plain
+    text, like wp does with the values it is not able to unserialize
+    """
+    if not any(search in value for search, _ in pairs):
+        return value
+    if b's:' not in value:
+        return _plain(value, pairs)
+    parts = list()
+    pos = 0
+    while True:
+        match = SERIALIZED.search(value, pos)
+        if match is None:
+            break
+        start = match.end()
+        end = start + int(match.group(1))
+        if value[end:end + 2] != b'";':
+            parts.append(_plain(value[pos:start], pairs))
+            pos = start
+            continue
+        parts.append(_plain(value[pos:match.start()], pairs))
+        inner = _value(value[start:end], pairs)
+        parts.append(b's:%d:"%s";' % (len(inner), inner))
+        pos = end + 2
+    parts.append(_plain(value[pos:], pairs))
+    return b''.join(parts)
+
+
+def replace_batch(data, pairs):
+    """Replaces the values of a batch of complete lines of a dump
+    Only the string literals are changed, so the names of the tables and
+    the columns are kept
+    """
+    needles = [_escape(search) for search, _ in pairs]
+
+    def literal(match):
+        text = match.group(0)
+        if not any(needle in text for needle in needles):
+            return text
+        return b"'" + _escape(_value(_unescape(text[1:-1]), pairs)) + b"'"
+
+    lines = data.split(b'\n')
+    for idx, line in enumerate(lines):
+        if any(needle in line for needle in needles):
+            lines[idx] = LITERAL.sub(literal, line)
+    return b'\n'.join(lines)
+
+
+class Replacer(object):
+    """Replaces the urls of a dump while it is being transferred
+
+    The data is fed in pieces of any size and it is given back in the same
+    order once its lines are complete. The batches which contain the url
+    are replaced in worker processes, at most two batches per worker are
+    kept in memory, besides the current line of the dump.
+    """
+
+    def __init__(self, search, replace, workers=1, domains=()):
+        # The urls of the sites moved to other domains usually contain the
+        # url of the network, so they are replaced first
+        self.pairs = [pair for url, domain in domains
+                      for pair in rules(url, domain)]
+        self.pairs += rules(search, replace)
+        self.needles = [_escape(item) for item, _ in self.pairs]
+        self.line = b''
+        self.batch = list()
+        self.size = 0
+        # Batches in the order of the dump, bytes or futures
+        self.pending = deque()
+        self.limit = workers * 2
+        self.executor = None
+        if workers > 1:
+            # The workers are not forked, the threads of this process may
+            # be holding locks
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'))
+
+    def _submit(self):
+        data = b''.join(self.batch)
+        self.batch = list()
+        self.size = 0
+        if not any(needle in data for needle in self.needles):
+            self.pending.append(data)
+        elif self.executor is None:
+            self.pending.append(replace_batch(data, self.pairs))
+        else:
+            self.pending.append(self.executor.submit(replace_batch, data,
+                                                     self.pairs))
+
+    def _ready(self, wait=False):
+        parts = list()
+        while self.pending:
+            item = self.pending[0]
+            if isinstance(item, bytes):
+                parts.append(self.pending.popleft())
+            elif wait or item.done() or len(self.pending) > self.limit:
+                parts.append(self.pending.popleft().result())
+            else:
+                break
+        return b''.join(parts)
+
+    def feed(self, data):
+        """Adds data to the dump, returns the replaced data which is ready"""
+        end = data.rfind(b'\n')
+        if end < 0:
+            self.line += data
+            return self._ready()
+        self.batch.append(self.line + data[:end + 1])
+        self.size += len(self.batch[-1])
+        self.line = data[end + 1:]
+        if self.size >= BATCH_SIZE:
+            self._submit()
+        return self._ready()
+
+    def close(self):
+        """Ends the dump, returns the rest of the replaced data"""
+        self.batch.append(self.line)
+        self.line = b''
+        self._submit()
+        try:
+            return self._ready(wait=True)
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+
+    def abort(self):
+        """Stops the workers without waiting for the batches"""
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+
+def replacer(args, conf, workers=None):
+    """Returns the replacer of the source site url by the destination one
+    and of the urls of the selected sites by their domains
+    """
+    return Replacer(conf['wp-config']['SRC_DOMAIN_CURRENT_SITE'],
+                    conf['wp-config']['DOMAIN_CURRENT_SITE'],
+                    workers or args.replace_workers, site_domains(conf))
+
+
+def rewrite(conf, engine, read, write, progress=None):
+    """Replaces the urls of a dump which is read with read(size) and
+    written with write(data)
+    A compressed dump is decompressed and compressed again with the codec
+    of the migration, which has to be installed in this machine
+    Returns the amount of bytes read
+    """
+    total = [0]
+
+    def source(size):
+        data = read(size)
+        total[0] += len(data)
+        if progress is not None:
+            progress.update(len(data))
+        return data
+
+    if local_command(conf, 'decompress') is None:
+        try:
+            while True:
+                data = source(READ_SIZE)
+                if not data:
+                    break
+                write(engine.feed(data))
+            write(engine.close())
+        except Exception:
+            engine.abort()
+            raise
+        return total[0]
+
+    decompressor = subprocess.Popen(local_command(conf, 'decompress'),
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE)
+    compressor = subprocess.Popen(local_command(conf, 'compress'),
+                                  stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE)
+    procs = [decompressor, compressor]
+    errors = list()
+    threads = [pump(source, decompressor.stdin.write, errors, procs,
+                    decompressor.stdin.close),
+               pump(compressor.stdout.read1, write, errors, procs)]
+    try:
+        while True:
+            data = decompressor.stdout.read1(READ_SIZE)
+            if not data:
+                break
+            compressor.stdin.write(engine.feed(data))
+        compressor.stdin.write(engine.close())
+        compressor.stdin.close()
+    except Exception as exc:
+        engine.abort()
+        errors.append(exc)
+        for proc in procs:
+            proc.kill()
+    for thread in threads:
+        thread.join()
+    for name, proc in (('decompress', decompressor), ('compress', compressor)):
+        if proc.wait() != 0 and not errors:
+            errors.append(Exception('Unable to {} the database dump'
+                                    .format(name)))
+    if errors:
+        raise errors[0]
+    return total[0]
+
+
+def replace_file(conf, source, target, engine, progress=None):
+    """Replaces the urls of a local dump into another file
+    Returns the size of the dump
+    """
+    with open(source, 'rb') as src, open(target, 'wb') as dest:
+        return rewrite(conf, engine, src.read, dest.write, progress)
+
+
+class LocalReplaceDumpProcess(AbstractProcess):
+    """Replaces the source site url in the downloaded database dump
+    The source only exports the database, the urls and the lengths of the
+    php serialized values are fixed in this machine before the dump is
+    uploaded to the destination
+    """
+    inputs = ('conf:compression', 'conf:wp-config', 'local:mysql.dump')
+    outputs = ('local:mysql.replaced.dump',)
+
+    def init(self):
+        # The dump goes to the destination
+        self.target = AbstractProcess.DEST
+        self.name = 'Replacing site url in database dump'
+
+    def execute(self, args, conf):
+        dump = local_path(args, 'mysql.dump')
+        size = replace_file(conf, dump,
+                            local_path(args, 'mysql.replaced.dump'),
+                            replacer(args, conf),
+                            metrics.Progress(self.name,
+                                             os.path.getsize(dump)))
+        lib.log.debug('%d bytes of dump replaced', size)
@@ -0,0 +1,201 @@
+import fnmatch
+import posixpath
+import re
+
+import lib
+from process.common import AbstractProcess
+from process.multisite import upload_rules
+
+# Files of a wordpress site which are not needed in the destination: caches
+# rebuilt by the plugins, backups made by backup plugins, logs and node
+# dependencies
+DEFAULT_EXCLUDES = [
+    'wp-content/cache',
+    'wp-content/et-cache',
+    'wp-content/upgrade',
+    'wp-content/updraft',
+    'wp-content/ai1wm-backups',
+    'wp-content/backups-dup-lite',
+    'wp-content/backups-dup-pro',
+    'wp-content/uploads/backwpup-*',
+    'node_modules',
+    '*.log',
+    'error_log',
+]
+
+# Directories listed by the scan, up to this depth
+REPORT_DIRS = 10
+REPORT_DEPTH = 3
+
+
+class Rules(object):
+    """Exclude and include patterns of the wordpress files
+
+    A pattern without a slash matches the name of a file or directory at
+    any depth, like node_modules or *.log, and a pattern with a slash
+    matches the path from the wordpress root, like wp-content/cache. A file
+    is excluded when it or one of its directories matches an exclude
+    pattern and none of them matches an include pattern.
+    """
+
+    def __init__(self, excludes, includes):
+        self.excludes = self._compile(excludes)
+        self.includes = self._compile(includes)
+        # (excluded, included) of the directories already checked
+        self.dirs = {'': (False, False)}
+
+    @staticmethod
+    def _compile(patterns):
+        patterns = [item.strip('/') for item in patterns]
+        compiled = list()
+        for with_slash in (False, True):
+            items = [fnmatch.translate(item) for item in patterns
+                     if ('/' in item) == with_slash]
+            compiled.append(re.compile('|'.join(items)) if items else None)
+        return compiled
+
+    @staticmethod
+    def _match(compiled, path):
+        names, paths = compiled
+        return bool(names and names.match(posixpath.basename(path)) or
+                    paths and paths.match(path))
+
+    def _dir_state(self, path):
+        """Returns if a directory or its parents match an exclude and an
+        include pattern
+        """
+        if path not in self.dirs:
+            excluded, included = self._dir_state(posixpath.dirname(path))
+            self.dirs[path] = (excluded or self._match(self.excludes, path),
+                               included or self._match(self.includes, path))
+        return self.dirs[path]
+
+    def excluded(self, name):
+        """Checks if a file, given by its path from the root, is excluded"""
+        excluded, included = self._dir_state(posixpath.dirname(name))
+        excluded = excluded or self._match(self.excludes, name)
+        included = included or self._match(self.includes, name)
+        return excluded and not included
+
+    def dir_excluded(self, path):
+        excluded, included = self._dir_state(path)
+        return excluded and not included
+
+
+def load_rules(args, conf):
+    """Returns the rules given by the arguments, along with the ones which
+    leave out the uploads of the sites not selected
+    """
+    excludes = list(args.exclude or list())
+    includes = list(args.include or list())
+    if not args.no_default_excludes:
+        excludes = DEFAULT_EXCLUDES + excludes
+    if conf.get('sites'):
+        site_excludes, site_includes = upload_rules(conf['sites'])
+        excludes += site_excludes
+        includes += site_includes
+    return Rules(excludes, includes)
+
+
+def plan(files, rules):
+    """Finds the paths to leave out of the archives
+    files is a dict of name -> size. A directory is left out as a whole
+    when it is excluded and none of its files is kept, otherwise its
+    excluded files are left out one by one
+    Returns the sorted paths and a dict with the excluded files and sizes
+    """
+    kept = set()
+    excluded = dict()
+    for name, size in files.items():
+        if rules.excluded(name):
+            excluded[name] = size
+            continue
+        parent = posixpath.dirname(name)
+        while parent and parent not in kept:
+            kept.add(parent)
+            parent = posixpath.dirname(parent)
+    paths = set()
+    for name in excluded:
+        parts = name.split('/')
+        target = name
+        for idx in range(1, len(parts)):
+            prefix = '/'.join(parts[:idx])
+            if prefix not in kept and rules.dir_excluded(prefix):
+                target = prefix
+                break
+        paths.add(target)
+    return sorted(paths), excluded
+
+
+def exclude_input(conf):
+    """Returns the input of archive_command, the paths it leaves out"""
+    return (('./' + path + '\n').encode('utf-8', 'surrogateescape')
+            for path in conf.get('excludes', list()) if '\n' not in path)
+
+
+def archive_command(args):
+    """Returns the tar command of the source files, it writes to stdout
+    The paths to leave out are read from its input, see exclude_input
+    """
+    return ('tar -cf - -C {} --anchored --no-wildcards -X - .'
+            .format(args.src_wpath))
+
+
+def _remote_sizes(ssh, path):
+    """Returns the size of every file in path, directories excluded"""
+    cmd = 'cd {} && find . ! -type d -printf "%s\\0%P\\0"'.format(path)
+    lib.log.debug(cmd)
+    _, stdout, stderr = ssh.exec_command(cmd)
+    content = stdout.read().decode('utf-8', 'surrogateescape')
+    status = stdout.channel.recv_exit_status()
+    if status != 0:
+        raise Exception(stderr.read().decode('utf-8'))
+    items = content.split('\0')[:-1]
+    return {items[idx + 1]: int(items[idx])
+            for idx in range(0, len(items), 2)}
+
+
+def _report(files, excluded, rules):
+    """Logs the largest directories and the savings of the rules"""
+    dirs = dict()
+    for name, size in files.items():
+        parts = name.split('/')
+        for idx in range(1, min(len(parts), REPORT_DEPTH + 1)):
+            item = dirs.setdefault('/'.join(parts[:idx]), [0, 0])
+            item[0] += size
+            item[1] += 1
+    lib.log.info('Largest directories:')
+    for path in sorted(dirs, key=lambda item: dirs[item][0],
+                       reverse=True)[:REPORT_DIRS]:
+        lib.log.info('%10.1f MB %8d files  %s%s', dirs[path][0] / 1024 / 1024,
+                     dirs[path][1], path,
+                     ' (excluded)' if rules.dir_excluded(path) else '')
+    total = sum(files.values())
+    saved = sum(excluded.values())
+    lib.log.info('Exclude rules leave out %d of %d files, %.1f of %.1f MB '
+                 '(%.0f%%)', len(excluded), len(files), saved / 1024 / 1024,
+                 total / 1024 / 1024, 100.0 * saved / total if total else 0)
+
+
+class SrcScanFilesProcess(AbstractProcess):
+    """Scans the wordpress files of the source
+    It logs the largest directories and the bytes the exclude rules save,
+    the archives and the other transfers of files leave those files out
+    """
+    inputs = ('conf:sites',)
+    outputs = ('conf:excludes', 'conf:files')
+
+    def init(self):
+        self.target = AbstractProcess.SRC
+        self.name = 'Scanning source files'
+
+    def execute(self, args, conf):
+        ssh = self.cons[self.target]
+        files = _remote_sizes(ssh, args.src_wpath)
+        rules = load_rules(args, conf)
+        conf['excludes'], excluded = plan(files, rules)
+        # The files which are transferred
+        conf['files'] = {
+            'count': len(files) - len(excluded),
+            'bytes': sum(files.values()) - sum(excluded.values())}
+        _report(files, excluded, rules)
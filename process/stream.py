@@ -0,0 +1,26 @@
+from process.common import AbstractProcess, files_path, pipe
+from process.compression import compress, decompress
+from process.scan import archive_command, exclude_input
+
+
+class DestStreamWordpressProcess(AbstractProcess):
+    """Streams the wordpress files from source straight into destination
+    The source tar output is extracted in the destination while it is being
+    created, so no tar file is written in any machine
+    """
+    inputs = ('conf:compression', 'conf:excludes', 'ssh:src',
+              'src:/tmp/tmp_key.pem', 'dest:authorized_keys')
+    outputs = ('dest:wpath',)
+
+    def init(self):
+        self.target = AbstractProcess.DEST
+        self.name = 'Streaming wordpress files from source to destination'
+
+    def execute(self, args, conf):
+        sudo = 'sudo ' if args.dest_sudo else ''
+        archive = compress(conf, archive_command(args))
+        extract = '{0}mkdir -p {1}; {2}'.format(
+            sudo, files_path(args),
+            decompress(conf, '{}tar -xf - -C {}'.format(sudo, files_path(args))))
+        self.add_bytes(pipe(self.cons, args, archive, extract,
+                            exclude_input(conf)))
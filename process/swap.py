@@ -0,0 +1,109 @@
+import posixpath
+import shlex
+import time
+
+import lib
+from process.backup import backup_path, make_backup_command
+from process.common import AbstractProcess, AsyncProcess, files_path
+from process.database import OLD_PREFIX, SHADOW_PREFIX, mysql_command
+
+
+def swap_statements(tables, existing):
+    """Returns the sql which puts the imported tables in place of the site
+    ones
+    The tables of the site are renamed with the old prefix in the same
+    statement, so the site never misses a table. The tables which were
+    already swapped are left as they are
+    """
+    existing = set(existing)
+    drops = ['`{}{}`'.format(OLD_PREFIX, table) for table in tables
+             if OLD_PREFIX + table in existing]
+    renames = list()
+    for table in tables:
+        if SHADOW_PREFIX + table not in existing:
+            continue
+        if table in existing:
+            renames.append('`{0}` TO `{1}{0}`'.format(table, OLD_PREFIX))
+        renames.append('`{1}{0}` TO `{0}`'.format(table, SHADOW_PREFIX))
+    if not renames:
+        return ''
+    sql = ''
+    if drops:
+        sql += 'DROP TABLE IF EXISTS {};\n'.format(', '.join(drops))
+    return sql + 'RENAME TABLE {};\n'.format(', '.join(renames))
+
+
+def unswap_statements(tables, existing):
+    """Returns the sql which puts back the site tables after the statements
+    of swap_statements, for the same tables and existing tables
+    """
+    existing = set(existing)
+    renames = list()
+    for table in tables:
+        if SHADOW_PREFIX + table not in existing:
+            continue
+        renames.append('`{0}` TO `{1}{0}`'.format(table, SHADOW_PREFIX))
+        if table in existing:
+            renames.append('`{1}{0}` TO `{0}`'.format(table, OLD_PREFIX))
+    if not renames:
+        return ''
+    return 'RENAME TABLE {};'.format(', '.join(renames))
+
+
+class DestSwapProcess(AsyncProcess):
+    """Puts the migrated site in place of the destination one
+    The imported tables take the names of the site tables and the new
+    directory takes the wordpress path. The previous tables are kept with
+    the old prefix. The previous files are renamed aside in the same file
+    system, so the switch never copies them, and then moved into the backup
+    of the migration, or kept with the .old suffix when there are no
+    backups. When the files can not be switched the tables are put back
+    """
+    inputs = ('conf:wp-config', 'conf:db_host', 'conf:tables',
+              'dest:wpath', 'dest:db')
+    outputs = ('dest:wpath', 'dest:db')
+
+    def init(self):
+        self.target = AbstractProcess.DEST
+        self.name = 'Swapping migrated site into place'
+
+    async def run(self, args, conf):
+        sudo = 'sudo ' if args.dest_sudo else ''
+        wpath = args.dest_wpath.rstrip('/')
+        if args.backup_keep:
+            # The rename is the snapshot of the files
+            aside = '{}.old.{}'.format(wpath, conf['backup'])
+            previous = posixpath.join(backup_path(args, conf), 'files')
+            await self.command(args, make_backup_command(args, conf))
+        else:
+            # The copy kept by the previous swap is removed before the site
+            # is switched, so the switch is only two renames
+            aside = previous = wpath + '.old'
+            await self.command(args, '{}rm -rf {}'.format(sudo, aside))
+        existing = await self.command(
+            args, "{} -N -e 'SHOW TABLES'".format(mysql_command(conf)))
+        existing = existing.decode('utf-8').split()
+        sql = swap_statements(conf['tables'], existing)
+        # The files are only switched once the tables are, a failed rename
+        # of the tables leaves the site as it was, and a failed rename of
+        # the files puts back the previous ones and the tables
+        cmd = ('[ ! -e {0} ] || {{ {{ [ ! -e {1} ] || {2}mv {1} {3}; }} && '
+               '{{ {2}mv {0} {1} || {{ [ ! -e {3} ] || {2}mv {3} {1}; '
+               'false; }}; }}; }}'.format(files_path(args), wpath, sudo,
+                                         aside))
+        if sql:
+            cmd = '{0} && {{ {1} || {{ {0} -e {2}; false; }}; }}'.format(
+                mysql_command(conf), cmd, shlex.quote(
+                    unswap_statements(conf['tables'], existing)))
+        start = time.time()
+        await self.command(args, cmd, [sql.encode('utf-8')])
+        lib.log.info('Site swapped in %.3fs', time.time() - start)
+        if aside != previous:
+            # The backups may be in another file system, the site is
+            # already running when the files are copied there. A copy left
+            # by a failed attempt is made again
+            await self.command(args, '[ ! -e {1} ] || {{ {0}rm -rf {2} && '
+                               '{0}mv {1} {2}; }}'.format(sudo, aside,
+                                                          previous))
+        lib.log.info('The previous files are kept in %s and its tables '
+                     'with the prefix %s', previous, OLD_PREFIX)
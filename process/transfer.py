@@ -0,0 +1,187 @@
+import collections
+import hashlib
+import os
+import threading
+
+import lib
+
+
+def _exec(ssh, cmd):
+    lib.log.debug(cmd)
+    _, stdout, stderr = ssh.exec_command(cmd)
+    content = stdout.read().decode('utf-8')
+    status = stdout.channel.recv_exit_status()
+    if status != 0:
+        raise Exception(stderr.read().decode('utf-8'))
+    return content
+
+
+def _remote_hash(ssh, path, chunk_size, idx):
+    """Returns the sha1 of a single chunk of a remote file"""
+    cmd = ('dd if={} bs={} skip={} count=1 iflag=fullblock 2> /dev/null '
+           '| sha1sum'.format(path, chunk_size, idx))
+    return _exec(ssh, cmd).split()[0]
+
+
+def _prepare(state, size, mtime, chunk_size, exists):
+    """Resets the state when it does not belong to the file being moved
+    Returns the chunks which still need to be moved
+    """
+    if (state.get('size') != size or state.get('mtime') != mtime or
+            state.get('chunk') != chunk_size or not exists):
+        state.clear()
+        state.update({'size': size, 'mtime': mtime, 'chunk': chunk_size,
+                      'done': list()})
+    count = (size + chunk_size - 1) // chunk_size
+    return [idx for idx in range(count) if idx not in state['done']]
+
+
+def _start(progress, pending, size, chunk_size):
+    """Gives the progress the bytes of the pending chunks as its total, the
+    chunks verified before are not transferred again
+    """
+    if progress is not None and progress.total is None:
+        progress.total = sum(min(chunk_size, size - idx * chunk_size)
+                             for idx in pending)
+
+
+def _parallel(connections, pending, move, state, checkpoint, progress):
+    """Moves the pending chunks, each connection moves one chunk at a time
+    move(sftp, ssh, idx) moves a single chunk and returns its size. The
+    verified chunks are recorded in state one at a time, so checkpoint
+    always sees a consistent state
+    Returns the amount of bytes moved
+    """
+    queue = collections.deque(pending)
+    lock = threading.Lock()
+    errors = list()
+    total = [0]
+
+    def worker(ssh):
+        sftp = ssh.open_sftp()
+        try:
+            while not errors:
+                with lock:
+                    if not queue:
+                        return
+                    idx = queue.popleft()
+                size = move(sftp, ssh, idx)
+                with lock:
+                    total[0] += size
+                    state['done'].append(idx)
+                    checkpoint()
+                if progress is not None:
+                    progress.update(size)
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            sftp.close()
+
+    threads = [threading.Thread(target=worker, args=(ssh,))
+               for ssh in connections[:max(len(pending), 1)]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return total[0]
+
+
+def download(connections, remote, local, state, checkpoint, chunk_size,
+             progress=None):
+    """Downloads a file in chunks over sftp
+    The chunks are split between the connections, which work at the same
+    time. Every chunk is checked against the sha1 of the remote chunk
+    before it is recorded in state, checkpoint is called after each one so
+    a new run continues from the verified chunks
+    progress is an optional metrics.Progress updated after every chunk,
+    its total is the size of the chunks not transferred yet
+    Returns the amount of bytes downloaded
+    """
+    ssh = connections[0]
+    sftp = ssh.open_sftp()
+    try:
+        stat = sftp.stat(remote)
+    finally:
+        sftp.close()
+    size = stat.st_size
+    pending = _prepare(state, size, stat.st_mtime, chunk_size,
+                       os.path.exists(local) and
+                       os.path.getsize(local) == size)
+    if not state['done']:
+        with open(local, 'wb') as file:
+            file.truncate(size)
+    if not pending:
+        return 0
+    _start(progress, pending, size, chunk_size)
+
+    def move(sftp, ssh, idx):
+        offset = idx * chunk_size
+        length = min(chunk_size, size - offset)
+        with sftp.open(remote, 'rb') as src:
+            data = b''.join(src.readv([(offset, length)]))
+        # Only the chunk is read again to hash it, not the whole file
+        if hashlib.sha1(data).hexdigest() != _remote_hash(ssh, remote,
+                                                          chunk_size, idx):
+            raise Exception('Chunk {} of {} is corrupted'.format(idx, remote))
+        with open(local, 'r+b') as dest:
+            dest.seek(offset)
+            dest.write(data)
+        return length
+
+    total = _parallel(connections, pending, move, state, checkpoint,
+                      progress)
+    if os.path.getsize(local) != size:
+        raise Exception('{} does not have the size of {}'.format(local,
+                                                                  remote))
+    return total
+
+
+def upload(connections, local, remote, state, checkpoint, chunk_size,
+           progress=None):
+    """Uploads a file in chunks over sftp
+    The chunks are split between the connections, which work at the same
+    time. Every chunk is checked against the sha1 of the chunk written in
+    the remote file before it is recorded in state, checkpoint is called
+    after each one so a new run continues from the verified chunks
+    progress is an optional metrics.Progress updated after every chunk,
+    its total is the size of the chunks not transferred yet
+    Returns the amount of bytes uploaded
+    """
+    size = os.path.getsize(local)
+    mtime = int(os.path.getmtime(local))
+    sftp = connections[0].open_sftp()
+    try:
+        try:
+            exists = sftp.stat(remote).st_size == size
+        except IOError:
+            exists = False
+        pending = _prepare(state, size, mtime, chunk_size, exists)
+        if not state['done']:
+            with sftp.open(remote, 'wb') as dest:
+                dest.truncate(size)
+    finally:
+        sftp.close()
+    _start(progress, pending, size, chunk_size)
+
+    def move(sftp, ssh, idx):
+        offset = idx * chunk_size
+        with open(local, 'rb') as src:
+            src.seek(offset)
+            data = src.read(chunk_size)
+        with sftp.open(remote, 'r+b') as dest:
+            dest.set_pipelined(True)
+            dest.seek(offset)
+            dest.write(data)
+            dest.flush()
+            # The writes are pipelined, a synchronous request makes sure the
+            # server processed all of them
+            dest.stat()
+        if _remote_hash(ssh, remote, chunk_size, idx) != \
+                hashlib.sha1(data).hexdigest():
+            raise Exception('Chunk {} of {} is corrupted'.format(idx, remote))
+        return len(data)
+
+    return _parallel(connections, pending, move, state, checkpoint,
+                     progress)
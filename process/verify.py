@@ -0,0 +1,292 @@
+import asyncio
+import posixpath
+import shlex
+
+import lib
+from process.common import AbstractProcess, AsyncProcess, tmp_path
+from process.database import mysql_command, selection
+from process.scan import load_rules, plan
+
+# Differences listed in the log, the rest are only counted
+REPORT_LIMIT = 20
+
+# Leaves out of the sha1sum output the files below the paths of the first
+# file, the paths are relative to the wordpress root
+SUMS_AWK = r'''
+FILENAME == ARGV[1] { skip[$0]; next }
+{
+    path = $0
+    sub(/^\\?[0-9a-f]+  \.\//, "", path)
+    while (1) {
+        if (path in skip)
+            next
+        if (!sub(/\/[^\/]*$/, "", path))
+            break
+    }
+    print
+}
+'''
+
+# Prints the children of the directories of the first file, an empty line
+# is the wordpress root. A file is printed with its sha1, a directory is
+# followed by the sha1 of the sums of all the files below it, which are
+# contiguous because the sums are sorted by path
+TREE_AWK = r'''
+FILENAME == ARGV[1] { want[$0]; next }
+{
+    path = $0
+    sub(/^\\?[0-9a-f]+  \.\//, "", path)
+    count = split(path, parts, "/")
+    dir = ""
+    for (idx = 1; idx <= count; idx++) {
+        if (dir in want) {
+            if (idx == count) {
+                done()
+                hash = $1
+                sub(/^\\/, "", hash)
+                print "F\t" dir "\t" parts[idx] "\t" hash
+            } else {
+                key = dir "\t" parts[idx]
+                if (key != current) {
+                    done()
+                    current = key
+                    print "D\t" key
+                    fflush()
+                }
+                print $0 | "sha1sum"
+            }
+            break
+        }
+        dir = idx == 1 ? parts[1] : dir "/" parts[idx]
+    }
+}
+function done() {
+    if (current != "") {
+        close("sha1sum")
+        current = ""
+    }
+}
+END { done() }
+'''
+
+
+def sums_command(args, wpath, sudo):
+    """Returns the command which hashes the files of wpath into the sums
+    file and prints the root of the tree, the sha1 of the sums file
+    The paths to leave out are read from its input, see skip_input
+    """
+    sums = tmp_path(args, 'verify.sums')
+    return ('set -o pipefail; cat > {0}.skip && '
+            '(cd {1} && {2}find . -type f -print0) | LC_ALL=C sort -z | '
+            '(cd {1} && {2}xargs -0 -r sha1sum --) | awk {3} {0}.skip - '
+            '> {0} && sha1sum < {0}'.format(sums, wpath, sudo,
+                                            shlex.quote(SUMS_AWK)))
+
+
+def skip_input(excludes):
+    """Returns the input of sums_command: the excluded paths, which are not
+    transferred, and wp-config.php, which has other credentials in the
+    destination
+    """
+    paths = ['wp-config.php'] + list(excludes)
+    return [''.join(path + '\n' for path in paths
+                    if '\n' not in path).encode('utf-8', 'surrogateescape')]
+
+
+def list_command(wpath, sudo):
+    """Returns the command which prints the files of wpath, relative to it
+    and separated by null characters
+    """
+    return 'cd {} && {}find . ! -type d -printf "%P\\0"'.format(wpath, sudo)
+
+
+def tree_command(args):
+    """Returns the command which prints the children of the directories
+    read from its input, one per line
+    """
+    sums = tmp_path(args, 'verify.sums')
+    return 'cat > {0}.query && awk {1} {0}.query {0}'.format(
+        sums, shlex.quote(TREE_AWK))
+
+
+def parse_tree(output):
+    """Returns the children printed by tree_command, a dict of
+    (directory, name) -> (kind, sha1)
+    """
+    entries = dict()
+    lines = iter(output.decode('utf-8', 'surrogateescape').split('\n'))
+    for line in lines:
+        if not line:
+            continue
+        items = line.split('\t')
+        if items[0] == 'D':
+            # The sha1 of the directory comes in the next line
+            items.append(next(lines).split()[0])
+        entries[(items[1], items[2])] = (items[0], items[3])
+    return entries
+
+
+def compare(src, dest):
+    """Compares the children of the same directories in both machines
+    Returns the directories which differ, to be compared one level below,
+    and the files which differ
+    """
+    descend = list()
+    differences = list()
+    for key in sorted(set(src) | set(dest)):
+        path = posixpath.join(*key)
+        if key not in dest:
+            differences.append('missing {}'.format(path))
+        elif key not in src:
+            differences.append('extra {}'.format(path))
+        elif src[key] == dest[key]:
+            continue
+        elif src[key][0] == dest[key][0] == 'D':
+            descend.append(path)
+        else:
+            differences.append('changed {}'.format(path))
+    return descend, differences
+
+
+def tables_sql(tables, summed, conditions=None):
+    """Returns the sql which prints the rows of every table, only the ones
+    matching their condition when it has one, and then the checksum of the
+    summed tables
+    """
+    conditions = conditions or dict()
+    sql = ' UNION ALL '.join(
+        "SELECT '{0}', COUNT(*) FROM `{0}`{1}".format(
+            table, ' WHERE {}'.format(conditions[table])
+            if table in conditions else '')
+        for table in tables) + ';'
+    if summed:
+        sql += ' CHECKSUM TABLE {};'.format(', '.join(
+            '`{}`'.format(table) for table in summed))
+    return sql
+
+
+def parse_tables(output, tables, summed):
+    """Returns the rows and the checksums printed by the sql of tables_sql,
+    by table
+    """
+    lines = output.decode('utf-8').strip().split('\n')
+    rows = {table: line.split('\t')[-1]
+            for table, line in zip(tables, lines[:len(tables)])}
+    # CHECKSUM TABLE prints the table with the name of the database
+    checksums = {table: line.split('\t')[-1]
+                 for table, line in zip(summed, lines[len(tables):])}
+    return rows, checksums
+
+
+class VerifySitesProcess(AsyncProcess):
+    """Checks that the destination matches the source
+    Both machines hash their files at the same time into a tree, only the
+    roots are compared and then the directories whose hashes differ, one
+    level at a time. The exclude rules leave out the same files in both
+    machines. The rows of every table are counted, the ones matching the
+    row filter in the source, and when the url of the site did not change
+    the checksums of the tables exported whole are compared too. No data
+    is transferred again
+    """
+    inputs = ('conf:excludes', 'conf:sites', 'conf:tables',
+              'conf:wp-config', 'conf:db_host', 'ssh:src', 'dest:wpath',
+              'dest:db')
+
+    def init(self):
+        self.target = AbstractProcess.DEST
+        self.name = 'Verifying destination against source'
+
+    async def run(self, args, conf):
+        sudo = 'sudo ' if args.dest_sudo else ''
+        try:
+            differences = await self._files(args, conf, sudo)
+            differences += await self._tables(args, conf)
+        finally:
+            cmd = 'rm -f {0} {0}.skip {0}.query'.format(
+                tmp_path(args, 'verify.sums'))
+            await asyncio.gather(
+                self.command(args, cmd),
+                self.command(args, cmd, target=AbstractProcess.SRC))
+        self.stats.info['verify'] = {'differences': len(differences)}
+        if differences:
+            for item in differences[:REPORT_LIMIT]:
+                lib.log.error('Verification: %s', item)
+            raise Exception('The destination does not match the source, {} '
+                            'differences found'.format(len(differences)))
+        lib.log.info('The destination matches the source')
+
+    async def _both(self, args, src_cmd, dest_cmd, stdin=None):
+        return await asyncio.gather(
+            self.command(args, src_cmd, stdin, target=AbstractProcess.SRC),
+            self.command(args, dest_cmd, stdin))
+
+    async def _excludes(self, args, conf, sudo):
+        """Returns the paths of the destination the exclude rules leave
+        out, like the uploads of the sites of the network not selected
+        """
+        output = await self.command(args, list_command(args.dest_wpath, sudo))
+        names = output.decode('utf-8', 'surrogateescape').split('\0')[:-1]
+        paths, _ = plan(dict.fromkeys(names, 0), load_rules(args, conf))
+        return paths
+
+    async def _files(self, args, conf, sudo):
+        excludes = await self._excludes(args, conf, sudo)
+        roots = await asyncio.gather(
+            self.command(args, sums_command(args, args.src_wpath, ''),
+                         skip_input(conf.get('excludes', list())),
+                         target=AbstractProcess.SRC),
+            self.command(args, sums_command(args, args.dest_wpath, sudo),
+                         skip_input(excludes)))
+        if roots[0] == roots[1]:
+            return list()
+        differences = list()
+        dirs = ['']
+        levels = 0
+        while dirs:
+            levels += 1
+            src, dest = await self._both(
+                args, tree_command(args), tree_command(args),
+                [''.join(item + '\n' for item in dirs).encode(
+                    'utf-8', 'surrogateescape')])
+            dirs, found = compare(parse_tree(src), parse_tree(dest))
+            differences += found
+        lib.log.info('Files compared down to %d levels', levels)
+        return differences
+
+    async def _tables(self, args, conf):
+        whole, filtered, schema = selection(args, conf['tables'])
+        # The destination has the rows of the source matching the filters,
+        # and none of the tables exported without their rows
+        conditions = dict(filtered)
+        conditions.update((table, 'FALSE') for table in schema)
+        tables = whole + list(conditions)
+        if not tables:
+            return list()
+        for table, condition in filtered:
+            lib.log.info('Only the rows of %s matching %s are compared', table,
+                         condition)
+        for table in schema:
+            lib.log.info('%s is expected without rows', table)
+        # The search and replace changes the rows with the url
+        summed = whole
+        if (conf['wp-config']['SRC_DOMAIN_CURRENT_SITE'] !=
+                conf['wp-config']['DOMAIN_CURRENT_SITE']):
+            summed = list()
+            lib.log.info('The site url changed, only the rows of the tables '
+                         'are compared')
+        src_sql = tables_sql(tables, summed, conditions)
+        dest_sql = tables_sql(tables, summed)
+        src, dest = await self._both(
+            args, 'wp --allow-root --path={} db query {} --skip-column-names'
+            .format(args.src_wpath, shlex.quote(src_sql)),
+            '{} -N -e {}'.format(mysql_command(conf), shlex.quote(dest_sql)))
+        src_rows, src_sums = parse_tables(src, tables, summed)
+        dest_rows, dest_sums = parse_tables(dest, tables, summed)
+        differences = list()
+        for table in tables:
+            if src_rows.get(table) != dest_rows.get(table):
+                differences.append('{} has {} rows instead of {}'.format(
+                    table, dest_rows.get(table), src_rows.get(table)))
+            elif src_sums.get(table) != dest_sums.get(table):
+                differences.append('{} has other rows'.format(table))
+        return differences
@@ -0,0 +1,153 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import threading
+
+import lib
+import metrics
+
+
+def _conflicts(first, second):
+    """Checks if the second process must wait for the first one
+    It happens when one of them writes a resource the other one reads or
+    writes
+    """
+    first_in, first_out = first.resources()
+    second_in, second_out = second.resources()
+    return bool(first_out & (second_in | second_out) or
+                first_in & second_out)
+
+
+def _merge(conf, before, after):
+    """Applies over conf the changes a process did over its copy"""
+    for key in after:
+        if key not in before or after[key] != before[key]:
+            conf[key] = copy.deepcopy(after[key])
+    for key in before:
+        if key not in after:
+            conf.pop(key, None)
+
+
+class Scheduler(object):
+    """Runs the processes as soon as their dependencies are done
+
+    The dependencies are taken from the order of the processes and the
+    resources each of them declares, so a process only waits for the
+    previous processes which touch the same resources. Every process works
+    over its own copy of the configuration, which is merged back when it
+    finishes, so the configuration can be saved at any time.
+
+    The processes are tasks of an event loop. The asynchronous ones wait
+    for their remote commands in the loop, and the synchronous ones run in
+    the threads of the loop.
+    """
+
+    def __init__(self, processes, done, jobs, name='', retries=0):
+        self.processes = processes
+        self.done = done
+        self.jobs = jobs
+        # Times a process is executed again when a connection dropped while
+        # it was running
+        self.retries = retries
+        # Prefix of the worker threads and lanes, it tells the migrations
+        # apart in the log when several of them run in the same process
+        self.name = name
+        self.lock = threading.Lock()
+        self.depends = dict()
+        for idx, proc in enumerate(processes):
+            self.depends[proc] = [item for item in processes[:idx]
+                                  if _conflicts(item, proc)]
+
+    def _ready(self, proc, finished):
+        return all(item in finished for item in self.depends[proc])
+
+    async def _run(self, proc, args, conf, lane):
+        # The stats and the remote commands of the process are drawn in the
+        # lane it took
+        metrics.LANE.set('{}_{}'.format(self.name or 'step', lane))
+        lib.log.info('Starts "%s"', proc.name)
+        proc.stats.begin()
+        for attempt in range(self.retries + 1):
+            drops = proc.pool.drops
+            try:
+                await proc.run(args, conf)
+                break
+            except asyncio.CancelledError:
+                proc.stats.finish('cancelled')
+                raise
+            except Exception as exc:
+                # The process resumes from its last checkpoint over the
+                # reconnected transports
+                if attempt == self.retries or proc.pool.drops == drops:
+                    proc.stats.finish('failed')
+                    raise
+                proc.stats.retries += 1
+                lib.log.warning('Connection lost in "%s", retrying: %s',
+                                proc.name, exc)
+        proc.stats.finish('done')
+        lib.log.info('Done "%s" in %.1fs (%.1fs in remote commands)',
+                     proc.name, proc.stats.wall_time,
+                     proc.stats.command_time)
+
+    def _checkpoint(self, before, local, save):
+        """Returns the function a process calls to save its progress"""
+        def checkpoint():
+            with self.lock:
+                _merge(self.conf, before, local)
+                save()
+        return checkpoint
+
+    def run(self, args, conf, save):
+        """Executes the pending processes
+        save is called after every process finishes, while holding the lock
+        Returns True when all the processes were executed
+        """
+        return asyncio.run(self._main(args, conf, save))
+
+    async def _main(self, args, conf, save):
+        # Besides the synchronous processes, the threads open the channels
+        # and wait for the end of the asynchronous commands
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(
+            max_workers=self.jobs * 2, thread_name_prefix=self.name))
+        self.conf = conf
+        finished = set(proc for proc in self.processes
+                       if proc.key in self.done and not proc.required)
+        pending = [proc for proc in self.processes if proc not in finished]
+        running = dict()
+        lanes = list(range(self.jobs))
+        failed = False
+        while pending or running:
+            if not failed:
+                for proc in [item for item in pending
+                             if self._ready(item, finished)]:
+                    if not lanes:
+                        break
+                    pending.remove(proc)
+                    with self.lock:
+                        before = copy.deepcopy(conf)
+                    local = copy.deepcopy(before)
+                    proc.checkpoint = self._checkpoint(before, local, save)
+                    lane = lanes.pop(0)
+                    task = asyncio.create_task(
+                        self._run(proc, args, local, lane))
+                    running[task] = (proc, before, local, lane)
+            if not running:
+                break
+            complete, _ = await asyncio.wait(
+                running, return_when=asyncio.FIRST_COMPLETED)
+            for task in complete:
+                proc, before, local, lane = running.pop(task)
+                lanes.append(lane)
+                lanes.sort()
+                exc = task.exception()
+                if exc is not None:
+                    lib.log.error(exc)
+                    failed = True
+                    continue
+                finished.add(proc)
+                with self.lock:
+                    _merge(conf, before, local)
+                    if proc.key not in self.done:
+                        self.done.append(proc.key)
+                    save()
+        return not failed and not pending